@@ -76,8 +76,7 @@ def _relevant_pickup_drop_affs() -> AffordancesList:
       if option in definitions.OptionsAny:
         # Skip options that do "any".
         continue
-      gridcell = int(option.name.replace('GoTo', '').split('_')[0])
-      target_location = env_utils.grid_cell_to_xy(gridcell)
+      target_location = definitions.OPTION_INFO[option].target_xy
 
       # The option goes to relevant corners of the world.
       if target_location in env_utils.LOCATION_TO_COLOR_MAPPING:
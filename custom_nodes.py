@@ -26,10 +26,14 @@ Additionally there are a few private functions to:
 2. Save and load the options, policy over options, models and affordances for
 later use.
 """
+import collections
+import concurrent.futures
 import functools
 import itertools
+import multiprocessing
 import os
 import shutil
+import threading
 import time
 from typing import Any, Dict, Optional, Union
 
@@ -45,6 +49,7 @@ from affordances_option_models import env_utils
 from affordances_option_models import hrl
 from affordances_option_models import networks
 from affordances_option_models import option_utils
+from affordances_option_models import seeding
 from affordances_option_models import task_queue
 from affordances_option_models import training
 
@@ -64,27 +69,48 @@ def _np_load(load_path: str) -> np.ndarray:
     return np.load(fout, allow_pickle=True)
 
 
-@functools.lru_cache(maxsize=1)
+# Loaded options by the digest of their content, shared by all nodes in this
+# process. Options saved in several places are only kept in memory once.
+_OPTIONS_BY_DIGEST: Dict[str, option_utils.PackedOptionPolicies] = {}
+_OPTIONS_LOCK = threading.Lock()
+
+
 def _load_options(
     path_to_options: str, debugging: bool = False
-    ) -> Dict[definitions.Options, np.ndarray]:
-  """Loads options into a table."""
-  option_policy_table = {}
-  for option_id in option_utils.Options:
-    load_path = os.path.join(path_to_options, option_id.name + '.npz')
-    if debugging and option_id.value > 1:
-      # When debugging, we are just looking for if the code runs and there are
-      # no issues. Since this is usually done locally, we bypass this by
-      # re-using the table loaded for the first option.
-      option_policy_table[option_id] = (
-          option_policy_table[option_utils.Options(1)])
-      logging.log_every_n_seconds(logging.WARNING, 'Debugging is on', 10)
-      continue
-    else:
-      option_policy_table[option_id] = _np_load(load_path)
+    ) -> option_utils.PackedOptionPolicies:
+  """Loads options into packed tables, reusing them if already loaded.
+
+  Args:
+    path_to_options: The directory with the option files.
+    debugging: If True, the first option is loaded for every option.
+
+  Returns:
+    The packed option policies, the same object as long as the option files do
+    not change.
+
+  Raises:
+    ValueError: If the option files do not match their manifest or the packed
+      tables have the wrong shape, see `option_utils.load_option_policies`.
+  """
+  if debugging:
+    # When debugging, we are just looking for if the code runs and there are
+    # no issues. Since this is usually done locally, we bypass this by
+    # re-using the table loaded for the first option.
+    logging.log_every_n_seconds(logging.WARNING, 'Debugging is on', 10)
+    option_policy = _np_load(os.path.join(
+        path_to_options,
+        option_utils.option_policy_filename(option_utils.Options(1))))
+    return option_utils.pack_option_policies(
+        {option_id: option_policy for option_id in option_utils.Options})
+  # The digest is cached until the option files change, so this is cheap.
+  digest = option_utils.option_policies_digest(path_to_options)
+  with _OPTIONS_LOCK:
+    if digest not in _OPTIONS_BY_DIGEST:
+      _OPTIONS_BY_DIGEST[digest] = option_utils.load_option_policies(
+          path_to_options)
       logging.info(
-          'Successfully loaded option: %s from %s', option_id, load_path)
-  return option_policy_table
+          'Successfully loaded options %s from %s', digest, path_to_options)
+    return _OPTIONS_BY_DIGEST[digest]
 
 
 def _make_option_model_table(
@@ -369,7 +395,7 @@ class Trainer:
         _, result = self._queue.get_task(self._topic_name)
         queue_get_time = time.time() - running_time
         running_time = time.time()
-        total_trajectories += len(result['data'])
+        total_trajectories += result['data'].num_transitions
         data = training.prepare_data(result['data'])
         model_losses = self._model_train_step(data)
         affordance_losses = self._affordance_train_step(data)
@@ -426,6 +452,7 @@ class Evaluation:
   """Evaluation node for running Value Iteration on option models."""
   _EVAL_NODE_SEED = 0
   _OPTION_LENGTHS_TO_EVAL = (5, 100)
+  _HRL_EVALUATORS = ('exact', 'sampled')
 
   def __init__(
       self, *,
@@ -440,7 +467,15 @@ class Evaluation:
       save_every: int = 1,
       save_path: str = '~',
       num_eval_episodes: int = 1000,
+      warm_start: bool = True,
+      solver: str = 'value_iteration',
+      oracle_max_option_length: Optional[int] = None,
+      hrl_evaluator: str = 'exact',
       ):
+    if hrl_evaluator not in self._HRL_EVALUATORS:
+      raise ValueError(
+          f'Unknown HRL evaluator {hrl_evaluator}. '
+          f'Valid: {list(self._HRL_EVALUATORS)}')
     self._trainer_node = trainer_node
     self._path_to_options = path_to_options
     self._path_to_option_model = path_to_option_model
@@ -453,10 +488,48 @@ class Evaluation:
     self._last_save = None
     self._save_dir = save_path
     self._num_eval_episodes = num_eval_episodes
+    # When warm starting, the values from the last evaluation are used to
+    # initialize value iteration on the next option model so that every re-plan
+    # refines the previous solution instead of starting from scratch.
+    self._warm_start = warm_start
+    self._values = None
+    self._solver = solver
+    # When set, every option model is compared to the exact option model of the
+    # option policies. It is computed again only if the options change.
+    self._oracle_max_option_length = oracle_max_option_length
+    self._oracle_option_model = None
+    self._oracle_options = None
+    # The policy over options is evaluated either exactly, weighting the
+    # episode from every initial state by its probability, or by sampling
+    # `num_eval_episodes` episodes.
+    self._hrl_evaluator = hrl_evaluator
+    # Episodes are cached across model versions and only re-run where the
+    # policy over options changed. The cache is tied to the option policies,
+    # which `_load_options` returns as the same object until they change.
+    self._hrl_evaluator_cache = None
+    self._hrl_evaluator_options = None
 
   def _get_latest_options(self):
     return _load_options(self._path_to_options)
 
+  def _get_oracle_option_model(self, option_policies):
+    """Returns the exact option model, recomputed only if the options changed."""
+    if option_policies is not self._oracle_options:
+      logging.info('Computing the oracle option model.')
+      self._oracle_option_model = option_utils.compute_option_model(
+          option_policies, self._oracle_max_option_length)
+      self._oracle_options = option_policies
+    return self._oracle_option_model
+
+  def _get_hrl_evaluator(self, option_policies) -> hrl.HrlEvaluator:
+    """Returns the HRL evaluator, recreated only if the options changed."""
+    if option_policies is not self._hrl_evaluator_options:
+      logging.info('Creating an HRL evaluator for the loaded options.')
+      self._hrl_evaluator_cache = hrl.HrlEvaluator(
+          option_policies.actions, max_steps_per_episode=100)
+      self._hrl_evaluator_options = option_policies
+    return self._hrl_evaluator_cache
+
   def _get_latest_option_model(self):
     """Returns latest option model from relevant source."""
     if self._path_to_option_model is None:
@@ -471,30 +544,31 @@ class Evaluation:
 
   def _run_evaluation(
       self,
-      option_policy_table, option_model_table, affordances_fn, total_steps=0
+      option_policies, option_model_table, affordances_fn, total_steps=0
       ):
     """Runs evaluation on a single set of tables."""
-    logging.info('Running value iteration.')
+    logging.info('Running %s.', self._solver)
     if self._last_save is None:
       self._last_save = total_steps
 
     affordances_mask = affordances_fn()
 
-    policy_over_options_table, num_iters = option_utils.learn_policy_over_options(
-        option_reward=option_model_table['rewards'],
-        option_transition=option_model_table['transitions'].copy(),
-        option_length=option_model_table['lengths'],
-        stopping_threshold=1e-8,
-        gamma=self._gamma,
-        affordances_fn=affordances_fn,
-        max_iterations=self._max_iterations,
-        seed=self._EVAL_NODE_SEED,
-        writer=self._vi_writer)
-    logging.info('value iteration completed in %d steps', num_iters)
-    def option_policy(state: int, option_id: option_utils.Options) -> int:
-      action_probabilities = option_policy_table[option_id][state]
-      return np.argmax(action_probabilities)
-
+    policy_over_options_table, num_iters, values = (
+        option_utils.learn_policy_over_options(
+            option_reward=option_model_table['rewards'],
+            option_transition=option_model_table['transitions'],
+            option_length=option_model_table['lengths'],
+            stopping_threshold=1e-8,
+            gamma=self._gamma,
+            affordances_fn=affordances_fn,
+            max_iterations=self._max_iterations,
+            seed=self._EVAL_NODE_SEED,
+            writer=self._vi_writer,
+            initial_values=self._values,
+            solver=self._solver))
+    if self._warm_start:
+      self._values = values
+    logging.info('%s completed in %d steps', self._solver, num_iters)
     if not np.all(policy_over_options_table.sum(1) > 0):
       # Note that we do not actually check if this is a stochastic policy matrix
       # since the masking is not guaranteed to result in a probability matrix.
@@ -503,43 +577,35 @@ class Evaluation:
       # only the greedy, then this works equivalently.
       raise ValueError('At least one option should be affordable!')
 
-    def policy_over_options(state: int) -> option_utils.Options:
-      option_int = np.argmax(policy_over_options_table[state])
-      # Options are indexed from 1, the model starts at 0.
-      return option_utils.Options(option_int + 1)
-
-    def option_term_fn(transition: hrl.TransitionWithOption) -> bool:
-      rl_transition = transition.transition
-      env_done = rl_transition.done
-      option_done = option_utils.check_option_termination(
-          rl_transition.s_t,
-          rl_transition.a_t,
-          transition.option_id)
-      return option_done or env_done
-
     # Verification of learned policy.
     all_statistics = {
         'num_iters': num_iters,
         'total_steps': total_steps,
         'affordance_set_size': np.count_nonzero(affordances_mask),
     }
+    if self._oracle_max_option_length is not None:
+      model_errors = option_utils.option_model_errors(
+          option_model_table,
+          self._get_oracle_option_model(option_policies),
+          affordances_mask=affordances_mask)
+      all_statistics.update(
+          {f'oracle_{k}': v for k, v in model_errors.items()})
+    hrl_evaluator = self._get_hrl_evaluator(option_policies)
     for option_length in self._OPTION_LENGTHS_TO_EVAL:
       logging.info('running policy with option length = %s', option_length)
-      _, _, _, rollout_statistics = hrl.run_hrl_policy_in_env(
-          option_policy=option_policy,
-          policy_over_options=policy_over_options,
-          option_term_fn=option_term_fn,
+      rollout_statistics = hrl_evaluator.evaluate(
+          policy_over_options_table=policy_over_options_table,
           max_option_length=option_length,
           num_episodes=self._num_eval_episodes,
+          exact=self._hrl_evaluator == 'exact',
           seed=self._EVAL_NODE_SEED,
-          max_steps_per_episode=100,
           )
       all_statistics.update(
           {f'{k}_{option_length}': v for k, v in rollout_statistics.items()})
     if total_steps - self._last_save > self._save_every:
       logging.info('Saving HRL tables.')
       _save_hrl_tables(
-          total_steps, policy_over_options_table, option_policy_table,
+          total_steps, policy_over_options_table, option_policies.to_dict(),
           self._save_dir, self._affordances_name,
           affordances_table=affordances_mask)
       self._last_save = total_steps
@@ -555,11 +621,11 @@ class Evaluation:
     while True:
       time.sleep(1)
       logging.info('Obtaining the latest tables.')
-      option_policy_table = self._get_latest_options()
+      option_policies = self._get_latest_options()
       option_model_table, total_steps = self._get_latest_option_model()
       logging.info('Running an evaluation')
       all_statistics = self._run_evaluation(
-          option_policy_table, option_model_table, affordances_fn,
+          option_policies, option_model_table, affordances_fn,
           total_steps=total_steps)
       if not all_statistics: continue
       all_statistics['eval_affordances_name'] = self._affordances_name
@@ -579,13 +645,26 @@ class Rollout:
       affordances_name: str,
       queue_writer=None,
       trainer_node=None,
+      use_outcome_table: bool = False,
+      aggregate_batches: bool = False,
+      num_workers: int = 1,
+      node_index: int = 0,
       ):
     self._global_seed = global_seed
+    # Every rollout node and batch gets an independent random stream.
+    self._node_index = node_index
+    self._seed_sequence = seeding.rollout_node_sequence(global_seed, node_index)
     self._max_option_length = max_option_length
     self._batch_size = batch_size
     self._path_to_options = path_to_options
     self._affordances_name = affordances_name
     self._queue_writer = queue_writer
+    self._use_outcome_table = use_outcome_table
+    # Send repeated transitions once, weighted by their count.
+    self._aggregate_batches = aggregate_batches
+    # Batches are collected by a pool of processes when there is more than one
+    # worker.
+    self._num_workers = num_workers
     if affordances_name == 'learned':
       self._trainer_node = trainer_node
     else:
@@ -597,30 +676,40 @@ class Rollout:
   def run(self):
     """Runs the rollout node to collect data."""
     logging.info('Welcome to the rollout node.')
-    option_policy_table = self._get_option_table()
+    option_policies = self._get_option_table()
+    option_outcomes = None
+    if self._use_outcome_table:
+      # Options are looked up instead of executed in the environment.
+      option_outcomes = data_tools.compile_option_outcomes(
+          option_policies, self._max_option_length,
+          seed=self._seed_sequence)
+    # Executing options in the environment takes the tables of every option.
+    option_policy_table = option_policies.to_dict()
 
     affordances_fn = _get_affordances_function(
         self._affordances_name, self._trainer_node)
 
     logging.info('Using affordances %s in rollout node', self._affordances_name)
-    logging.info('Now collecting data.')
+    logging.info('Now collecting data with %s workers.', self._num_workers)
+    collect = functools.partial(
+        data_tools.collect_option_transition_batch,
+        num_trajectories=self._batch_size,
+        max_trajectory_length=self._max_option_length,
+        aggregate=self._aggregate_batches)
+    if self._num_workers > 1:
+      batches = self._collect_in_parallel(
+          collect, affordances_fn, option_policy_table, option_outcomes)
+    else:
+      batches = self._collect(
+          functools.partial(
+              collect, option_policies=option_policy_table,
+              option_outcomes=option_outcomes),
+          affordances_fn)
+
     queue_put_time = 0
-    for i in itertools.count():
-      try:
-        time.sleep(0.5)
-        rollout_seed = self._global_seed + i
-        task_key = str(rollout_seed)
-        running_time = time.time()
-        affordances_mask = affordances_fn()
-        data, total_steps = data_tools.get_trajectories(
-            num_trajectories=self._batch_size,
-            max_trajectory_length=self._max_option_length,
-            option_policies=option_policy_table,
-            affordances_mask=affordances_mask,
-            initial_state=None,
-            uniform_random_initial_state=True,
-            seed=rollout_seed)
-        collection_time = time.time() - running_time
+    try:
+      for rollout_seed, data, total_steps, collection_time in batches:
+        task_key = '_'.join(map(str, rollout_seed))
         logging.info(
             'Collected %s trajectories (total_steps=%s) in %s seconds',
             self._batch_size,
@@ -639,6 +728,61 @@ class Rollout:
         else:
           logging.info('Data was collected but no queue to put it into.')
           break
-      except task_queue.QueueClosedErrors:
-        logging.info('Queue is empty, ending early!')
-        break
+    except task_queue.QueueClosedErrors:
+      logging.info('Queue is empty, ending early!')
+    finally:
+      batches.close()
+
+  def _batch_seed(self, batch_index: int):
+    """Returns the (global seed, node, batch) key and sequence of a batch."""
+    key = (self._global_seed, self._node_index, batch_index)
+    return key, seeding.batch_sequence(self._seed_sequence, batch_index)
+
+  def _collect(self, collect, affordances_fn):
+    """Yields (seed, data, total_steps, collection_time) of every batch."""
+    for i in itertools.count():
+      time.sleep(0.5)
+      rollout_seed, seed_sequence = self._batch_seed(i)
+      running_time = time.time()
+      data, total_steps = collect(
+          affordances_mask=affordances_fn(), seed=seed_sequence)
+      yield rollout_seed, data, total_steps, time.time() - running_time
+
+  def _collect_in_parallel(
+      self, collect, affordances_fn, option_policy_table, option_outcomes):
+    """Same as `_collect` but with a pool of worker processes.
+
+    Every worker is always collecting a batch, so collection continues while
+    batches are put in the queue. Batches are yielded in the order they were
+    started.
+
+    Args:
+      collect: Collects a batch given an affordances mask and a seed.
+      affordances_fn: Returns the latest affordances mask.
+      option_policy_table: The option policies, sent once to every worker.
+      option_outcomes: The option outcome table, sent once to every worker
+        instead of the option policies if given.
+
+    Yields:
+      The seed, data, total steps and collection time of every batch.
+    """
+    if option_outcomes is not None:
+      option_policy_table = None
+    # Workers are spawned rather than forked since this process runs threads.
+    # A spawned worker re-imports the launching module, and with it tensorflow,
+    # so every worker pays that import once when the pool starts.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=self._num_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=data_tools.init_collection_worker,
+        initargs=(option_policy_table, option_outcomes)) as executor:
+      pending = collections.deque()
+      for i in itertools.count():
+        rollout_seed, seed_sequence = self._batch_seed(i)
+        pending.append((rollout_seed, time.time(), executor.submit(
+            collect, affordances_mask=affordances_fn(), seed=seed_sequence)))
+        if len(pending) < self._num_workers:
+          continue
+        rollout_seed, running_time, future = pending.popleft()
+        data, total_steps = future.result()
+        yield rollout_seed, data, total_steps, time.time() - running_time
@@ -0,0 +1,58 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for custom_nodes."""
+
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import custom_nodes
+from affordances_option_models import env_utils
+from affordances_option_models import option_utils
+
+Options = option_utils.Options
+
+
+class EvaluationTest(absltest.TestCase):
+
+  def _random_option_policies(self, seed):
+    rng = np.random.default_rng(seed)
+    return option_utils.pack_option_policies({
+        option: np.eye(env_utils.NUM_ACTIONS)[
+            rng.integers(env_utils.NUM_ACTIONS, size=env_utils.NUM_STATES)]
+        for option in Options})
+
+  def test_oracle_follows_changed_options(self):
+    evaluation = custom_nodes.Evaluation(
+        path_to_options='',
+        affordances_name='everything',
+        gamma=0.99,
+        max_iterations=1,
+        num_eval_episodes=10,
+        oracle_max_option_length=5)
+    affordances_mask = np.ones((env_utils.NUM_STATES, len(Options)))
+    # Evaluate the exact model of each set of options, as if the options were
+    # republished between evaluations.
+    for seed in (0, 1):
+      option_policies = self._random_option_policies(seed)
+      option_model = option_utils.compute_option_model(
+          option_policies, max_option_length=5)
+      statistics = evaluation._run_evaluation(
+          option_policies, option_model, lambda: affordances_mask)
+      self.assertEqual(statistics['oracle_transition_tv_max'], 0.0)
+      self.assertEqual(statistics['oracle_length_mae'], 0.0)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -14,7 +14,7 @@
 # ==============================================================================
 
 """Generate data from taxienv."""
-from typing import Dict, List, NamedTuple, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from absl import logging
 import numpy as np
@@ -23,6 +23,9 @@ from affordances_option_models import env_utils
 from affordances_option_models import intent_utils
 from affordances_option_models import option_utils
 from affordances_option_models import rl
+from affordances_option_models import seeding
+
+_NEXT_STATES, _REWARDS, _DONES = env_utils.get_transition_tables()
 
 
 class IntentCompletionIndicator(NamedTuple):
@@ -40,6 +43,98 @@ class OptionTransition(NamedTuple):
   intents_completed: IntentCompletionIndicator
 
 
+class OptionTransitionBatch(NamedTuple):
+  """Columnar storage for a batch of `OptionTransition`s.
+
+  Every field holds the corresponding field of all transitions in the batch, so
+  a batch is cheap to serialize and can be handed to tensorflow directly.
+  """
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  initial_state: np.ndarray  # int32 of shape [B].
+  option_id: np.ndarray  # int32 of shape [B].
+  option_length: np.ndarray  # int32 of shape [B].
+  option_reward: np.ndarray  # float32 of shape [B].
+  final_state: np.ndarray  # int32 of shape [B].
+  intents_completed: np.ndarray  # int8 of shape [B, |I|].
+  # float32 of shape [B] with the number of times every transition occurred, see
+  # `aggregate_option_transitions`. None if every transition occurred once.
+  weights: Optional[np.ndarray] = None
+
+  @property
+  def num_transitions(self) -> int:
+    if self.weights is None:
+      return self.initial_state.shape[0]
+    return int(round(float(self.weights.sum())))
+
+
+def stack_option_transitions(
+    transitions: Sequence[OptionTransition]) -> OptionTransitionBatch:
+  """Converts a list of transitions into a columnar batch."""
+  return OptionTransitionBatch(
+      initial_state=np.array(
+          [t.initial_state for t in transitions], dtype=np.int32),
+      option_id=np.array([t.option_id for t in transitions], dtype=np.int32),
+      option_length=np.array(
+          [t.option_length for t in transitions], dtype=np.int32),
+      option_reward=np.array(
+          [t.option_reward for t in transitions], dtype=np.float32),
+      final_state=np.array(
+          [t.final_state for t in transitions], dtype=np.int32),
+      intents_completed=np.array(
+          [t.intents_completed.indicators for t in transitions],
+          dtype=np.int8).reshape(len(transitions), len(intent_utils.Intents)),
+  )
+
+
+def aggregate_option_transitions(
+    batch: OptionTransitionBatch) -> OptionTransitionBatch:
+  """Merges repeated transitions of a batch into weighted unique transitions.
+
+  With few states and options most transitions of a batch are repeated. A loss
+  that weighs every unique transition by its count is the same as the loss over
+  the original batch.
+
+  Args:
+    batch: The batch to aggregate. Its weights are summed if it has any.
+
+  Returns:
+    A batch of the unique transitions with their counts as weights.
+  """
+  # Rewards are compared by their bits so that all fields are integers.
+  keys = np.column_stack([
+      batch.initial_state, batch.option_id, batch.option_length,
+      batch.option_reward.view(np.int32), batch.final_state,
+      batch.intents_completed])
+  _, first_index, inverse = np.unique(
+      keys, axis=0, return_index=True, return_inverse=True)
+  weights = np.ones(batch.num_transitions) if batch.weights is None else (
+      batch.weights)
+  weights = np.bincount(
+      inverse.ravel(), weights=weights, minlength=len(first_index))
+  return OptionTransitionBatch(
+      *(field[first_index] for field in batch[:-1]),
+      weights=weights.astype(np.float32))
+
+
+def unstack_option_transitions(
+    batch: OptionTransitionBatch) -> List[OptionTransition]:
+  """Converts a columnar batch back into a list of transitions.
+
+  Weights are dropped, so aggregated transitions appear only once.
+  """
+  return [
+      OptionTransition(
+          initial_state,
+          option_id,
+          option_length,
+          option_reward,
+          final_state,
+          IntentCompletionIndicator(
+              tuple(map(intent_utils.IntentStatus, intents))),
+      ) for initial_state, option_id, option_length, option_reward, final_state,
+      intents in zip(*(field.tolist() for field in batch[:-1]))]
+
+
 def get_trajectories(
     option_policies: Dict[option_utils.Options, np.ndarray],
     num_trajectories: int = 1,
@@ -47,7 +142,7 @@ def get_trajectories(
     affordances_mask: Optional[np.ndarray] = None,
     uniform_random_initial_state: bool = False,
     initial_state: Optional[int] = None,
-    seed: Optional[int] = None) -> Tuple[List[OptionTransition], int]:
+    seed: seeding.Seed = None) -> Tuple[List[OptionTransition], int]:
   """Samples trajectory transitions by executing options in an environment.
 
   Options are sampled uniformly from the `option_policies` table. They are then
@@ -65,7 +160,8 @@ def get_trajectories(
       the environment (we do not use the internal initial state distribution,
       via reset() to sample starting states).
     initial_state: Initial state for the rollouts.
-    seed: seed for randomness
+    seed: seed for randomness. When this is a `np.random.SeedSequence`, every
+      trajectory gets an independent child sequence, see `seeding`.
   Returns:
     1. Trajectories collected from the environment when executing an option from
        a state. They are stored as `OptionTransition` which contains metadata
@@ -73,15 +169,11 @@ def get_trajectories(
     2. An integer representing the total steps taken in the environment.
   """
   rng = np.random.default_rng(seed)
-  def rargmax(arr):
-    """Random argmax with stochastic tie-breaking."""
-    arr = np.isclose(arr, arr.max(-1, keepdims=True))
-    return rng.choice(np.flatnonzero(arr))
   max_trajectory_length = max_trajectory_length or float('inf')
   data = []
   total_steps = []
 
-  for i in range(num_trajectories):
+  for trajectory_seed in seeding.trajectory_seeds(seed, num_trajectories):
     if uniform_random_initial_state:
       initial_state = rng.integers(0, env_utils.NUM_STATES)
       logging.debug('Initial state set to %s', initial_state)
@@ -104,7 +196,7 @@ def get_trajectories(
     def option_policy(x):
       """Executes the relevant low level option policy."""
       q_values = option_policies[option_id][x]  # pylint: disable=cell-var-from-loop
-      return rargmax(q_values)
+      return rl.random_argmax(q_values, rng)
 
     def termination_fn(transition: rl.Transition):
       """Determines if any given transition terminates the option."""
@@ -118,7 +210,7 @@ def get_trajectories(
         initial_state=initial_state,
         max_steps_per_episode=max_trajectory_length,
         termination_fn=termination_fn,
-        seed=seed + i if seed is not None else None,
+        seed=trajectory_seed,
         )
 
     assert len(trajectories) == 1
@@ -129,14 +221,9 @@ def get_trajectories(
     final_transition = trajectory[-1]
 
     # Collect indications for every intent whether it was completed.
-    all_intents = []
-    for intent_id in intent_utils.Intents:
-      intent_completed = intent_utils.is_intent_completed(
-          first_transition.s_t,
-          option_id,
-          final_transition.s_tp1,
-          intent_id=intent_id)
-      all_intents.append(intent_completed)
+    all_intents = map(
+        intent_utils.IntentStatus,
+        intent_utils.intents_completed(final_transition.s_tp1).tolist())
 
     # Since we get -1 reward per step, this sum doesn't need to be discounted.
     option_reward = sum(rewards)
@@ -156,3 +243,253 @@ def get_trajectories(
         ))
 
   return data, sum(total_steps)
+
+
+class OptionOutcomes(NamedTuple):
+  """Precomputed outcomes of executing every option from every state.
+
+  Entry [s, o, k] is the k-th sampled execution of option `o` (indexed from 0)
+  from state `s`. Executions only differ when an option policy has ties, so
+  there is a single sample when there are none.
+  """
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  final_states: np.ndarray  # |S| x |O| x K.
+  lengths: np.ndarray  # |S| x |O| x K.
+  rewards: np.ndarray  # |S| x |O| x K.
+  intents_completed: np.ndarray  # |S| x |O| x K x |I|.
+  max_option_length: int
+
+
+def compile_option_outcomes(
+    option_policies: Union[
+        Dict[option_utils.Options, np.ndarray],
+        option_utils.PackedOptionPolicies],
+    max_option_length: int,
+    num_samples: int = 16,
+    seed: seeding.Seed = None) -> OptionOutcomes:
+  """Executes every option from every state once to build a lookup table.
+
+  The taxi environment is deterministic, so the outcome of an option only
+  depends on how ties in its policy are broken. All (state, option) pairs are
+  executed together, one environment step at a time, with the same termination
+  rules as `get_trajectories`.
+
+  Args:
+    option_policies: A dictionary mapping option_id to a numpy table
+      representing the optimal low level policy that maximizes that option, or
+      the packed option policies.
+    max_option_length: The maximum length of an option execution.
+    num_samples: The number of executions per (state, option) pair to sample
+      when an option policy has ties. Ignored when there are no ties.
+    seed: seed for the tie-breaking.
+
+  Returns:
+    The `OptionOutcomes` of every (state, option) pair.
+  """
+  if not max_option_length or max_option_length < 1:
+    raise ValueError(
+        f'max_option_length must be positive, got {max_option_length}.')
+  rng = np.random.default_rng(seed)
+  option_policies = option_utils.as_packed_option_policies(option_policies)
+  if option_policies.ties is None:
+    num_samples = 1
+  else:
+    ties = option_policies.ties.astype(np.float64)
+  num_options = option_policies.actions.shape[1]
+  shape = (env_utils.NUM_STATES, num_options, num_samples)
+  initial_states, options, _ = np.indices(shape).reshape(3, -1)
+
+  states = initial_states.copy()
+  lengths = np.zeros(states.shape, dtype=np.int64)
+  rewards = np.zeros(states.shape)
+  active = np.arange(states.size)
+  for _ in range(max_option_length):
+    active_states, active_options = states[active], options[active]
+    if option_policies.ties is None:
+      actions = option_policies.actions[active_states, active_options]
+    else:
+      actions = rl.random_argmax(ties[active_states, active_options], rng)
+    terminated = _DONES[active_states, actions] | (
+        option_utils.OPTION_TERMINATION_TABLE[
+            active_states, actions, active_options])
+    states[active] = _NEXT_STATES[active_states, actions]
+    rewards[active] += _REWARDS[active_states, actions]
+    lengths[active] += 1
+    active = active[~terminated]
+    if not active.size:
+      break
+
+  logging.info(
+      'Compiled outcomes of %s options with %s samples each.', num_options,
+      num_samples)
+  return OptionOutcomes(
+      final_states=states.reshape(shape),
+      lengths=lengths.reshape(shape),
+      rewards=rewards.reshape(shape),
+      intents_completed=intent_utils.intents_completed(states.reshape(shape)),
+      max_option_length=max_option_length)
+
+
+def sample_option_transition_batch(
+    option_outcomes: OptionOutcomes,
+    num_trajectories: int = 1,
+    affordances_mask: Optional[np.ndarray] = None,
+    uniform_random_initial_state: bool = False,
+    initial_state: Optional[int] = None,
+    seed: seeding.Seed = None) -> Tuple[OptionTransitionBatch, int]:
+  """Samples a batch of option transitions from precomputed option outcomes.
+
+  This samples initial states and options like `get_trajectories` but looks up
+  their outcome in a table from `compile_option_outcomes` instead of executing
+  the option in the environment. Draws from the random number generator differ,
+  so the two functions give different samples for the same seed.
+
+  Args:
+    option_outcomes: The outcomes of every (state, option) pair.
+    num_trajectories: The total number of trajectories to sample.
+    affordances_mask: Mask for sampling over the affordances.
+    uniform_random_initial_state: Each episode can start uniformly randomly in
+      the environment.
+    initial_state: Initial state for the rollouts.
+    seed: seed for randomness
+
+  Returns:
+    1. The sampled transitions as an `OptionTransitionBatch`.
+    2. An integer representing the total steps taken in the environment.
+  """
+  rng = np.random.default_rng(seed)
+  if uniform_random_initial_state:
+    initial_states = rng.integers(
+        0, env_utils.NUM_STATES, size=num_trajectories)
+  elif initial_state is None:
+    raise ValueError(
+        'Initial state cannot be None if uniform_random_initial_state=False')
+  else:
+    initial_states = np.full(num_trajectories, initial_state)
+
+  # Pick an option according to the relevant distribution.
+  if affordances_mask is None:
+    # Same as `get_trajectories`, which never selects the first option.
+    option_ids = rng.integers(1, len(option_utils.Options),
+                              size=num_trajectories)
+  else:
+    affordable = affordances_mask[initial_states] > 0
+    num_affordable = affordable.sum(-1)
+    if not np.all(num_affordable):
+      # `get_trajectories` fails in `rng.choice` for these states.
+      raise ValueError(
+          'No option is affordable in initial states '
+          f'{np.unique(initial_states[num_affordable == 0]).tolist()}.')
+    choices = np.floor(
+        rng.random(num_trajectories) * num_affordable).astype(np.int64)
+    option_ids = np.argmax(
+        np.cumsum(affordable, -1) > choices[:, None], axis=-1)
+  samples = rng.integers(
+      0, option_outcomes.final_states.shape[-1], size=num_trajectories)
+
+  index = (initial_states, option_ids, samples)
+  batch = OptionTransitionBatch(
+      initial_state=initial_states.astype(np.int32),
+      option_id=option_ids.astype(np.int32),
+      option_length=option_outcomes.lengths[index].astype(np.int32),
+      option_reward=option_outcomes.rewards[index].astype(np.float32),
+      final_state=option_outcomes.final_states[index].astype(np.int32),
+      intents_completed=option_outcomes.intents_completed[index].astype(
+          np.int8),
+  )
+  return batch, int(option_outcomes.lengths[index].sum())
+
+
+def get_trajectories_from_outcomes(
+    option_outcomes: OptionOutcomes,
+    num_trajectories: int = 1,
+    affordances_mask: Optional[np.ndarray] = None,
+    uniform_random_initial_state: bool = False,
+    initial_state: Optional[int] = None,
+    seed: seeding.Seed = None) -> Tuple[List[OptionTransition], int]:
+  """Same as `sample_option_transition_batch` but returns a list.
+
+  Returns:
+    1. Trajectories as a list of `OptionTransition`.
+    2. An integer representing the total steps taken in the environment.
+  """
+  batch, total_steps = sample_option_transition_batch(
+      option_outcomes,
+      num_trajectories=num_trajectories,
+      affordances_mask=affordances_mask,
+      uniform_random_initial_state=uniform_random_initial_state,
+      initial_state=initial_state,
+      seed=seed)
+  return unstack_option_transitions(batch), total_steps
+
+
+# Tables of a data collection worker process, see `init_collection_worker`.
+_WORKER_TABLES = {}
+
+
+def init_collection_worker(
+    option_policies: Optional[Dict[option_utils.Options, np.ndarray]] = None,
+    option_outcomes: Optional[OptionOutcomes] = None):
+  """Stores the tables of a worker process so they are only sent to it once.
+
+  Pass this as the initializer of a process pool that runs
+  `collect_option_transition_batch`.
+
+  Args:
+    option_policies: The option policies to execute.
+    option_outcomes: If given, outcomes are looked up in this table instead.
+  """
+  _WORKER_TABLES['option_policies'] = option_policies
+  _WORKER_TABLES['option_outcomes'] = option_outcomes
+
+
+def collect_option_transition_batch(
+    num_trajectories: int,
+    max_trajectory_length: int,
+    affordances_mask: Optional[np.ndarray] = None,
+    seed: seeding.Seed = None,
+    aggregate: bool = False,
+    option_policies: Optional[Dict[option_utils.Options, np.ndarray]] = None,
+    option_outcomes: Optional[OptionOutcomes] = None,
+    ) -> Tuple[OptionTransitionBatch, int]:
+  """Collects a batch of option transitions from uniformly random states.
+
+  Args:
+    num_trajectories: The total number of trajectories to sample.
+    max_trajectory_length: The maximum length of the trajectory.
+    affordances_mask: Mask for sampling over the affordances.
+    seed: seed for randomness
+    aggregate: Merge repeated transitions, see `aggregate_option_transitions`.
+    option_policies: The option policies to execute with `get_trajectories`.
+    option_outcomes: If given, the transitions are sampled with
+      `sample_option_transition_batch` instead. When neither tables are given,
+      those of `init_collection_worker` are used.
+
+  Returns:
+    1. The collected `OptionTransitionBatch`.
+    2. An integer representing the total steps taken in the environment.
+  """
+  if option_policies is None and option_outcomes is None:
+    option_policies = _WORKER_TABLES.get('option_policies')
+    option_outcomes = _WORKER_TABLES.get('option_outcomes')
+  if option_outcomes is not None:
+    batch, total_steps = sample_option_transition_batch(
+        option_outcomes,
+        num_trajectories=num_trajectories,
+        affordances_mask=affordances_mask,
+        uniform_random_initial_state=True,
+        seed=seed)
+  elif option_policies is not None:
+    trajectories, total_steps = get_trajectories(
+        option_policies,
+        num_trajectories=num_trajectories,
+        max_trajectory_length=max_trajectory_length,
+        affordances_mask=affordances_mask,
+        uniform_random_initial_state=True,
+        seed=seed)
+    batch = stack_option_transitions(trajectories)
+  else:
+    raise ValueError('No option policies or outcomes to collect data with.')
+  if aggregate:
+    batch = aggregate_option_transitions(batch)
+  return batch, total_steps
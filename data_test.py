@@ -0,0 +1,189 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for data."""
+import concurrent.futures
+import functools
+import multiprocessing
+
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import data
+from affordances_option_models import env_utils
+from affordances_option_models import option_utils
+
+
+class DataTest(absltest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls._option_policies, _ = option_utils.learn_option_policies(
+        max_iterations=1000, stopping_threshold=1e-5, seed=1)
+
+  def test_option_outcomes_match_rollouts(self):
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=10)
+    self.assertEqual(outcomes.final_states.shape,
+                     (env_utils.NUM_STATES, len(option_utils.Options), 1))
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+      state = rng.integers(env_utils.NUM_STATES)
+      option_id = rng.integers(len(option_utils.Options))
+      affordances_mask = np.zeros(
+          (env_utils.NUM_STATES, len(option_utils.Options)))
+      affordances_mask[:, option_id] = 1
+      (transition,), total_steps = data.get_trajectories(
+          self._option_policies, max_trajectory_length=10,
+          affordances_mask=affordances_mask, initial_state=state, seed=1)
+      (expected,), expected_steps = data.get_trajectories_from_outcomes(
+          outcomes, affordances_mask=affordances_mask, initial_state=state,
+          seed=1)
+      self.assertEqual(transition, expected)
+      self.assertEqual(total_steps, expected_steps)
+
+  def test_trajectories_from_outcomes_sampling(self):
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=100)
+    transitions, total_steps = data.get_trajectories_from_outcomes(
+        outcomes, num_trajectories=1000, uniform_random_initial_state=True,
+        seed=0)
+    self.assertLen(transitions, 1000)
+    self.assertEqual(total_steps, sum(t.option_length for t in transitions))
+    self.assertNotIn(0, {t.option_id for t in transitions})
+    self.assertEqual(
+        transitions,
+        data.get_trajectories_from_outcomes(
+            outcomes, num_trajectories=1000, uniform_random_initial_state=True,
+            seed=0)[0])
+
+    affordances_mask = np.zeros(
+        (env_utils.NUM_STATES, len(option_utils.Options)))
+    affordances_mask[::2, :3] = 1
+    affordances_mask[1::2, 7] = 1
+    transitions, _ = data.get_trajectories_from_outcomes(
+        outcomes, num_trajectories=1000, affordances_mask=affordances_mask,
+        uniform_random_initial_state=True, seed=0)
+    for transition in transitions:
+      self.assertEqual(
+          affordances_mask[transition.initial_state, transition.option_id], 1)
+    self.assertEqual({t.option_id for t in transitions}, {0, 1, 2, 7})
+
+  def test_option_transition_batch(self):
+    transitions, _ = data.get_trajectories(
+        self._option_policies, num_trajectories=20,
+        uniform_random_initial_state=True, seed=0)
+    batch = data.stack_option_transitions(transitions)
+    self.assertEqual(batch.num_transitions, 20)
+    self.assertEqual(batch.intents_completed.shape, (20, 8))
+    self.assertEqual(batch.intents_completed.dtype, np.int8)
+    self.assertEqual(data.unstack_option_transitions(batch), transitions)
+    self.assertEqual(data.stack_option_transitions([]).num_transitions, 0)
+
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=100)
+    batch, total_steps = data.sample_option_transition_batch(
+        outcomes, num_trajectories=20, uniform_random_initial_state=True,
+        seed=0)
+    transitions, expected_steps = data.get_trajectories_from_outcomes(
+        outcomes, num_trajectories=20, uniform_random_initial_state=True,
+        seed=0)
+    self.assertEqual(total_steps, expected_steps)
+    for field, expected_field in zip(
+        batch[:-1], data.stack_option_transitions(transitions)[:-1]):
+      np.testing.assert_array_equal(field, expected_field)
+      self.assertEqual(field.dtype, expected_field.dtype)
+    self.assertIsNone(batch.weights)
+
+  def test_aggregate_option_transitions(self):
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=100)
+    affordances_mask = np.zeros(
+        (env_utils.NUM_STATES, len(option_utils.Options)))
+    affordances_mask[:, :2] = 1
+    batch, _ = data.sample_option_transition_batch(
+        outcomes, num_trajectories=1000, affordances_mask=affordances_mask,
+        initial_state=3, seed=0)
+    aggregated = data.aggregate_option_transitions(batch)
+    self.assertEqual(aggregated.num_transitions, 1000)
+    self.assertLen(aggregated.weights, 2)
+    self.assertEqual(
+        set(data.unstack_option_transitions(aggregated)),
+        set(data.unstack_option_transitions(batch)))
+    np.testing.assert_allclose(
+        np.sum(aggregated.weights * aggregated.option_reward),
+        np.sum(batch.option_reward))
+    reaggregated = data.aggregate_option_transitions(aggregated._replace(
+        weights=aggregated.weights * 2))
+    np.testing.assert_array_equal(reaggregated.weights, aggregated.weights * 2)
+
+  def test_sample_option_transition_batch_without_affordable_options(self):
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=100)
+    affordances_mask = np.ones(
+        (env_utils.NUM_STATES, len(option_utils.Options)))
+    affordances_mask[3] = 0
+    for sample in (data.sample_option_transition_batch,
+                   data.get_trajectories_from_outcomes):
+      with self.assertRaises(ValueError):
+        sample(outcomes, num_trajectories=10,
+               affordances_mask=affordances_mask, initial_state=3, seed=0)
+
+  def test_collect_option_transition_batch(self):
+    outcomes = data.compile_option_outcomes(
+        self._option_policies, max_option_length=100)
+    collect = functools.partial(
+        data.collect_option_transition_batch, num_trajectories=50,
+        max_trajectory_length=100)
+    batch, total_steps = collect(
+        seed=0, option_policies=self._option_policies)
+    transitions, expected_steps = data.get_trajectories(
+        self._option_policies, num_trajectories=50, max_trajectory_length=100,
+        uniform_random_initial_state=True, seed=0)
+    self.assertEqual(total_steps, expected_steps)
+    self.assertEqual(data.unstack_option_transitions(batch), transitions)
+    batch, _ = collect(seed=0, option_outcomes=outcomes, aggregate=True)
+    self.assertEqual(batch.num_transitions, 50)
+    self.assertIsNotNone(batch.weights)
+
+    # Workers only receive their tables once.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context('spawn'),
+        initializer=data.init_collection_worker,
+        initargs=(None, outcomes)) as executor:
+      futures = [executor.submit(collect, seed=seed) for seed in range(4)]
+      for seed, future in enumerate(futures):
+        batch, total_steps = future.result()
+        expected_batch, expected_steps = collect(
+            seed=seed, option_outcomes=outcomes)
+        self.assertEqual(total_steps, expected_steps)
+        self.assertEqual(data.unstack_option_transitions(batch),
+                         data.unstack_option_transitions(expected_batch))
+
+  def test_option_outcomes_sample_ties(self):
+    uniform_policies = {
+        option: np.ones((env_utils.NUM_STATES, env_utils.NUM_ACTIONS))
+        for option in option_utils.Options}
+    outcomes = data.compile_option_outcomes(
+        uniform_policies, max_option_length=5, num_samples=8, seed=0)
+    self.assertEqual(outcomes.final_states.shape,
+                     (env_utils.NUM_STATES, len(option_utils.Options), 8))
+    self.assertTrue(np.all(outcomes.lengths >= 1))
+    self.assertTrue(np.all(outcomes.lengths <= 5))
+    self.assertGreater(len(np.unique(outcomes.final_states[0, 0])), 1)
+
+
+if __name__ == '__main__':
+  absltest.main()
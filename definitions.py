@@ -16,6 +16,7 @@
 """Definitions for constants, options, intents related to the taxienv."""
 
 import enum
+from typing import NamedTuple, Tuple
 
 
 @enum.unique
@@ -78,7 +79,8 @@ class IntentStatus(enum.IntEnum):
   incomplete = 0
 
 
-_NUM_GRID_CELLS = 25
+_GRID_SIZE = 5
+_NUM_GRID_CELLS = _GRID_SIZE * _GRID_SIZE
 
 
 # Unfortunately, we have to define each option explicitly to avoid the
@@ -187,3 +189,37 @@ OptionsPicking = tuple(member for member in Options.__members__.values()
                        if 'Pickup' in member.name)
 OptionsAny = tuple(
     member for member in Options.__members__.values() if 'Any' in member.name)
+
+
+@enum.unique
+class OptionKind(enum.Enum):
+  """The three sets of options, see `Options`."""
+  DROP = enum.auto()
+  PICKUP = enum.auto()
+  ANY = enum.auto()
+
+
+class OptionInfo(NamedTuple):
+  """Metadata about an option parsed from its name."""
+  kind: OptionKind
+  # The grid cell (0-24) the option travels to.
+  grid_cell: int
+  # The (row, col) position of the grid cell.
+  target_xy: Tuple[int, int]
+
+
+def _parse_option(option: Options) -> OptionInfo:
+  """Parses the metadata from names like "GoToXX_??"."""
+  grid_cell, kind_name = option.name.replace('GoTo', '').split('_')
+  grid_cell = int(grid_cell)
+  if not 0 <= grid_cell < _NUM_GRID_CELLS:
+    raise ValueError(f'Option {option} goes to an unknown grid cell.')
+  kind = {'Drop': OptionKind.DROP,
+          'Pickup': OptionKind.PICKUP,
+          'Any': OptionKind.ANY}[kind_name]
+  return OptionInfo(kind, grid_cell, divmod(grid_cell, _GRID_SIZE))
+
+
+# Maps every option to its metadata so that names never need to be parsed
+# again.
+OPTION_INFO = {option: _parse_option(option) for option in Options}
@@ -25,11 +25,12 @@ controls the taxi and gets +20 for dropping the passenger to the correct goal.
 The agent gets -10 if it drops the passenger to the wrong goal. The agent gets
 -1 for each step of the episode.
 """
-from typing import Any, NamedTuple, Tuple
+from typing import Any, NamedTuple, Optional, Sequence, Tuple
 import gym
 import numpy as np
 
 from affordances_option_models import definitions
+from affordances_option_models import seeding
 
 Colors = definitions.Colors
 PASSENGER_INSIDE_CAR_STATUS = 4
@@ -69,17 +70,56 @@ NUM_STATES = _GLOBAL_ENV.nS
 NUM_ACTIONS = _GLOBAL_ENV.nA
 
 
+_GRID_SIZE = 5
+_NUM_PASSENGER_STATUSES = PASSENGER_INSIDE_CAR_STATUS + 1
+_NUM_DESTINATIONS = 4
+
+
+def encode_states(
+    row: np.ndarray,
+    col: np.ndarray,
+    passenger_status: np.ndarray,
+    destination: np.ndarray) -> np.ndarray:
+  """Vectorized version of `state_to_int_fn` that does not validate inputs."""
+  row, col, passenger_status, destination = map(
+      np.asarray, (row, col, passenger_status, destination))
+  return (((row * _GRID_SIZE + col) * _NUM_PASSENGER_STATUSES
+           + passenger_status) * _NUM_DESTINATIONS + destination)
+
+
+def decode_states(
+    states: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  """Vectorized version of `int_to_state_fn`.
+
+  Args:
+    states: Array of integer states.
+
+  Returns:
+    Arrays of the same shape as `states` containing the row, column, passenger
+    status and destination of every state.
+  """
+  states = np.asarray(states)
+  destination = states % _NUM_DESTINATIONS
+  states = states // _NUM_DESTINATIONS
+  passenger_status = states % _NUM_PASSENGER_STATUSES
+  states = states // _NUM_PASSENGER_STATUSES
+  col = states % _GRID_SIZE
+  row = states // _GRID_SIZE
+  return row, col, passenger_status, destination
+
+
 def state_to_int_fn(taxi_state: TaxiState) -> int:
   """Converts a readable state in the environment to the integer state."""
   taxi_state.validate()
-  return _GLOBAL_ENV.encode(*taxi_state)
+  return int(encode_states(*taxi_state))
 
 
 def int_to_state_fn(x: int) -> TaxiState:
   """Converts an integer representation of state into a human readable one."""
-  state = TaxiState(*_GLOBAL_ENV.decode(x))
-  state.validate()
-  return state
+  if not 0 <= x < NUM_STATES:
+    raise ValueError(f'State {x} is not between (0, {NUM_STATES - 1})')
+  return _TAXI_STATES[x]
 
 # Maps human readable color from the visualization into one of 4 goal states.
 COLOR_TO_LOCATION_MAPPING = {
@@ -92,6 +132,29 @@ COLOR_TO_LOCATION_MAPPING = {
 # Maps the 4 goal states to a human readable color.
 LOCATION_TO_COLOR_MAPPING = {v: k for k, v in COLOR_TO_LOCATION_MAPPING.items()}
 
+# Precomputed features of every state, indexed by the integer state. Use these
+# instead of decoding states on hot paths.
+STATE_ROW, STATE_COL, STATE_PASSENGER_STATUS, STATE_DESTINATION = (
+    decode_states(np.arange(NUM_STATES)))
+# The grid cell (0-24) the taxi is in. See `grid_cell_to_xy`.
+STATE_GRID_CELL = STATE_ROW * _GRID_SIZE + STATE_COL
+# The value of the color the taxi is at or -1 if it is not at any color.
+STATE_COLOR_REACHED = np.full(NUM_STATES, -1)
+for (_row, _col), _color in LOCATION_TO_COLOR_MAPPING.items():
+  STATE_COLOR_REACHED[(STATE_ROW == _row) & (STATE_COL == _col)] = _color.value
+# The destination never changes within an episode, so the states with the same
+# destination form independent blocks of the MDP.
+DESTINATION_BLOCKS = tuple(
+    np.flatnonzero(STATE_DESTINATION == destination)
+    for destination in range(_NUM_DESTINATIONS))
+for _table in (STATE_ROW, STATE_COL, STATE_PASSENGER_STATUS, STATE_DESTINATION,
+               STATE_GRID_CELL, STATE_COLOR_REACHED) + DESTINATION_BLOCKS:
+  _table.flags.writeable = False
+
+_TAXI_STATES = tuple(
+    TaxiState(*map(int, features)) for features in zip(
+        STATE_ROW, STATE_COL, STATE_PASSENGER_STATUS, STATE_DESTINATION))
+
 
 def grid_cell_to_xy(pos: int, grid_size: int = 5) -> Tuple[int, int]:
   """Converts an integer from 0-24 into an (x, y) position."""
@@ -134,3 +197,107 @@ def get_transition_and_reward_matrices() -> Tuple[Any, np.ndarray, np.ndarray]:
       P_matrix[s, a, sprime] = prob
       R_matrix[s, a] = reward
   return P, P_matrix, R_matrix
+
+
+def get_transition_tables() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Obtains the deterministic transition tables for taxi as numpy arrays.
+
+  Taxi is deterministic, so every (s, a) pair has exactly one successor. These
+  tables hold the same information as `get_transition_and_reward_matrices` but
+  can be indexed directly instead of searched.
+
+  Returns:
+    next_states: A |S| x |A| integer matrix where next_states[s, a] is the state
+      reached by taking action a from state s.
+    rewards: A |S| x |A| matrix where rewards[s, a] is the reward obtained by
+      taking action a from state s.
+    dones: A |S| x |A| boolean matrix where dones[s, a] indicates if the episode
+      terminates by taking action a from state s.
+  """
+  num_states = _GLOBAL_ENV.nS
+  num_actions = _GLOBAL_ENV.nA
+  next_states = np.zeros((num_states, num_actions), dtype=np.int64)
+  rewards = np.zeros((num_states, num_actions))
+  dones = np.zeros((num_states, num_actions), dtype=bool)
+  for (s, transition) in _GLOBAL_ENV.P.items():
+    for a in range(num_actions):
+      if len(transition[a]) != 1 or transition[a][0][0] != 1.0:
+        raise ValueError(f'Transition from ({s}, {a}) is not deterministic.')
+      _, next_states[s, a], rewards[s, a], dones[s, a] = transition[a][0]
+  return next_states, rewards, dones
+
+
+_NEXT_STATES, _REWARDS, _DONES = get_transition_tables()
+# The distribution of states returned by `reset()` in the gym environment.
+INITIAL_STATE_DISTRIBUTION = np.array(_GLOBAL_ENV.isd, dtype=np.float64)
+
+
+class BatchedTaxiEnvironment:
+  """A vectorized version of the taxi environment.
+
+  Steps `num_envs` copies of the environment at once using array indexing into
+  the deterministic transition tables. Unlike the gym environment, the state of
+  every copy can be reset to an arbitrary state.
+  """
+
+  def __init__(self, num_envs: int = 1, seed: seeding.Seed = None):
+    if num_envs < 1:
+      raise ValueError(f'Need at least one environment, got {num_envs}.')
+    self._num_envs = num_envs
+    self._rng = np.random.default_rng(seed)
+    self._states = np.zeros(num_envs, dtype=np.int64)
+
+  @property
+  def num_envs(self) -> int:
+    return self._num_envs
+
+  @property
+  def states(self) -> np.ndarray:
+    return self._states.copy()
+
+  def seed(self, seed: seeding.Seed = None):
+    self._rng = np.random.default_rng(seed)
+
+  def reset(
+      self, initial_states: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Resets all environments.
+
+    Args:
+      initial_states: Optional states of shape (num_envs,) (or a scalar) to put
+        the environments in. If not given, states are sampled from the initial
+        state distribution of the gym environment.
+
+    Returns:
+      The states of the environments.
+    """
+    if initial_states is None:
+      self._states = self._rng.choice(
+          NUM_STATES, size=self._num_envs, p=INITIAL_STATE_DISTRIBUTION)
+    else:
+      initial_states = np.broadcast_to(
+          np.asarray(initial_states, dtype=np.int64), (self._num_envs,))
+      if np.any((initial_states < 0) | (initial_states >= NUM_STATES)):
+        raise ValueError(f'Initial states must be in [0, {NUM_STATES}).')
+      self._states = initial_states.copy()
+    return self._states.copy()
+
+  def step(
+      self, actions: Sequence[int]
+      ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Takes one step in every environment.
+
+    Args:
+      actions: Array of shape (num_envs,) with the action for every environment.
+
+    Returns:
+      The next states, rewards and done flags, each of shape (num_envs,).
+    """
+    actions = np.asarray(actions)
+    if actions.shape != (self._num_envs,):
+      raise ValueError(
+          f'Expected actions of shape {(self._num_envs,)}, got {actions.shape}')
+    states = self._states
+    rewards = _REWARDS[states, actions]
+    dones = _DONES[states, actions]
+    self._states = _NEXT_STATES[states, actions]
+    return self._states.copy(), rewards, dones
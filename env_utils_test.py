@@ -0,0 +1,76 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for env_utils."""
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import env_utils
+
+
+class EnvUtilsTest(absltest.TestCase):
+
+  def test_transition_tables_match_matrices(self):
+    _, P_matrix, R_matrix = env_utils.get_transition_and_reward_matrices()  # pylint: disable=invalid-name
+    next_states, rewards, dones = env_utils.get_transition_tables()
+    np.testing.assert_array_equal(next_states, P_matrix.argmax(-1))
+    np.testing.assert_array_equal(rewards, R_matrix)
+    np.testing.assert_array_equal(dones, rewards == 20)
+
+  def test_state_tables_match_gym(self):
+    gym_env = env_utils.make_taxi_environment()
+    all_states = np.arange(env_utils.NUM_STATES)
+    decoded = np.array([list(gym_env.decode(s)) for s in all_states])
+    np.testing.assert_array_equal(
+        np.stack(env_utils.decode_states(all_states), -1), decoded)
+    np.testing.assert_array_equal(env_utils.encode_states(*decoded.T),
+                                  all_states)
+    np.testing.assert_array_equal(
+        env_utils.STATE_GRID_CELL, decoded[:, 0] * 5 + decoded[:, 1])
+    for state, (row, col, passenger_status, destination) in enumerate(decoded):
+      taxi_state = env_utils.int_to_state_fn(state)
+      self.assertEqual(
+          taxi_state, (row, col, passenger_status, destination))
+      self.assertEqual(env_utils.state_to_int_fn(taxi_state), state)
+      color = env_utils.LOCATION_TO_COLOR_MAPPING.get((row, col))
+      self.assertEqual(env_utils.STATE_COLOR_REACHED[state],
+                       -1 if color is None else color.value)
+
+  def test_batched_environment_matches_gym(self):
+    gym_env = env_utils.make_taxi_environment()
+    batched_env = env_utils.BatchedTaxiEnvironment(num_envs=10, seed=0)
+    rng = np.random.default_rng(0)
+    initial_states = rng.integers(0, env_utils.NUM_STATES, size=10)
+    states = batched_env.reset(initial_states)
+    np.testing.assert_array_equal(states, initial_states)
+    for _ in range(20):
+      actions = rng.integers(0, env_utils.NUM_ACTIONS, size=10)
+      expected = []
+      for state, action in zip(states, actions):
+        gym_env.s = state
+        new_state, reward, done, _ = gym_env.step(action)
+        expected.append((new_state, reward, done))
+      states, rewards, dones = batched_env.step(actions)
+      self.assertEqual(list(zip(states, rewards, dones)), expected)
+
+  def test_batched_environment_reset_samples_initial_states(self):
+    env = env_utils.BatchedTaxiEnvironment(num_envs=1000, seed=0)
+    states = env.reset()
+    self.assertTrue(np.all(env_utils.INITIAL_STATE_DISTRIBUTION[states] > 0))
+    np.testing.assert_array_equal(
+        env_utils.BatchedTaxiEnvironment(num_envs=1000, seed=0).reset(), states)
+
+
+if __name__ == '__main__':
+  absltest.main()
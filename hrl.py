@@ -15,16 +15,20 @@
 
 """Components for HRL."""
 import collections
-from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from typing import (
+    Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple)
 
 from absl import logging
+import numpy as np
 
 from affordances_option_models import env_utils
 from affordances_option_models import option_utils
 from affordances_option_models import rl
+from affordances_option_models import stats_utils
+from affordances_option_models import tracing
 
 Options = option_utils.Options
-Statistics = Dict[str, Any]
+Statistics = stats_utils.Statistics
 
 
 class TransitionWithOption(NamedTuple):
@@ -34,6 +38,10 @@ class TransitionWithOption(NamedTuple):
 
 TrajectoryWithOption = List[TransitionWithOption]
 
+_NEXT_STATES, _REWARDS, _DONES = env_utils.get_transition_tables()
+# Names of the options by their index, i.e. `option.value - 1`.
+_OPTION_NAMES = tuple(option.name for option in Options)
+
 
 def run_hrl_policy_in_env(
     option_policy: Callable[[int, Options], int],
@@ -44,122 +52,474 @@ def run_hrl_policy_in_env(
     max_steps_per_episode: int = 1000,
     initial_state: Optional[int] = None,
     seed: Optional[int] = None,
+    record_trajectories: bool = True,
+    tracer: Optional[tracing.Tracer] = None,
     ) -> Tuple[List[TrajectoryWithOption], List[int], List[float], Statistics]:
-  """Executes policy in the environment."""
+  """Executes policy in the environment.
+
+  If `record_trajectories` is False, no trajectories are kept and the returned
+  list of trajectories is empty. The statistics are the same either way. Every
+  step, option and episode is reported to the `tracer`, if given (e.g. a
+  `tracing.LoggingTracer` to log them). Without a tracer, events are logged if
+  debug logging is enabled, see `tracing.get_default_tracer`.
+  """
+  if tracer is None:
+    tracer = tracing.get_default_tracer()
 
-  env = env_utils.make_taxi_environment()
-  env.seed(seed)
+  env = env_utils.BatchedTaxiEnvironment(num_envs=1, seed=seed)
 
   trajectories = []
   lengths = []
   rewards = []
-  option_lengths = []
-  option_rewards = []
-  options_per_episode = []
-  total_steps, total_pickups, total_illegal, total_reward = 0, 0, 0, 0
-  option_counts = collections.Counter()
-  per_option_rewards = collections.Counter()
+  statistics = stats_utils.HrlStatistics(_OPTION_NAMES)
 
   for _ in range(num_episodes):
     episode_reward, episode_length, reward, num_options = 0, 0, 0, 0
-    state = env.reset()
-    if initial_state is not None:
-      env.s = initial_state
-      state = env.s
-      logging.debug('State set to %s', env.s)
-    else:
-      state = env.reset()
+    num_pickups, num_illegal = 0, 0
+    state = int(env.reset(initial_state)[0])
+    if tracer is not None:
+      tracer.on_episode_start(state)
 
     transitions = []
 
     while True:   # Main rollout loop.
       # Step 1: Decide which option to execute.
       option_id = policy_over_options(state)
-      option_counts.update({option_id: 1})
       num_options += 1
       option_reward = 0
       for i in range(max_option_length):
         # Execute the option in the environment.
         action = option_policy(state, option_id)
-        new_state, reward, done, _ = env.step(action)
-
-        logging.debug(
-            ('New transition: \n\t'
-             'State @ t = %s,\n\t'
-             'action = %s,\n\t'
-             'option= %s\n\t'
-             'State @ t+1 = %s,\n\t'
-             'reward = %s'),
-            env_utils.int_to_state_fn(state),
-            action,
-            option_id,
-            env_utils.int_to_state_fn(new_state),
-            reward)
+        new_states, step_rewards, dones = env.step([action])
+        new_state, reward, done = (
+            int(new_states[0]), float(step_rewards[0]), bool(dones[0]))
+
+        if tracer is not None:
+          tracer.on_step(state, action, reward, new_state, done, option_id)
 
         if reward == 20:
-          total_pickups += 1
+          num_pickups += 1
           assert done, 'Episode should terminate when pickup is successful.'
         if reward == -10:
-          total_illegal += 1
+          num_illegal += 1
 
-        transitions.append(
-            TransitionWithOption(
-                rl.Transition(state, action, reward, new_state, done),
-                option_id))
+        transition = TransitionWithOption(
+            rl.Transition(state, action, reward, new_state, done), option_id)
+        if record_trajectories:
+          transitions.append(transition)
         state = new_state
 
-        total_steps += 1
-        total_reward += reward
         episode_reward += reward
         episode_length += 1
         option_reward += reward
 
-        if option_term_fn(transitions[-1]):
-          logging.debug('Option terminated. Option length =%d', i)
+        if option_term_fn(transition):
           break
         if episode_length > max_steps_per_episode:
-          logging.debug('Episode too long')
           break
 
-      option_rewards.append(option_reward)
-      per_option_rewards.update({option_id: option_reward})
-      option_lengths.append(i + 1)
+      statistics.add_option(option_id.value - 1, i + 1, option_reward)
+      if tracer is not None:
+        tracer.on_option_end(option_id, i + 1, option_reward)
       if done or episode_length > max_steps_per_episode:
-        logging.debug('Episode terminated. Length=%d', episode_length)
         break
-    trajectories.append(transitions)
+    if record_trajectories:
+      trajectories.append(transitions)
     lengths.append(episode_length)
     rewards.append(episode_reward)
-    options_per_episode.append(num_options)
-
-  statistics = {
-      'num_episodes': num_episodes,
-      'avg_num_steps_per_episode': total_steps / num_episodes,
-      'avg_num_illegal_per_step': total_illegal / total_steps,
-      'avg_success_per_step': total_pickups / total_steps,
-      'avg_reward_per_step': total_reward / total_steps,
-      'prop_success': total_pickups / num_episodes,
-      'prop_illegal': total_illegal / num_episodes,
-      'avg_episode_reward': sum(rewards) / len(rewards),
-      'min_episode_reward': min(rewards),
-      'max_episode_reward': max(rewards),
-      'min_episode_length': min(lengths),
-      'max_episode_length': max(lengths),
-      'avg_num_options_per_episode': (
-          sum(options_per_episode) / len(options_per_episode)),
-      'total_options_executed': sum(options_per_episode),
-      'total_steps': total_steps,
-      'avg_option_length': sum(option_lengths) / len(option_lengths),
-      'min_option_length': min(option_lengths),
-      'max_option_length': max(option_lengths),
-      'avg_option_reward': sum(option_rewards) / len(option_rewards),
-      'min_option_reward': min(option_rewards),
-      'max_option_reward': max(option_rewards),
-      'most_common_options': {k.name: v / sum(options_per_episode)
-                              for k, v in option_counts.most_common(10)},
-      'most_common_option_reward': {k.name: (per_option_rewards[k] / v)
-                                    for k, v in option_counts.most_common(10)},
-  }
+    statistics.add_episode(
+        episode_length, episode_reward, num_pickups, num_illegal, num_options)
+    if tracer is not None:
+      tracer.on_episode_end(episode_length, episode_reward)
+
+  statistics = statistics.result()
+  logging.info(statistics)
+  return trajectories, lengths, rewards, statistics
+
+
+class _BatchedEpisodes(NamedTuple):
+  """Outcomes of episodes run by `_run_batched_episodes`."""
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  lengths: np.ndarray  # Number of steps of every episode.
+  rewards: np.ndarray  # Sum of rewards of every episode.
+  num_options: np.ndarray  # Number of options executed in every episode.
+  num_pickups: np.ndarray  # Number of successful pickups in every episode.
+  num_illegal: np.ndarray  # Number of illegal actions in every episode.
+  # Every executed option in the order of execution, episode by episode.
+  option_episodes: np.ndarray
+  option_initial_states: np.ndarray  # Where the option was chosen.
+  option_ids: np.ndarray  # Indexed from 0.
+  option_lengths: np.ndarray
+  option_rewards: np.ndarray
+  # Columns (episode, s_t, a_t, r_tp1, s_tp1, done, option_id) of every step in
+  # the order of execution, episode by episode, if steps were recorded.
+  steps: Tuple[np.ndarray, ...]
+
+
+def _run_batched_episodes(
+    option_actions: np.ndarray,
+    policy_over_options_table: np.ndarray,
+    option_termination_table: np.ndarray,
+    max_option_length: int,
+    initial_states: np.ndarray,
+    max_steps_per_episode: int,
+    record_steps: bool = True,
+    ) -> _BatchedEpisodes:
+  """Runs one episode from each initial state, advancing all at once."""
+  if max_option_length < 1:
+    raise ValueError(
+        f'max_option_length must be positive, got {max_option_length}.')
+  # Greedy options of shape |S|.
+  state_options = np.argmax(policy_over_options_table, axis=-1)
+
+  num_episodes = len(initial_states)
+  states = np.array(initial_states, dtype=np.int64)
+  options = np.zeros(num_episodes, dtype=np.int64)
+  option_initial_states = np.zeros(num_episodes, dtype=np.int64)
+  option_steps = np.zeros(num_episodes, dtype=np.int64)
+  option_reward = np.zeros(num_episodes)
+  needs_option = np.ones(num_episodes, dtype=bool)
+  num_options = np.zeros(num_episodes, dtype=np.int64)
+  num_pickups = np.zeros(num_episodes, dtype=np.int64)
+  num_illegal = np.zeros(num_episodes, dtype=np.int64)
+  episode_lengths = np.zeros(num_episodes, dtype=np.int64)
+  episode_rewards = np.zeros(num_episodes)
+
+  steps = []
+  executed_options = []
+  active = np.arange(num_episodes)
+  while active.size:
+    # Step 1: Decide which option to execute where the last one ended.
+    starting = active[needs_option[active]]
+    options[starting] = state_options[states[starting]]
+    option_initial_states[starting] = states[starting]
+    option_steps[starting] = 0
+    option_reward[starting] = 0
+    num_options[starting] += 1
+
+    # Step 2: Execute one step of the option in every active episode.
+    s_t = states[active]
+    o_t = options[active]
+    a_t = option_actions[s_t, o_t]
+    s_tp1 = _NEXT_STATES[s_t, a_t]
+    r_t = _REWARDS[s_t, a_t]
+    done = _DONES[s_t, a_t]
+    if record_steps:
+      steps.append((active, s_t, a_t, r_t, s_tp1, done, o_t))
+    assert np.all(done[r_t == 20]), (
+        'Episode should terminate when pickup is successful.')
+
+    states[active] = s_tp1
+    num_pickups[active] += r_t == 20
+    num_illegal[active] += r_t == -10
+    option_steps[active] += 1
+    option_reward[active] += r_t
+    episode_lengths[active] += 1
+    episode_rewards[active] += r_t
+
+    too_long = episode_lengths[active] > max_steps_per_episode
+    option_done = (
+        option_termination_table[s_t, a_t, o_t] | done | too_long |
+        (option_steps[active] == max_option_length))
+    ending = active[option_done]
+    executed_options.append((
+        ending, num_options[ending], option_initial_states[ending],
+        options[ending], option_steps[ending], option_reward[ending]))
+    needs_option[active] = option_done
+    active = active[~(option_done & (done | too_long))]
+
+  (option_episodes, ordinals, option_initial_states, option_ids,
+   option_lengths, option_rewards) = (
+       np.concatenate(column) for column in zip(*executed_options))
+  order = np.lexsort((ordinals, option_episodes))
+  if record_steps:
+    steps = tuple(np.concatenate(column) for column in zip(*steps))
+    # Steps of every episode are recorded in order, so a stable sort by episode
+    # keeps them in order.
+    step_order = np.argsort(steps[0], kind='stable')
+    steps = tuple(column[step_order] for column in steps)
+  return _BatchedEpisodes(
+      lengths=episode_lengths,
+      rewards=episode_rewards,
+      num_options=num_options,
+      num_pickups=num_pickups,
+      num_illegal=num_illegal,
+      option_episodes=option_episodes[order],
+      option_initial_states=option_initial_states[order],
+      option_ids=option_ids[order],
+      option_lengths=option_lengths[order],
+      option_rewards=option_rewards[order],
+      steps=tuple(steps))
+
+
+def run_batched_hrl_policy_in_env(
+    option_actions: np.ndarray,
+    policy_over_options_table: np.ndarray,
+    option_termination_table: np.ndarray,
+    max_option_length: int,
+    num_episodes: int = 1000,
+    max_steps_per_episode: int = 1000,
+    initial_state: Optional[int] = None,
+    seed: Optional[int] = None,
+    record_trajectories: bool = True,
+    ) -> Tuple[List[TrajectoryWithOption], List[int], List[float], Statistics]:
+  """Executes a tabular HRL policy in all episodes at once.
+
+  Same as `run_hrl_policy_in_env` for greedy policies given as tables, but every
+  episode is advanced simultaneously with array indexing into the transition
+  tables. Ties in the policies are broken by taking the first option or action.
+  Given the same seed, the results are identical to `run_hrl_policy_in_env`.
+
+  Args:
+    option_actions: Array of shape |S| x |O| with the greedy action of every
+      option, e.g. `option_utils.pack_option_policies(...).actions`.
+    policy_over_options_table: Array of shape |S| x |O| with the policy over
+      options.
+    option_termination_table: Boolean array of shape |S| x |A| x |O| indicating
+      if an option terminates, e.g. `option_utils.OPTION_TERMINATION_TABLE`.
+    max_option_length: The maximum number of steps an option is executed for.
+    num_episodes: The number of episodes to run.
+    max_steps_per_episode: Episodes are stopped after the first option that
+      ends beyond this number of steps.
+    initial_state: Optional state to start every episode in.
+    seed: Seed for sampling the initial states.
+    record_trajectories: If False, the steps are not kept and the returned list
+      of trajectories is empty.
+
+  Returns:
+    The trajectories, episode lengths, episode rewards and statistics as
+    returned by `run_hrl_policy_in_env`.
+  """
+  env = env_utils.BatchedTaxiEnvironment(num_envs=num_episodes, seed=seed)
+  episodes = _run_batched_episodes(
+      option_actions, policy_over_options_table, option_termination_table,
+      max_option_length, env.reset(initial_state), max_steps_per_episode,
+      record_steps=record_trajectories)
+
+  statistics = stats_utils.HrlStatistics(_OPTION_NAMES)
+  statistics.add_episodes(
+      episodes.lengths, episodes.rewards, episodes.num_pickups,
+      episodes.num_illegal, episodes.num_options)
+  statistics.add_options(
+      episodes.option_ids, episodes.option_lengths, episodes.option_rewards)
+  statistics = statistics.result()
   logging.info(statistics)
-  assert sum(option_counts.values()) == sum(options_per_episode)
+
+  lengths = episodes.lengths.tolist()
+  rewards = episodes.rewards.tolist()
+  if not record_trajectories:
+    return [], lengths, rewards, statistics
+  transitions = [
+      TransitionWithOption(rl.Transition(s, a, r, s_next, d), Options(o + 1))
+      for s, a, r, s_next, d, o in zip(
+          *(column.tolist() for column in episodes.steps[1:]))]
+  boundaries = np.cumsum(lengths).tolist()
+  trajectories = [transitions[start:end] for start, end in zip(
+      [0] + boundaries[:-1], boundaries)]
   return trajectories, lengths, rewards, statistics
+
+
+class _EpisodeOutcome(NamedTuple):
+  """Outcome of a single episode, without its transitions."""
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  length: int
+  reward: float
+  num_pickups: int
+  num_illegal: int
+  # Every executed option in the order of execution.
+  option_initial_states: np.ndarray
+  option_ids: np.ndarray
+  option_lengths: np.ndarray
+  option_rewards: np.ndarray
+
+
+def _split_episodes(episodes: _BatchedEpisodes) -> List[_EpisodeOutcome]:
+  """Splits batched episodes into the outcome of every episode."""
+  boundaries = np.cumsum(episodes.num_options)[:-1]
+  option_columns = (
+      np.split(column, boundaries) for column in (
+          episodes.option_initial_states, episodes.option_ids,
+          episodes.option_lengths, episodes.option_rewards))
+  return [
+      _EpisodeOutcome(*outcome) for outcome in zip(
+          episodes.lengths.tolist(), episodes.rewards.tolist(),
+          episodes.num_pickups.tolist(), episodes.num_illegal.tolist(),
+          *option_columns)]
+
+
+def _get_weighted_statistics(
+    episodes: Sequence[_EpisodeOutcome],
+    weights: Sequence[float],
+    num_episodes: Optional[int] = None,
+    ) -> Statistics:
+  """Summarizes episodes that were observed `weights` times.
+
+  Args:
+    episodes: The outcomes of the episodes.
+    weights: The weight of every episode, e.g. the number of times it was
+      sampled or its probability.
+    num_episodes: The number of episodes the totals are reported for. Defaults
+      to the sum of the weights.
+
+  Returns:
+    The statistics as returned by `run_hrl_policy_in_env`. Minima and maxima are
+    over the episodes with a non-zero weight.
+  """
+  statistics = stats_utils.HrlStatistics(_OPTION_NAMES)
+  for episode, weight in zip(episodes, weights):
+    if not weight:
+      continue
+    statistics.add_episode(
+        episode.length, episode.reward, episode.num_pickups,
+        episode.num_illegal, len(episode.option_ids), weight=weight)
+    statistics.add_options(
+        episode.option_ids, episode.option_lengths, episode.option_rewards,
+        weights=weight)
+  return statistics.result(num_episodes)
+
+
+class HrlEvaluator:
+  """Evaluates tabular policies over options, reusing unchanged episodes.
+
+  Episodes are deterministic given their initial state, so the outcome of the
+  episode from every initial state is cached together with the options chosen
+  by the policy over options along the way. The cached episode is reused for a
+  new policy over options as long as the new policy chooses the same options in
+  those states, so only the episodes affected by a change of the policy are run
+  again.
+  """
+
+  def __init__(
+      self,
+      option_actions: np.ndarray,
+      option_termination_table: np.ndarray = (
+          option_utils.OPTION_TERMINATION_TABLE),
+      max_steps_per_episode: int = 1000,
+      ):
+    """Initializes the evaluator.
+
+    Args:
+      option_actions: Array of shape |S| x |O| with the greedy action of every
+        option, e.g. `option_utils.pack_option_policies(...).actions`.
+      option_termination_table: Boolean array of shape |S| x |A| x |O|
+        indicating if an option terminates.
+      max_steps_per_episode: Episodes are stopped after the first option that
+        ends beyond this number of steps.
+    """
+    self._option_actions = option_actions
+    self._option_termination_table = option_termination_table
+    self._max_steps_per_episode = max_steps_per_episode
+    # Maps the maximum option length to the episode from every initial state.
+    self._episodes: Dict[int, Dict[int, _EpisodeOutcome]] = (
+        collections.defaultdict(dict))
+
+  def _get_episodes(
+      self,
+      policy_over_options_table: np.ndarray,
+      max_option_length: int,
+      initial_states: Sequence[int],
+      ) -> List[_EpisodeOutcome]:
+    """Returns the episodes from the initial states, running stale ones."""
+    state_options = np.argmax(policy_over_options_table, axis=-1)
+    episodes = self._episodes[max_option_length]
+    stale_states = [
+        state for state in initial_states
+        if state not in episodes or not np.array_equal(
+            state_options[episodes[state].option_initial_states],
+            episodes[state].option_ids)]
+    logging.info(
+        'Reusing %d of %d episodes with option length %d.',
+        len(initial_states) - len(stale_states), len(initial_states),
+        max_option_length)
+    if stale_states:
+      episodes.update(zip(stale_states, _split_episodes(_run_batched_episodes(
+          self._option_actions, policy_over_options_table,
+          self._option_termination_table, max_option_length,
+          np.array(stale_states), self._max_steps_per_episode))))
+    return [episodes[state] for state in initial_states]
+
+  def evaluate(
+      self,
+      policy_over_options_table: np.ndarray,
+      max_option_length: int,
+      num_episodes: int = 1000,
+      exact: bool = True,
+      seed: Optional[int] = None,
+      ) -> Statistics:
+    """Computes the statistics of a policy over options.
+
+    Args:
+      policy_over_options_table: Array of shape |S| x |O| with the policy over
+        options.
+      max_option_length: The maximum number of steps an option is executed for.
+      num_episodes: The number of episodes to sample or, if exact, the number
+        of episodes the totals are reported for.
+      exact: If true, every initial state is weighted by its probability (see
+        `evaluate_hrl_policy_exactly`). Otherwise, initial states are sampled
+        and the statistics are the same as those of
+        `run_batched_hrl_policy_in_env`.
+      seed: Seed for sampling the initial states.
+
+    Returns:
+      The statistics of the policy.
+    """
+    if exact:
+      initial_states = np.flatnonzero(env_utils.INITIAL_STATE_DISTRIBUTION)
+      weights = env_utils.INITIAL_STATE_DISTRIBUTION[initial_states]
+    else:
+      env = env_utils.BatchedTaxiEnvironment(num_envs=num_episodes, seed=seed)
+      # Unique initial states in the order they were sampled, so that options
+      # are counted in the same order as when running every episode.
+      initial_states, first_index, weights = np.unique(
+          env.reset(), return_index=True, return_counts=True)
+      order = np.argsort(first_index)
+      initial_states, weights = initial_states[order], weights[order]
+    episodes = self._get_episodes(
+        policy_over_options_table, max_option_length, initial_states.tolist())
+    statistics = _get_weighted_statistics(
+        episodes, weights.tolist(), num_episodes if exact else None)
+    logging.info(statistics)
+    return statistics
+
+
+def evaluate_hrl_policy_exactly(
+    option_actions: np.ndarray,
+    policy_over_options_table: np.ndarray,
+    option_termination_table: np.ndarray,
+    max_option_length: int,
+    max_steps_per_episode: int = 1000,
+    num_episodes: int = 1000,
+    ) -> Statistics:
+  """Computes the expected statistics of a tabular HRL policy.
+
+  The greedy option policies, the greedy policy over options and the taxi
+  environment are deterministic, so the Markov chain over (state, option, option
+  step, episode step) induced by the policy has exactly one path from every
+  initial state. Instead of sampling episodes, the chain is followed from every
+  state in the support of the initial state distribution and the outcomes are
+  weighted by their initial state probability.
+
+  The statistics have the same keys as those of `run_hrl_policy_in_env`.
+  Averages and proportions are expectations, minima and maxima are over the
+  episodes that have a non-zero probability and totals are the expected totals
+  of `num_episodes` episodes.
+
+  Args:
+    option_actions: Array of shape |S| x |O| with the greedy action of every
+      option, e.g. `option_utils.pack_option_policies(...).actions`.
+    policy_over_options_table: Array of shape |S| x |O| with the policy over
+      options.
+    option_termination_table: Boolean array of shape |S| x |A| x |O| indicating
+      if an option terminates, e.g. `option_utils.OPTION_TERMINATION_TABLE`.
+    max_option_length: The maximum number of steps an option is executed for.
+    max_steps_per_episode: Episodes are stopped after the first option that
+      ends beyond this number of steps.
+    num_episodes: The number of episodes the totals are reported for.
+
+  Returns:
+    The statistics of the policy.
+  """
+  evaluator = HrlEvaluator(
+      option_actions, option_termination_table, max_steps_per_episode)
+  return evaluator.evaluate(
+      policy_over_options_table, max_option_length, num_episodes, exact=True)
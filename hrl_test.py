@@ -0,0 +1,163 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for hrl."""
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+from affordances_option_models import env_utils
+from affordances_option_models import hrl
+from affordances_option_models import option_utils
+
+Options = option_utils.Options
+
+
+class HrlTest(parameterized.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    option_policies, _ = option_utils.learn_option_policies(
+        max_iterations=1000, stopping_threshold=1e-5, seed=1)
+    cls.option_policy_table = option_utils.stack_option_policies(
+        option_policies)
+    cls.option_actions = option_utils.pack_option_policies(
+        option_policies).actions
+    # Random policy over options so that options are interrupted, repeated and
+    # episodes get truncated.
+    cls.policy_over_options_table = np.random.default_rng(0).random(
+        (env_utils.NUM_STATES, len(Options)))
+
+  def _run_sequential(self, max_option_length, **kwargs):
+    def option_policy(state, option_id):
+      return np.argmax(self.option_policy_table[option_id.value - 1, state])
+
+    def policy_over_options(state):
+      return Options(np.argmax(self.policy_over_options_table[state]) + 1)
+
+    def option_term_fn(transition):
+      return transition.transition.done or (
+          option_utils.check_option_termination(
+              transition.transition.s_t, transition.transition.a_t,
+              transition.option_id))
+
+    return hrl.run_hrl_policy_in_env(
+        option_policy=option_policy,
+        policy_over_options=policy_over_options,
+        option_term_fn=option_term_fn,
+        max_option_length=max_option_length,
+        **kwargs)
+
+  @parameterized.parameters(
+      {'max_option_length': 5},
+      {'max_option_length': 100},
+      {'max_option_length': 100, 'initial_state': 123},
+  )
+  def test_batched_matches_sequential(self, max_option_length, **kwargs):
+    kwargs.update(num_episodes=200, max_steps_per_episode=100, seed=0)
+    expected = self._run_sequential(max_option_length, **kwargs)
+    actual = hrl.run_batched_hrl_policy_in_env(
+        self.option_actions, self.policy_over_options_table,
+        option_utils.OPTION_TERMINATION_TABLE, max_option_length, **kwargs)
+    self.assertEqual(actual[1], expected[1])
+    self.assertEqual(actual[2], expected[2])
+    self.assertEqual(actual[3], expected[3])
+    self.assertEqual(actual[0], expected[0])
+
+    _, lengths, rewards, statistics = hrl.run_batched_hrl_policy_in_env(
+        self.option_actions, self.policy_over_options_table,
+        option_utils.OPTION_TERMINATION_TABLE, max_option_length,
+        record_trajectories=False, **kwargs)
+    self.assertEqual((lengths, rewards, statistics), expected[1:])
+
+  @parameterized.parameters(5, 100)
+  def test_exact_evaluation(self, max_option_length):
+    statistics = hrl.evaluate_hrl_policy_exactly(
+        self.option_actions, self.policy_over_options_table,
+        option_utils.OPTION_TERMINATION_TABLE, max_option_length,
+        max_steps_per_episode=100)
+    # Sampled episodes converge to the exact statistics.
+    trajectories, lengths, rewards, sampled_statistics = (
+        hrl.run_batched_hrl_policy_in_env(
+            self.option_actions, self.policy_over_options_table,
+            option_utils.OPTION_TERMINATION_TABLE, max_option_length,
+            num_episodes=3000, max_steps_per_episode=100, seed=0))
+    self.assertEqual(statistics.keys(), sampled_statistics.keys())
+    for key in ('avg_reward_per_step', 'avg_option_length',
+                'avg_num_options_per_episode'):
+      self.assertAlmostEqual(
+          statistics[key], sampled_statistics[key],
+          delta=0.05 * abs(statistics[key]))
+
+    # Episodes are deterministic given their initial state, so weighting the
+    # sampled episodes by the initial state distribution gives the expectation.
+    outcomes = {
+        trajectory[0].transition.s_t: (length, reward)
+        for trajectory, length, reward in zip(trajectories, lengths, rewards)}
+    initial_states = np.flatnonzero(env_utils.INITIAL_STATE_DISTRIBUTION)
+    self.assertSameElements(outcomes, initial_states)
+    probabilities = env_utils.INITIAL_STATE_DISTRIBUTION[initial_states]
+    expected_lengths, expected_rewards = np.array(
+        [outcomes[state] for state in initial_states]).T
+    self.assertAlmostEqual(
+        statistics['avg_num_steps_per_episode'],
+        np.dot(probabilities, expected_lengths))
+    self.assertAlmostEqual(
+        statistics['avg_episode_reward'],
+        np.dot(probabilities, expected_rewards))
+    self.assertEqual(statistics['max_episode_length'], max(lengths))
+
+  def test_evaluator_matches_batched_rollouts(self):
+    evaluator = hrl.HrlEvaluator(
+        self.option_actions, max_steps_per_episode=100)
+    for max_option_length in (5, 100):
+      _, _, _, expected = hrl.run_batched_hrl_policy_in_env(
+          self.option_actions, self.policy_over_options_table,
+          option_utils.OPTION_TERMINATION_TABLE, max_option_length,
+          num_episodes=500, max_steps_per_episode=100, seed=0)
+      statistics = evaluator.evaluate(
+          self.policy_over_options_table, max_option_length, num_episodes=500,
+          exact=False, seed=0)
+      self.assertEqual(statistics, expected)
+
+  def test_evaluator_only_reruns_changed_episodes(self):
+    evaluator = hrl.HrlEvaluator(
+        self.option_actions, max_steps_per_episode=100)
+    evaluator.evaluate(self.policy_over_options_table, 100)
+    # Change the option chosen in one state.
+    policy_over_options_table = self.policy_over_options_table.copy()
+    policy_over_options_table[123] = np.roll(
+        policy_over_options_table[123], 1)
+    with mock.patch.object(
+        hrl, '_run_batched_episodes',
+        wraps=hrl._run_batched_episodes) as run_batched_episodes:
+      statistics = evaluator.evaluate(policy_over_options_table, 100)
+      self.assertEqual(statistics, evaluator.evaluate(
+          policy_over_options_table, 100))
+    run_batched_episodes.assert_called_once()
+    num_rerun = len(run_batched_episodes.call_args.args[4])
+    self.assertBetween(
+        num_rerun, 1,
+        np.count_nonzero(env_utils.INITIAL_STATE_DISTRIBUTION) - 1)
+    expected = hrl.evaluate_hrl_policy_exactly(
+        self.option_actions, policy_over_options_table,
+        option_utils.OPTION_TERMINATION_TABLE, 100, max_steps_per_episode=100)
+    self.assertEqual(statistics, expected)
+
+
+if __name__ == '__main__':
+  absltest.main()
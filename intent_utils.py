@@ -15,6 +15,8 @@
 
 """Utilities to work with intents in the taxi domain."""
 
+import numpy as np
+
 from affordances_option_models import definitions
 from affordances_option_models import env_utils
 from affordances_option_models import option_utils
@@ -23,6 +25,43 @@ Intents = definitions.Intents
 IntentStatus = definitions.IntentStatus
 
 
+def _compute_intent_completion_table() -> np.ndarray:
+  """Computes the intent statuses, see `INTENT_COMPLETION_TABLE`."""
+  table = np.zeros((env_utils.NUM_STATES, len(Intents)), dtype=np.int8)
+  passenger_status = env_utils.STATE_PASSENGER_STATUS
+  passenger_inside_car = (
+      passenger_status == env_utils.PASSENGER_INSIDE_CAR_STATUS)
+  for color, intents in definitions.COLOR_TO_INTENT_MAPPING.items():
+    color_reached = env_utils.STATE_COLOR_REACHED == color.value
+    for intent_id in intents:
+      if intent_id in definitions.IntentsWithPassengersInside:
+        completed = color_reached & passenger_inside_car
+      else:
+        # Color must match the passenger status.
+        completed = color_reached & (passenger_status == color.value)
+      table[:, intent_id.value - 1] = completed
+  return table
+
+
+# INTENT_COMPLETION_TABLE[s, i] is the `IntentStatus` of `Intents(i + 1)` after
+# reaching state s. Intent completion only depends on the final state.
+INTENT_COMPLETION_TABLE = _compute_intent_completion_table()
+INTENT_COMPLETION_TABLE.flags.writeable = False
+
+
+def intents_completed(final_states: np.ndarray) -> np.ndarray:
+  """Returns the status of every intent after reaching the final states.
+
+  Args:
+    final_states: Array of integer states of any shape.
+
+  Returns:
+    An int8 array of shape final_states.shape + (|I|,). Entry i is the status of
+    `Intents(i + 1)`.
+  """
+  return INTENT_COMPLETION_TABLE[np.asarray(final_states)]
+
+
 def is_intent_completed(
     s_i: int,
     option_id: option_utils.Options,
@@ -42,39 +81,11 @@ def is_intent_completed(
   """
   del s_i, option_id  # Unused.
 
-  final_taxi_state = env_utils.int_to_state_fn(s_f)
-
+  if not 0 <= s_f < env_utils.NUM_STATES:
+    raise ValueError(
+        f'State {s_f} is not between (0, {env_utils.NUM_STATES - 1})')
   if intent_id not in Intents:
     raise ValueError(
         f'Unknown intent_id={intent_id}. See {Intents} for valid intents.')
 
-  # Obtain which color is reached at this taxi location.
-  color_reached = env_utils.LOCATION_TO_COLOR_MAPPING.get(
-      (final_taxi_state.row, final_taxi_state.col), None)
-
-  # Determine if the passenger is inside the car.
-  passenger_inside_car = (
-      final_taxi_state.passenger_status == env_utils.PASSENGER_INSIDE_CAR_STATUS
-      )
-
-  if color_reached is None:
-    # No color was reached so the intent could not have been completed.
-    return IntentStatus.incomplete
-
-  # At this color, the current intent cannot be completed.
-  if intent_id not in definitions.COLOR_TO_INTENT_MAPPING[color_reached]:
-    return IntentStatus.incomplete
-
-  # This intent is supposed to have the passenger inside the car.
-  if (intent_id in definitions.IntentsWithPassengersInside and
-      passenger_inside_car):
-    return IntentStatus.complete
-
-  # This intent is supposed to have the passenger outside the car.
-  if (intent_id in definitions.IntentsWithPassengersOutside and
-      not passenger_inside_car):
-    if final_taxi_state.passenger_status == color_reached.value:
-      # Color must match the passenger status.
-      return IntentStatus.complete
-
-  return IntentStatus.incomplete
+  return IntentStatus(INTENT_COMPLETION_TABLE[s_f, intent_id.value - 1])
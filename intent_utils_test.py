@@ -17,6 +17,8 @@
 
 from absl.testing import absltest
 from absl.testing import parameterized
+import numpy as np
+from affordances_option_models import definitions
 from affordances_option_models import env_utils
 from affordances_option_models import intent_utils
 
@@ -24,6 +26,23 @@ Intents = intent_utils.Intents
 IntentStatus = intent_utils.IntentStatus
 
 
+def _reference_is_intent_completed(s_f, intent_id):
+  """Decodes the state to check intent completion, independently of tables."""
+  taxi_state = env_utils.int_to_state_fn(s_f)
+  color_reached = env_utils.LOCATION_TO_COLOR_MAPPING.get(
+      (taxi_state.row, taxi_state.col))
+  if (color_reached is None or
+      intent_id not in definitions.COLOR_TO_INTENT_MAPPING[color_reached]):
+    return IntentStatus.incomplete
+  passenger_inside_car = (
+      taxi_state.passenger_status == env_utils.PASSENGER_INSIDE_CAR_STATUS)
+  if intent_id in definitions.IntentsWithPassengersInside:
+    completed = passenger_inside_car
+  else:
+    completed = taxi_state.passenger_status == color_reached.value
+  return IntentStatus.complete if completed else IntentStatus.incomplete
+
+
 class IntentUtilsTest(parameterized.TestCase):
 
   @parameterized.named_parameters(
@@ -118,6 +137,25 @@ class IntentUtilsTest(parameterized.TestCase):
         intent_utils.is_intent_completed(None, None, taxi_state, intent_id),
         status)
 
+  @parameterized.parameters(-1, env_utils.NUM_STATES)
+  def test_is_intent_completed_invalid_state(self, state):
+    with self.assertRaisesRegex(ValueError, 'is not between'):
+      intent_utils.is_intent_completed(None, None, state, Intents.R_in)
+
+  def test_intents_completed(self):
+    final_states = np.arange(env_utils.NUM_STATES).reshape(20, 25)
+    statuses = intent_utils.intents_completed(final_states)
+    self.assertEqual(statuses.shape, (20, 25, len(Intents)))
+    for final_state, intent_statuses in zip(
+        final_states.ravel(), statuses.reshape(-1, len(Intents))):
+      self.assertEqual(
+          tuple(intent_statuses),
+          tuple(_reference_is_intent_completed(final_state, i)
+                for i in Intents))
+    # Every intent is completed at its color in one state per destination.
+    np.testing.assert_array_equal(
+        intent_utils.INTENT_COMPLETION_TABLE.sum(0), 4)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -37,6 +37,8 @@ python3 -m affordances_option_models.lp_learn_model_from_options -- \
 ```
 """
 
+from typing import Optional
+
 from absl import app
 from absl import flags
 from absl import logging
@@ -46,12 +48,16 @@ import launchpad as lp
 from affordances_option_models import custom_nodes
 from affordances_option_models import env_utils
 from affordances_option_models import option_utils
+from affordances_option_models import rl
 from affordances_option_models import task_queue
 
 
 ALL_AFFORDANCE_TYPES = [
     'everything', 'only_pickup_drop', 'only_relevant_pickup_drop', 'learned']
 flags.DEFINE_integer('num_rollout_nodes', 1, 'Number of rollout nodes.')
+flags.DEFINE_integer(
+    'num_rollout_workers', 1,
+    'Number of processes collecting data in parallel in every rollout node.')
 flags.DEFINE_string('path_to_options', None, 'Location to load the options.')
 flags.DEFINE_integer('total_steps', -1, 'Number of steps to do training for.')
 flags.DEFINE_integer('seed', 1, 'The seed to use for training.')
@@ -65,6 +71,26 @@ flags.DEFINE_float(
      ' thrown requiring the user to set it.'))
 flags.DEFINE_string('save_path', '~/affordances_theory/experiment',
                     'Path to save affordances, models and policy over options.')
+flags.DEFINE_bool(
+    'use_outcome_table', False,
+    'Look up the outcomes of options in a precomputed table in the rollout '
+    'nodes instead of executing them in the environment.')
+flags.DEFINE_bool(
+    'aggregate_batches', False,
+    'Send every batch from the rollout nodes as unique transitions weighted by '
+    'their counts.')
+flags.DEFINE_bool(
+    'log_oracle_model_errors', False,
+    'Compare every learned option model to the exact option model of the '
+    'option policies in the evaluation nodes.')
+flags.DEFINE_enum(
+    'hrl_evaluator', 'exact', ['exact', 'sampled'],
+    'Evaluate the policy over options exactly from every initial state or by '
+    'sampling episodes.')
+flags.DEFINE_enum(
+    'solver', 'value_iteration', list(rl.SOLVERS),
+    'The planner used by the evaluation nodes to learn the policy over '
+    'options.')
 
 FLAGS = flags.FLAGS
 _GLOBAL_SEED = 424242
@@ -119,6 +145,9 @@ def make_evaluation_node(
     affordances_name: str,
     save_path: str,
     save_every: int,
+    oracle_max_option_length: Optional[int] = None,
+    hrl_evaluator: str = 'exact',
+    solver: str = 'value_iteration',
     ):
   """Creates a training node to learn the models."""
   num_eval_episodes = 1 if FLAGS.lp_launch_type.startswith('test') else 1000
@@ -138,6 +167,9 @@ def make_evaluation_node(
         save_path=save_path,
         save_every=save_every,
         num_eval_episodes=num_eval_episodes,
+        oracle_max_option_length=oracle_max_option_length,
+        hrl_evaluator=hrl_evaluator,
+        solver=solver,
         writer=log_writer)
     return evaluation
   return evaluation_node
@@ -155,7 +187,13 @@ def _make_program(model_learning_rate: float,
                   max_iterations_for_value_iter: int,
                   seed: int,
                   affordances_threshold: float = 0.5,
-                  num_rollout_nodes=1):
+                  num_rollout_nodes=1,
+                  use_outcome_table: bool = False,
+                  aggregate_batches: bool = False,
+                  log_oracle_model_errors: bool = False,
+                  num_rollout_workers: int = 1,
+                  hrl_evaluator: str = 'exact',
+                  solver: str = 'value_iteration'):
   """Creates the launchpad program."""
   program = lp.Program('model_learning')
   program_stopper = lp.make_program_stopper(FLAGS.lp_launch_type)
@@ -210,6 +248,10 @@ def _make_program(model_learning_rate: float,
               affordances_name=evaluation_affordance_name,
               save_path=save_path,
               save_every=200000,
+              oracle_max_option_length=(
+                  max_option_length if log_oracle_model_errors else None),
+              hrl_evaluator=hrl_evaluator,
+              solver=solver,
               ),
           trainer_node)
       program.add_node(evaluation_node)
@@ -226,13 +268,17 @@ def _make_program(model_learning_rate: float,
     for i in range(num_rollout_nodes):
       rollout_node = lp.CourierNode(
           custom_nodes.Rollout,
-          global_seed=seed * _GLOBAL_SEED + i,
+          global_seed=seed * _GLOBAL_SEED,
+          node_index=i,
           batch_size=batch_size,
           path_to_options=path_to_options,
           affordances_name=rollout_node_affordances,
           max_option_length=max_option_length,
           queue_writer=queue.writer(),
-          trainer_node=trainer_node)
+          trainer_node=trainer_node,
+          use_outcome_table=use_outcome_table,
+          aggregate_batches=aggregate_batches,
+          num_workers=num_rollout_workers)
       program.add_node(rollout_node)
 
   return program
@@ -266,10 +312,16 @@ def main(_):
   program = _make_program(
       path_to_options=FLAGS.path_to_options,
       num_rollout_nodes=FLAGS.num_rollout_nodes,
+      num_rollout_workers=FLAGS.num_rollout_workers,
       affordances_name=FLAGS.affordances_name,
       affordances_threshold=FLAGS.affordances_threshold,
       save_path=FLAGS.save_path,
       seed=FLAGS.seed,
+      use_outcome_table=FLAGS.use_outcome_table,
+      aggregate_batches=FLAGS.aggregate_batches,
+      log_oracle_model_errors=FLAGS.log_oracle_model_errors,
+      hrl_evaluator=FLAGS.hrl_evaluator,
+      solver=FLAGS.solver,
       **program_config)
 
   lp.launch(program)
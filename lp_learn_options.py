@@ -15,10 +15,15 @@
 
 r"""Learn option tables for the taxi environment.
 
-This script uses task_queue to learn all the options in parallel.
-Ideally this only needs to be done once for the full set of options.
-
-Options will be saved individually as npz files.
+This script uses task_queue to learn all the options in parallel. Alternatively,
+with `--batch_solve` all options are learned in a single batched value
+iteration on the local machine. Ideally this only needs to be done once for the
+full set of options.
+
+Options will be saved individually as npz files. Once all options are learned,
+their greedy actions are also packed into a single table that is memory-mapped
+when the options are loaded, see `option_utils.save_packed_option_policies`,
+and the content hashes of all option files are written to a manifest.
 """
 import os
 import time
@@ -44,37 +49,78 @@ flags.DEFINE_string(
 flags.DEFINE_integer(
     'max_iterations', 1000,
     'Maximum number of iterations to run the value iteration.')
+flags.DEFINE_bool(
+    'batch_solve', False,
+    'Learn all options in one batched value iteration on this machine instead '
+    'of launching a program with a queue and consumers.')
+flags.DEFINE_float(
+    'results_timeout', 3600,
+    'Seconds the writer waits for the consumers to learn all options before '
+    'failing with the options that are still missing.')
+
+
+def _make_save_path(save_path, gamma, max_iterations):
+  """Creates and returns the folder that options are saved into."""
+  save_path = os.path.join(
+      save_path,
+      f'gamma{gamma}',
+      f'max_iterations{max_iterations}',
+      'options')
+  if not os.path.exists(save_path):
+    os.makedirs(save_path)
+  logging.info('Saving to folder: %s', save_path)
+  return save_path
+
+
+def _save_option_policy(save_path, option, option_policy):
+  option_save_path = os.path.join(
+      save_path, option_utils.option_policy_filename(option))
+  with open(option_save_path, 'wb') as fout:
+    np.save(fout, option_policy, allow_pickle=False)
+  logging.info('Saved option to %s', option_save_path)
+
 
+def _pack_saved_option_policies(save_path):
+  """Packs the options saved individually in `save_path`."""
+  # A manifest of options saved before into the same folder is out of date.
+  manifest_path = os.path.join(save_path, option_utils.OPTION_MANIFEST_FILENAME)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+  option_utils.save_packed_option_policies(
+      save_path, option_utils.load_option_policies(save_path, packed=False))
+  option_utils.write_option_manifest(save_path)
 
-def make_writer(program_stopper):
+
+def make_writer(program_stopper, save_path, results_timeout=None):
   """Creates a writer node to write all options to a queue.."""
   def writer(queue):
     logging.info('Writer has started.')
-    future_to_task_key = {}
+    task_key_to_option = {}
     for task_key, option in enumerate(option_utils.Options):
       task_key = str(task_key)
       task_parameters = {'option': option}
-      future = queue.enqueue_task(task_key, task_parameters)
+      queue.enqueue_task(task_key, task_parameters)
       logging.info('Adding task %s: %s', task_key, task_parameters)
-      future_to_task_key[future] = task_key
+      task_key_to_option[task_key] = option
 
     logging.info('All options added to the queue. Waiting for results...')
+    # Closing only waits until every task was taken, so wait for the consumers
+    # to save every option before packing them.
+    missing = queue.join(results_timeout)
+    if missing:
+      raise RuntimeError(
+          f'No results after {results_timeout} seconds for options '
+          f'{[task_key_to_option[task_key].name for task_key in missing]}.')
     queue.close()
-    logging.info('All results received. Done.')
+    logging.info('All results received. Packing options.')
+    _pack_saved_option_policies(save_path)
     program_stopper(mark_as_completed=True)
   return writer
 
 
 def make_consumer(gamma, max_iterations, topic_name, save_path):
   """Makes the function that consumes the queue."""
-  save_path = os.path.join(
-      save_path,
-      f'gamma{gamma}',
-      f'max_iterations{max_iterations}',
-      'options')
-  if not os.path.exists(save_path):
-    os.makedirs(save_path)
-  logging.info('Saving to folder: %s', save_path)
+  save_path = _make_save_path(save_path, gamma, max_iterations)
 
   def consumer(queue):
     logging.info('Starting consumer.')
@@ -98,10 +144,7 @@ def make_consumer(gamma, max_iterations, topic_name, save_path):
         logging.info(
             'Option was learned in %s iterations. Saving to disk.', num_iters)
 
-        option_save_path = f'{save_path}/{option.name}.npz'
-        with open(option_save_path, 'wb') as fout:
-          np.save(fout, option_policy, allow_pickle=False)
-        logging.info('Saved option to %s', option_save_path)
+        _save_option_policy(save_path, option, option_policy)
 
         queue.set_result(
             topic_name, task_key, {'option': option, 'learned': True})
@@ -112,7 +155,8 @@ def make_consumer(gamma, max_iterations, topic_name, save_path):
   return consumer
 
 
-def _make_program(gamma, max_iterations, save_path, num_consumers=1):
+def _make_program(gamma, max_iterations, save_path, num_consumers=1,
+                  results_timeout=None):
   """Creates the launchpad program."""
   program = lp.Program('option_learning')
   program_stopper = lp.make_program_stopper(FLAGS.lp_launch_type)
@@ -130,7 +174,9 @@ def _make_program(gamma, max_iterations, save_path, num_consumers=1):
   #     Problems creator       #
   ##############################
   with program.group('writer'):
-    write_to_queue = make_writer(program_stopper)
+    write_to_queue = make_writer(
+        program_stopper, _make_save_path(save_path, gamma, max_iterations),
+        results_timeout)
     program.add_node(
         lp.PyNode(write_to_queue, queue.writer()))
 
@@ -148,13 +194,34 @@ def _make_program(gamma, max_iterations, save_path, num_consumers=1):
   return program
 
 
+def _batch_solve(gamma, max_iterations, save_path):
+  """Learns and saves all options on this machine."""
+  save_path = _make_save_path(save_path, gamma, max_iterations)
+  option_policies, num_iters = option_utils.learn_option_policies(
+      gamma=gamma,
+      stopping_threshold=1e-5,
+      max_iterations=max_iterations,
+      seed=_SEED)
+  logging.info('Options were learned in %s iterations.', num_iters)
+  for option, option_policy in option_policies.items():
+    _save_option_policy(save_path, option, option_policy)
+  option_utils.save_packed_option_policies(
+      save_path, option_utils.pack_option_policies(option_policies))
+  option_utils.write_option_manifest(save_path)
+
+
 def main(_):
 
+  if FLAGS.batch_solve:
+    _batch_solve(FLAGS.gamma, FLAGS.max_iterations, FLAGS.save_path)
+    return
+
   program = _make_program(
       FLAGS.gamma,
       FLAGS.max_iterations,
       FLAGS.save_path,
-      FLAGS.num_consumers)
+      FLAGS.num_consumers,
+      FLAGS.results_timeout)
 
   lp.launch(program)
 
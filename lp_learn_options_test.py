@@ -0,0 +1,123 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for lp_learn_options."""
+
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import env_utils
+from affordances_option_models import lp_learn_options
+from affordances_option_models import option_utils
+from affordances_option_models import task_queue
+
+Options = option_utils.Options
+
+
+class LpLearnOptionsTest(absltest.TestCase):
+
+  def _random_option_policies(self, seed):
+    rng = np.random.default_rng(seed)
+    return {
+        option: np.eye(env_utils.NUM_ACTIONS)[
+            rng.integers(env_utils.NUM_ACTIONS, size=env_utils.NUM_STATES)]
+        for option in Options}
+
+  def test_writer_packs_options_after_slow_consumer(self):
+    tempdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tempdir.cleanup)
+    save_path = tempdir.name
+    # Options of an earlier run saved into the same folder.
+    for option, option_policy in self._random_option_policies(0).items():
+      lp_learn_options._save_option_policy(save_path, option, option_policy)
+    lp_learn_options._pack_saved_option_policies(save_path)
+    stale_digest = option_utils.option_policies_digest(save_path)
+    option_policies = self._random_option_policies(1)
+
+    # Poll the queue quickly so that the writer would pack as soon as the last
+    # task is taken if it did not wait for the results.
+    sleep = time.sleep
+    self.enter_context(mock.patch.object(
+        task_queue, 'time',
+        mock.Mock(sleep=lambda _: sleep(0.01), time=time.time)))
+    queue = task_queue._QueueImplementation()
+    program_stopper = mock.Mock()
+    writer = threading.Thread(
+        target=lp_learn_options.make_writer(program_stopper, save_path),
+        args=(queue,))
+    writer.start()
+
+    for i in range(len(Options)):
+      task_key, task_params = queue.get_task('default')
+      if i == len(Options) - 1:
+        # The last option takes a while to learn.
+        deadline = time.time() + 1
+        while not queue.closed() and time.time() < deadline:
+          sleep(0.01)
+        self.assertFalse(queue.closed())
+      option = task_params['option']
+      lp_learn_options._save_option_policy(
+          save_path, option, option_policies[option])
+      queue.set_result('default', task_key, {'option': option})
+    writer.join()
+
+    program_stopper.assert_called_once_with(mark_as_completed=True)
+    # The packed tables and the manifest are those of the new options, and the
+    # manifest validates both the packed and the individual files.
+    self.assertNotEqual(
+        option_utils.option_policies_digest(save_path), stale_digest)
+    expected_actions = option_utils.pack_option_policies(
+        option_policies).actions
+    for packed in (True, False):
+      np.testing.assert_array_equal(
+          option_utils.load_option_policies(save_path, packed=packed).actions,
+          expected_actions)
+
+  def test_writer_reports_missing_options(self):
+    tempdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tempdir.cleanup)
+    sleep = time.sleep
+    self.enter_context(mock.patch.object(
+        task_queue, 'time',
+        mock.Mock(sleep=lambda _: sleep(0.01), time=time.time)))
+    queue = task_queue._QueueImplementation()
+    option_policies = self._random_option_policies(0)
+
+    def consumer():
+      # The consumer of the last option fails before setting its result.
+      for _ in range(len(Options) - 1):
+        task_key, task_params = queue.get_task('default')
+        option = task_params['option']
+        lp_learn_options._save_option_policy(
+            tempdir.name, option, option_policies[option])
+        queue.set_result('default', task_key, {'option': option})
+
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+    program_stopper = mock.Mock()
+    writer = lp_learn_options.make_writer(
+        program_stopper, tempdir.name, results_timeout=0.5)
+    with self.assertRaisesRegex(RuntimeError, list(Options)[-1].name):
+      writer(queue)
+    consumer_thread.join()
+    program_stopper.assert_not_called()
+
+
+if __name__ == '__main__':
+  absltest.main()
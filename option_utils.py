@@ -14,9 +14,17 @@
 # ==============================================================================
 
 """Utilities related to options and learning option policies in the Taxi-v2."""
-from typing import Optional, Tuple
+import concurrent.futures
+import functools
+import hashlib
+import io
+import json
+import os
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple, Union
 from absl import logging
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 from affordances_option_models import affordances
 from affordances_option_models import definitions
@@ -27,8 +35,44 @@ Options = definitions.Options
 OptionsDropping = definitions.OptionsDropping
 OptionsPicking = definitions.OptionsPicking
 OptionsAny = definitions.OptionsAny
-_TRANSITION_DICT, _TRANSITION_MATRIX = (
-    env_utils.get_transition_and_reward_matrices()[:-1])
+OptionKind = definitions.OptionKind
+OPTION_INFO = definitions.OPTION_INFO
+_NEXT_STATES, _REWARDS, _DONES = env_utils.get_transition_tables()
+# Files of the packed option policies, see `save_packed_option_policies`.
+OPTION_ACTIONS_FILENAME = 'option_actions.npy'
+OPTION_TIES_FILENAME = 'option_ties.npy'
+# Content hashes of the option files, see `write_option_manifest`.
+OPTION_MANIFEST_FILENAME = 'manifest.json'
+
+
+def _compute_option_termination_table() -> np.ndarray:
+  """Computes the termination table, see `check_option_termination`."""
+  options = sorted(Options, key=lambda option: option.value)
+  kinds = np.array([OPTION_INFO[option].kind for option in options])
+  grid_cells = np.array([OPTION_INFO[option].grid_cell for option in options])
+  actions = np.arange(env_utils.NUM_ACTIONS)[None, :, None]
+  passenger_inside = (
+      env_utils.STATE_PASSENGER_STATUS == env_utils.PASSENGER_INSIDE_CAR_STATUS
+      )[:, None, None]
+
+  # Dropping options need the DROP action with the passenger inside and picking
+  # options need the PICKUP action with the passenger outside.
+  can_drop = (actions == definitions.ActionMap.DROP) & passenger_inside
+  can_pickup = (actions == definitions.ActionMap.PICKUP) & ~passenger_inside
+  action_matches = np.where(
+      kinds == OptionKind.DROP, can_drop,
+      np.where(kinds == OptionKind.PICKUP, can_pickup, True))
+
+  # The taxi must end up in the grid cell the option goes to.
+  reaches_target = (
+      env_utils.STATE_GRID_CELL[_NEXT_STATES][:, :, None] == grid_cells)
+  return action_matches & reaches_target
+
+
+# A |S| x |A| x |O| boolean table where entry (s, a, o) indicates if taking
+# action a in state s terminates option o (indexed from 0, i.e. o.value - 1).
+OPTION_TERMINATION_TABLE = _compute_option_termination_table()
+OPTION_TERMINATION_TABLE.flags.writeable = False
 
 
 def check_option_termination(
@@ -60,37 +104,10 @@ def check_option_termination(
   Returns:
     boolean indicating if the option terminates in this transition.
   """
-  if option not in Options:
+  if not isinstance(option, Options):
     raise ValueError(
         f'Unknown Option {option}. Valid: {Options.__members__.values()}')
-  _, s_tp1, _ = _TRANSITION_DICT[s_t][a_t][0]
-  _, _, passenger_state, _ = env_utils.int_to_state_fn(s_t)
-  taxi_row, taxi_col, _, _ = env_utils.int_to_state_fn(s_tp1)
-
-  if option in OptionsDropping:
-    # Option is supposed to drop off a passenger so action must be dropping.
-    if a_t != definitions.ActionMap.DROP:
-      return False
-    # If passenger was not in the car, this option cannot terminate.
-    if passenger_state != env_utils.PASSENGER_INSIDE_CAR_STATUS:
-      return False
-
-  if option in OptionsPicking:
-    # Option is supposed to pick up a passenger so action must be picking.
-    if a_t != definitions.ActionMap.PICKUP:
-      return False
-    # If the passenger is in the car, then picking up is not possible.
-    if passenger_state == env_utils.PASSENGER_INSIDE_CAR_STATUS:
-      return False
-
-  # Now check if the option "go to" location matches the current taxi position.
-  # Options are named "GoToXX_??" where XX us the grid index.
-  grid_idx = int(option.name.replace('GoTo', '').split('_')[0])
-  grid_row, grid_col = env_utils.grid_cell_to_xy(grid_idx)
-  if (taxi_row, taxi_col) == (grid_row, grid_col):
-    return True
-  else:
-    return False
+  return bool(OPTION_TERMINATION_TABLE[s_t, a_t, option.value - 1])
 
 
 def compute_per_step_matrices_for_option_learning(
@@ -111,25 +128,46 @@ def compute_per_step_matrices_for_option_learning(
        if the entry (s, a) has a 1, transitions can take place. If it has a zero
        it terminates.
   """
-  taxienv = env_utils.make_taxi_environment()
-  num_states, num_actions = taxienv.nS, taxienv.nA
-  option_step_reward = np.full((num_states, num_actions), r_other)
-  option_transition_mask = np.ones((num_states, num_actions), dtype=np.float)
-  for s in range(num_states):
-    for a in range(num_actions):
-      if check_option_termination(s, a, option):
-        option_step_reward[s, a] = r_option_completion
-        option_transition_mask[s, a] = 0.0  # No possible transitions from here.
+  if not isinstance(option, Options):
+    raise ValueError(
+        f'Unknown Option {option}. Valid: {Options.__members__.values()}')
+  terminates = OPTION_TERMINATION_TABLE[:, :, option.value - 1]
+  option_step_reward = np.where(terminates, r_option_completion, r_other)
+  # No possible transitions from where the option terminates.
+  option_transition_mask = np.where(terminates, 0.0, 1.0)
 
   return option_step_reward, option_transition_mask
 
 
+def compute_per_step_matrices_for_all_options(
+    r_option_completion: float = 1.0,
+    r_other: float = 0.0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+  """Computes per-step matrices needed to learn all option polices at once.
+
+  Args:
+    r_option_completion: The reward for successful completion of the option.
+    r_other: The reward for all other steps of the option.
+
+  Returns:
+    1. A |O| x |S| x |A| matrix containing the per-step rewards for every
+       option (indexed from 0, i.e. o.value - 1).
+    2. A |O| x |S| x |A| matrix containing the termination mask for every
+       option. See `compute_per_step_matrices_for_option_learning`.
+  """
+  terminates = np.moveaxis(OPTION_TERMINATION_TABLE, -1, 0)
+  option_step_reward = np.where(terminates, r_option_completion, r_other)
+  option_transition_mask = np.where(terminates, 0.0, 1.0)
+  return option_step_reward, option_transition_mask
+
+
 def learn_option_policy(
     option: Options,
     gamma: float = rl.DEFAULT_GAMMA,
     stopping_threshold: float = 0.0001,
     max_iterations: int = 10000,
     seed: Optional[int] = None,
+    factored: bool = False,
     ) -> Tuple[np.ndarray, int]:
   """Learns the low level policy for an option.
 
@@ -139,59 +177,552 @@ def learn_option_policy(
     stopping_threshold: Stop if the change in value is less than this value.
     max_iterations: Maximum number of iterations to run VI.
     seed: For tie-breaking.
+    factored: Solve the MDP of every destination independently, see
+      `rl.factored_solve`.
 
   Returns:
     pi_star: Low level policy, |S| x |A| that achieves the desired option.
   """
   r_option, b_option = compute_per_step_matrices_for_option_learning(option)
-  # The transition matrix must be masked to take into account when an option
-  # will terminate. For example, if the option termination condition is to go to
+  # The transitions must be masked to take into account when an option will
+  # terminate. For example, if the option termination condition is to go to
   # state X, then it must not be able to go to any other state after. The
-  # b_option matrix contains this information and we expand dimensions to
-  # automatically broadcast and mask the usual transition matrix.
-  b_option = np.expand_dims(b_option, -1)
-  masked_transition_matrix = b_option * _TRANSITION_MATRIX
-  V_star, _, num_iters = rl.value_iteration(  # pylint: disable=invalid-name
+  # b_option matrix contains this information. Since taxi is deterministic, we
+  # fold it into the discount and use the next state table directly instead of
+  # masking a dense |S| x |A| x |S| transition matrix.
+  option_gamma = gamma * b_option
+  if factored:
+    solve = functools.partial(
+        rl.factored_solve, blocks=env_utils.DESTINATION_BLOCKS)
+  else:
+    solve = rl.value_iteration
+  V_star, _, num_iters = solve(  # pylint: disable=invalid-name
       reward_matrix=r_option,
-      transition_matrix=masked_transition_matrix,
+      transition_matrix=_NEXT_STATES,
       max_iterations=max_iterations,
       stopping_threshold=stopping_threshold,
-      gamma=gamma)
+      gamma=option_gamma)
   pi_star = rl.extract_greedy_policy(
-      r_option, masked_transition_matrix, V_star, gamma=gamma, seed=seed)
+      r_option, _NEXT_STATES, V_star, gamma=option_gamma, seed=seed)
 
   return pi_star, num_iters
 
 
-def learn_policy_over_options(
-    option_reward: np.ndarray,
-    option_transition: np.ndarray,
-    option_length: np.ndarray,
+def learn_option_policies(
+    options: Optional[Sequence[Options]] = None,
     gamma: float = rl.DEFAULT_GAMMA,
     stopping_threshold: float = 0.0001,
     max_iterations: int = 10000,
     seed: Optional[int] = None,
+    ) -> Tuple[Dict[Options, np.ndarray], Dict[Options, int]]:
+  """Learns the low level policies for many options at once.
+
+  This solves the same problems as `learn_option_policy` but stacks them along
+  an option axis so that value iteration and greedy policy extraction are done
+  for all options in one vectorized computation.
+
+  Args:
+    options: The options for which to learn the policy. Defaults to all.
+    gamma: Discount factor in VI.
+    stopping_threshold: Stop if the change in value is less than this value.
+    max_iterations: Maximum number of iterations to run VI.
+    seed: For tie-breaking.
+
+  Returns:
+    pi_stars: Maps every option to its low level policy, |S| x |A|.
+    num_iters: Maps every option to the number of iterations VI took.
+  """
+  options = tuple(Options) if options is None else tuple(options)
+  option_indices = [option.value - 1 for option in options]
+  r_options, b_options = compute_per_step_matrices_for_all_options()
+  r_options = r_options[option_indices]
+  # See `learn_option_policy` for why the termination mask is in the discount.
+  option_gammas = gamma * b_options[option_indices]
+  V_stars, _, num_iters = rl.batched_value_iteration(  # pylint: disable=invalid-name
+      reward_matrices=r_options,
+      transition_matrix=_NEXT_STATES,
+      max_iterations=max_iterations,
+      stopping_threshold=stopping_threshold,
+      gamma=option_gammas)
+  pi_stars = rl.extract_batched_greedy_policies(
+      r_options, _NEXT_STATES, V_stars, gamma=option_gammas, seed=seed)
+
+  return dict(zip(options, pi_stars)), dict(zip(options, num_iters.tolist()))
+
+
+def stack_option_policies(
+    option_policies: Dict[Options, np.ndarray]) -> np.ndarray:
+  """Stacks option policies into an array of shape |O| x |S| x |A|.
+
+  Args:
+    option_policies: A dictionary mapping every option to its |S| x |A| table.
+
+  Returns:
+    The tables of every option, ordered by option index (`option.value - 1`).
+  """
+  missing_options = [option for option in Options
+                     if option not in option_policies]
+  if missing_options:
+    raise ValueError(f'No option policies given for {missing_options}.')
+  return np.stack([option_policies[option] for option in Options])
+
+
+class PackedOptionPolicies(NamedTuple):
+  """Greedy option policies of all options packed into tables."""
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  # The |S| x |O| table of the greedy action of every option, indexed by
+  # `option.value - 1`. The first maximal action is taken on ties.
+  actions: np.ndarray
+  # The |S| x |O| x |A| mask of the maximal actions of every option, only
+  # present if at least one policy has ties.
+  ties: Optional[np.ndarray] = None
+
+  def to_dict(self) -> Dict[Options, np.ndarray]:
+    """Returns the tables of every option as loaded from the legacy files.
+
+    Every |S| x |A| table is one-hot on the greedy action, or has a one for
+    every maximal action when there are ties. Taking the argmax, or the random
+    argmax, of a table executes the same actions as the original policy.
+    """
+    if self.ties is None:
+      num_actions = env_utils.NUM_ACTIONS
+      tables = np.eye(num_actions)[np.moveaxis(self.actions, -1, 0)]
+    else:
+      tables = np.moveaxis(self.ties, 1, 0).astype(np.float64)
+    return dict(zip(Options, tables))
+
+
+def pack_option_policies(
+    option_policies: Dict[Options, np.ndarray]) -> PackedOptionPolicies:
+  """Packs option policies into greedy action tables.
+
+  Args:
+    option_policies: A dictionary mapping every option to its |S| x |A| table.
+
+  Returns:
+    The packed option policies. Actions are maximal if they are close to the
+    maximum, as in `rl.random_argmax`.
+  """
+  policies = np.moveaxis(stack_option_policies(option_policies), 0, 1)
+  ties = np.isclose(policies, policies.max(-1, keepdims=True))
+  actions = np.argmax(ties, axis=-1).astype(np.uint8)
+  if np.all(ties.sum(-1) == 1):
+    ties = None
+  return PackedOptionPolicies(actions=actions, ties=ties)
+
+
+def as_packed_option_policies(
+    option_policies: Union[Dict[Options, np.ndarray], PackedOptionPolicies],
+    ) -> PackedOptionPolicies:
+  """Returns packed option policies, packing them if needed."""
+  if isinstance(option_policies, PackedOptionPolicies):
+    return option_policies
+  return pack_option_policies(option_policies)
+
+
+def save_packed_option_policies(
+    save_dir: str, option_policies: PackedOptionPolicies):
+  """Saves packed option policies as `.npy` files in `save_dir`."""
+  with open(os.path.join(save_dir, OPTION_ACTIONS_FILENAME), 'wb') as fout:
+    np.save(fout, option_policies.actions, allow_pickle=False)
+  ties_path = os.path.join(save_dir, OPTION_TIES_FILENAME)
+  if option_policies.ties is not None:
+    with open(ties_path, 'wb') as fout:
+      np.save(fout, option_policies.ties, allow_pickle=False)
+  elif os.path.exists(ties_path):
+    os.remove(ties_path)
+  logging.info('Saved packed option policies to %s', save_dir)
+
+
+def load_packed_option_policies(
+    save_dir: str, mmap_mode: Optional[str] = 'r') -> PackedOptionPolicies:
+  """Loads option policies saved by `save_packed_option_policies`.
+
+  Args:
+    save_dir: The directory with the packed option policies.
+    mmap_mode: Memory-map mode for `np.load`. By default the tables are mapped
+      read-only, so that processes on the same host share their pages.
+
+  Returns:
+    The packed option policies.
+
+  Raises:
+    FileNotFoundError: If there are no packed option policies in `save_dir`.
+    ValueError: If the tables do not have the shapes of the taxi options.
+  """
+  actions = np.load(
+      os.path.join(save_dir, OPTION_ACTIONS_FILENAME), mmap_mode=mmap_mode,
+      allow_pickle=False)
+  ties = None
+  ties_path = os.path.join(save_dir, OPTION_TIES_FILENAME)
+  if os.path.exists(ties_path):
+    ties = np.load(ties_path, mmap_mode=mmap_mode, allow_pickle=False)
+  return _check_packed_option_policies(actions, ties)
+
+
+def _check_packed_option_policies(
+    actions: np.ndarray, ties: Optional[np.ndarray]) -> PackedOptionPolicies:
+  """Returns the packed option policies after checking their shapes."""
+  expected_shape = (env_utils.NUM_STATES, len(Options))
+  if actions.shape != expected_shape:
+    raise ValueError(
+        f'Expected option actions of shape {expected_shape}, '
+        f'got {actions.shape}.')
+  expected_shape += (env_utils.NUM_ACTIONS,)
+  if ties is not None and ties.shape != expected_shape:
+    raise ValueError(
+        f'Expected option ties of shape {expected_shape}, got {ties.shape}.')
+  return PackedOptionPolicies(actions=actions, ties=ties)
+
+
+def option_policy_filename(option: Options) -> str:
+  """Returns the name of the file an option policy is saved to on its own."""
+  return f'{option.name}.npz'
+
+
+def _read_file(path: str) -> bytes:
+  with open(path, 'rb') as fin:
+    return fin.read()
+
+
+def _sha256(content: bytes) -> str:
+  return hashlib.sha256(content).hexdigest()
+
+
+def _map_npy(path: str) -> Tuple[np.memmap, str]:
+  """Memory-maps an `.npy` file read-only and hashes the mapped bytes.
+
+  The array is a view of the hashed mapping, so the hash is that of the data
+  that is used even if the file is replaced in the meantime.
+
+  Args:
+    path: The path of the file.
+
+  Returns:
+    The array and the hash of the whole file.
+  """
+  with open(path, 'rb') as fin:
+    version = np.lib.format.read_magic(fin)
+    if version == (1, 0):
+      header = np.lib.format.read_array_header_1_0(fin)
+    else:
+      header = np.lib.format.read_array_header_2_0(fin)
+    offset = fin.tell()
+    content = np.memmap(fin, dtype=np.uint8, mode='r')
+  shape, fortran_order, dtype = header
+  array = content[offset:].view(dtype).reshape(
+      shape, order='F' if fortran_order else 'C')
+  return array, _sha256(content)
+
+
+def _option_filenames(save_dir: str, packed: bool = True) -> Tuple[str, ...]:
+  """Returns the option files to load, packed tables if they were saved."""
+  actions_path = os.path.join(save_dir, OPTION_ACTIONS_FILENAME)
+  if packed and os.path.exists(actions_path):
+    filenames = [OPTION_ACTIONS_FILENAME]
+    if os.path.exists(os.path.join(save_dir, OPTION_TIES_FILENAME)):
+      filenames.append(OPTION_TIES_FILENAME)
+    return tuple(filenames)
+  return tuple(option_policy_filename(option) for option in Options)
+
+
+def _read_option_manifest(save_dir: str) -> Optional[Dict[str, str]]:
+  """Returns the content hash of every option file, if there is a manifest."""
+  path = os.path.join(save_dir, OPTION_MANIFEST_FILENAME)
+  if not os.path.exists(path):
+    return None
+  with open(path, 'r') as fin:
+    return json.load(fin)['sha256']
+
+
+def write_option_manifest(save_dir: str, max_workers: int = 8):
+  """Writes the content hashes of the option files in `save_dir`.
+
+  Both the packed tables and the individual option policies are hashed, so the
+  manifest must be written after all of them are saved.
+
+  Args:
+    save_dir: The directory with the option files.
+    max_workers: The number of threads reading the files.
+  """
+  filenames = [
+      filename for filename in (
+          OPTION_ACTIONS_FILENAME, OPTION_TIES_FILENAME,
+          *map(option_policy_filename, Options))
+      if os.path.exists(os.path.join(save_dir, filename))]
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    contents = executor.map(
+        _read_file, [os.path.join(save_dir, f) for f in filenames])
+    digests = dict(zip(filenames, map(_sha256, contents)))
+  with open(os.path.join(save_dir, OPTION_MANIFEST_FILENAME), 'w') as fout:
+    json.dump({'sha256': digests}, fout, indent=2, sort_keys=True)
+  logging.info('Wrote the hashes of %d option files to %s',
+               len(digests), save_dir)
+
+
+def _option_files_signature(save_dir: str) -> Tuple[Tuple[str, int, int], ...]:
+  """Returns the name, modification time and size of the files to hash."""
+  if os.path.exists(os.path.join(save_dir, OPTION_MANIFEST_FILENAME)):
+    filenames = (OPTION_MANIFEST_FILENAME,)
+  else:
+    filenames = _option_filenames(save_dir)
+  signature = []
+  for filename in filenames:
+    stat = os.stat(os.path.join(save_dir, filename))
+    signature.append((filename, stat.st_mtime_ns, stat.st_size))
+  return tuple(signature)
+
+
+def option_policies_digest(save_dir: str, max_workers: int = 8) -> str:
+  """Returns a hash identifying the content of the options in `save_dir`.
+
+  With a manifest only the manifest is read. Otherwise every option file that
+  `load_option_policies` would load is read and hashed. Files are only read
+  again once their modification time or size changes.
+
+  Args:
+    save_dir: The directory with the option files.
+    max_workers: The number of threads reading the files.
+  """
+  return _option_policies_digest(
+      save_dir, _option_files_signature(save_dir), max_workers)
+
+
+@functools.lru_cache(maxsize=16)
+def _option_policies_digest(
+    save_dir: str,
+    signature: Tuple[Tuple[str, int, int], ...],
+    max_workers: int,
+    ) -> str:
+  """Computes `option_policies_digest` for a signature of the files."""
+  filenames = [filename for filename, _, _ in signature]
+  if filenames == [OPTION_MANIFEST_FILENAME]:
+    return _sha256(_read_file(os.path.join(save_dir, OPTION_MANIFEST_FILENAME)))
+  logging.warning('No option manifest in %s, hashing the option files.',
+                  save_dir)
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    digests = executor.map(
+        lambda f: _sha256(_read_file(os.path.join(save_dir, f))), filenames)
+    return _sha256('\n'.join(
+        f'{f}:{digest}' for f, digest in zip(filenames, digests)).encode())
+
+
+def load_option_policies(
+    save_dir: str,
+    packed: bool = True,
+    max_workers: int = 8,
+    ) -> PackedOptionPolicies:
+  """Loads the options saved in `save_dir`.
+
+  The packed tables are memory-mapped if they were saved, see
+  `load_packed_option_policies`. Otherwise the individual option policies are
+  read in parallel and packed. Files listed in the manifest, if there is one,
+  are checked against their content hash.
+
+  Args:
+    save_dir: The directory with the option files.
+    packed: If False, the individual option policies are loaded even if the
+      packed tables were saved.
+    max_workers: The number of threads reading the individual option policies.
+
+  Returns:
+    The packed option policies.
+
+  Raises:
+    ValueError: If a file does not match the manifest, or if the packed tables
+      do not have the shapes of the taxi options.
+  """
+  manifest = _read_option_manifest(save_dir)
+  filenames = _option_filenames(save_dir, packed)
+
+  def check(filename: str, digest: str):
+    if manifest is None:
+      return
+    if filename not in manifest:
+      raise ValueError(f'{filename} is not in the manifest of {save_dir}.')
+    if digest != manifest[filename]:
+      raise ValueError(
+          f'{filename} in {save_dir} does not match its hash in the manifest.')
+
+  if filenames[0] == OPTION_ACTIONS_FILENAME:
+    if manifest is not None and OPTION_TIES_FILENAME in manifest:
+      if OPTION_TIES_FILENAME not in filenames:
+        raise ValueError(f'{OPTION_TIES_FILENAME} is missing in {save_dir}.')
+    tables = []
+    for filename in filenames:
+      table, digest = _map_npy(os.path.join(save_dir, filename))
+      check(filename, digest)
+      tables.append(table)
+    actions, ties = (tables + [None])[:2]
+    return _check_packed_option_policies(actions, ties)
+
+  def load(filename: str) -> np.ndarray:
+    content = _read_file(os.path.join(save_dir, filename))
+    check(filename, _sha256(content))
+    return np.load(io.BytesIO(content), allow_pickle=True)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    tables = list(executor.map(load, filenames))
+  logging.info('Loaded %d option policies from %s', len(tables), save_dir)
+  return pack_option_policies(dict(zip(Options, tables)))
+
+
+def compute_option_model(
+    option_policies: Union[Dict[Options, np.ndarray], PackedOptionPolicies],
+    max_option_length: Optional[int] = 100,
+    ) -> Dict[str, np.ndarray]:
+  """Computes the exact option model of a set of option policies.
+
+  Executing an option is a Markov chain over states that is absorbed when the
+  option or the environment terminates. Its transitions, expected lengths and
+  expected rewards are obtained by propagating the state distribution for
+  `max_option_length` steps, or by solving the linear system of the absorbing
+  chain when there is no maximum length. Ties in an option policy are broken
+  uniformly at random, as in `data.get_trajectories`.
+
+  Args:
+    option_policies: A dictionary mapping every option to its |S| x |A| table,
+      or the packed option policies.
+    max_option_length: Executions are cut off after this many steps. If None,
+      every option must terminate with probability 1 from every state.
+
+  Returns:
+    A dictionary with the same entries as the option model tables used in
+    evaluation:
+      - transitions: The |S| x |O| x |S| option transition table.
+      - rewards: The |S| x |O| table of the expected sum of rewards.
+      - lengths: The |S| x |O| table of the expected length of execution.
+  """
+  option_policies = as_packed_option_policies(option_policies)
+  if option_policies.ties is None:
+    ties = np.eye(env_utils.NUM_ACTIONS, dtype=bool)[option_policies.actions.T]
+  else:
+    ties = np.moveaxis(option_policies.ties, 1, 0)
+  action_probabilities = ties / ties.sum(-1, keepdims=True)
+  num_options = ties.shape[0]
+  num_states, num_actions = _NEXT_STATES.shape
+  num_pairs = num_options * num_states
+
+  # The chains of all options are solved together as one chain over (option,
+  # state) pairs, with row o * |S| + s for state s while executing option o.
+  stops = _DONES | np.moveaxis(OPTION_TERMINATION_TABLE, -1, 0)
+  rows = np.repeat(np.arange(num_pairs), num_actions)
+  next_states = np.broadcast_to(_NEXT_STATES, stops.shape)
+  next_pairs = np.arange(num_options)[:, None, None] * num_states + next_states
+  # Duplicate entries are summed when several actions lead to the same state.
+  continue_matrix = scipy.sparse.csr_matrix(
+      ((action_probabilities * ~stops).ravel(), (rows, next_pairs.ravel())),
+      shape=(num_pairs, num_pairs))
+  stop_matrix = scipy.sparse.csr_matrix(
+      ((action_probabilities * stops).ravel(), (rows, next_states.ravel())),
+      shape=(num_pairs, num_states))
+  step_rewards = np.sum(action_probabilities * _REWARDS, axis=-1).ravel()
+
+  if max_option_length is None:
+    solve = scipy.sparse.linalg.splu(
+        (scipy.sparse.identity(num_pairs) - continue_matrix).tocsc()).solve
+    transitions = solve(stop_matrix.toarray())
+    rewards = solve(step_rewards)
+    lengths = solve(np.ones(num_pairs))
+  else:
+    # Distribution over the current (option, state) pair of executions that are
+    # still running, one row per initial pair.
+    running = scipy.sparse.identity(num_pairs, format='csr')
+    transitions = scipy.sparse.csr_matrix((num_pairs, num_states))
+    rewards = np.zeros(num_pairs)
+    lengths = np.zeros(num_pairs)
+    for _ in range(max_option_length):
+      lengths += np.asarray(running.sum(-1)).ravel()
+      rewards += running @ step_rewards
+      transitions = transitions + running @ stop_matrix
+      running = running @ continue_matrix
+      if not running.nnz:
+        break
+    # Executions that reach the maximum length end where they are.
+    pair_to_state = scipy.sparse.csr_matrix(
+        (np.ones(num_pairs), (np.arange(num_pairs), np.tile(
+            np.arange(num_states), num_options))),
+        shape=(num_pairs, num_states))
+    transitions = (transitions + running @ pair_to_state).toarray()
+
+  return {
+      'transitions': np.swapaxes(
+          transitions.reshape(num_options, num_states, num_states), 0, 1),
+      'rewards': rewards.reshape(num_options, num_states).T,
+      'lengths': lengths.reshape(num_options, num_states).T,
+  }
+
+
+def option_model_errors(
+    option_model: Dict[str, np.ndarray],
+    reference_option_model: Dict[str, np.ndarray],
+    affordances_mask: Optional[np.ndarray] = None,
+    ) -> Dict[str, float]:
+  """Measures how far an option model is from a reference model.
+
+  Args:
+    option_model: The option model tables, e.g. of a learned model.
+    reference_option_model: The tables to compare to, e.g. from
+      `compute_option_model`.
+    affordances_mask: If given, only affordable (state, option) pairs of this
+      |S| x |O| mask are compared.
+
+  Returns:
+    The mean and max total variation distance between the transitions and the
+    mean absolute errors of the rewards and lengths.
+  """
+  transitions = option_model['transitions']
+  reference_transitions = reference_option_model['transitions']
+  if transitions.shape != reference_transitions.shape:
+    raise ValueError(
+        f'Option transition tables have different shapes '
+        f'{transitions.shape} and {reference_transitions.shape}.')
+  # Compared one option at a time to avoid another |S| x |O| x |S| array.
+  total_variation = np.stack([
+      0.5 * np.abs(
+          transitions[:, option_index] -
+          reference_transitions[:, option_index]).sum(-1)
+      for option_index in range(transitions.shape[1])], axis=1)
+  if affordances_mask is None:
+    compared = np.ones(total_variation.shape, dtype=bool)
+  else:
+    compared = affordances_mask > 0
+
+  return {
+      'transition_tv_mean': float(np.mean(total_variation[compared])),
+      'transition_tv_max': float(np.max(total_variation[compared])),
+      'reward_mae': float(np.mean(np.abs(
+          option_model['rewards'] - reference_option_model['rewards'])[
+              compared])),
+      'length_mae': float(np.mean(np.abs(
+          option_model['lengths'] - reference_option_model['lengths'])[
+              compared])),
+  }
+
+
+def make_option_planning_problem(
+    option_reward: np.ndarray,
+    option_transition: rl.TransitionMatrix,
+    option_length: np.ndarray,
+    gamma: float = rl.DEFAULT_GAMMA,
     affordances_fn: Optional[affordances.AffordancesFn] = None,
-    writer=None,
-    ) -> Tuple[np.ndarray, int]:
-  """Learns the policy over option policies.
+    ) -> rl.PlanningProblem:
+  """Checks an option model and prepares the MDP over options for planning.
 
   Args:
     option_reward: Reward matrix of shape |S| x |O| that determines the
       environment reward for every state option pair.
     option_transition: Transition matrix of shape |S| x |O| x |S| that
-      determines the transition state after executing an option in a state.
+      determines the transition state after executing an option in a state. It
+      can also be given as a sparse (|S| * |O|) x |S| matrix, see
+      `rl.to_sparse_transition_matrix`. It is not modified.
     option_length: Length matrix of shape |S| x |O| that determines the
       Length of execution for every state option pair.
-    gamma: Discount factor in VI.
-    stopping_threshold: Stop if the change in value is less than this value.
-    max_iterations: Maximum number of iterations to run VI.
-    seed: For tie-breaking.
+    gamma: Discount factor per step. Options are discounted by their length.
     affordances_fn: Affordances and relevant masking for the bellman update.
-    writer: An optional writer to save data.
 
   Returns:
-    pi_star: Policy over options, |S| x |O|.
+    The `rl.PlanningProblem` over options.
   """
   if option_length.min() < 1:
     logging.error(
@@ -200,35 +731,103 @@ def learn_policy_over_options(
         np.where(option_length < 1)[0],
         option_length[option_length < 1])
     option_length = np.clip(option_length, 1, 100)
-  if np.any(option_transition.sum(-1).round(2) > 1):
+  num_states, num_options = option_reward.shape
+  if scipy.sparse.issparse(option_transition):
+    row_sums = np.asarray(option_transition.sum(-1)).ravel()
+    probabilities = option_transition.data
+    expected_shape = (num_states * num_options, num_states)
+  else:
+    row_sums = option_transition.sum(-1)
+    probabilities = option_transition
+    expected_shape = (num_states, num_options, num_states)
+  if np.any(row_sums.round(2) > 1):
     raise ValueError(
         'At least one probability distribution from a (state, option) pair '
         'had a sum > 1.')
-  if not (np.all(option_transition <= 1) and np.all(option_transition >= 0)):
+  if not (np.all(probabilities <= 1) and np.all(probabilities >= 0)):
     raise ValueError(
         'At least one transitition probability is not between (0, 1).')
 
   gamma = gamma ** option_length
-  num_states, num_options = option_reward.shape
-  if option_transition.shape != (num_states, num_options, num_states):
+  if option_transition.shape != expected_shape:
     raise ValueError(
         f'Option transition matrix has shape {option_transition.shape}. '
-        f'Expected {(num_states, num_options, num_states)}')
+        f'Expected {expected_shape}')
   if gamma.shape != (num_states, num_options):
     raise ValueError(
         f'gamma matrix has shape {gamma.shape}. '
         f'Expected {(num_states, num_options)}')
 
-  V_star, _, num_iters = rl.value_iteration(  # pylint: disable=invalid-name
-      reward_matrix=option_reward,
-      transition_matrix=option_transition,
+  return rl.make_planning_problem(
+      option_reward, option_transition, gamma=gamma,
+      affordances_fn=affordances_fn)
+
+
+def learn_policy_over_options(
+    option_reward: np.ndarray,
+    option_transition: rl.TransitionMatrix,
+    option_length: np.ndarray,
+    gamma: float = rl.DEFAULT_GAMMA,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 10000,
+    seed: Optional[int] = None,
+    affordances_fn: Optional[affordances.AffordancesFn] = None,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    solver: str = 'value_iteration',
+    factored: bool = False,
+    ) -> Tuple[np.ndarray, int, np.ndarray]:
+  """Learns the policy over option policies.
+
+  Args:
+    option_reward: Reward matrix of shape |S| x |O| that determines the
+      environment reward for every state option pair.
+    option_transition: Transition matrix of shape |S| x |O| x |S| that
+      determines the transition state after executing an option in a state. It
+      can also be given as a sparse (|S| * |O|) x |S| matrix, see
+      `rl.to_sparse_transition_matrix`. It is not modified.
+    option_length: Length matrix of shape |S| x |O| that determines the
+      Length of execution for every state option pair.
+    gamma: Discount factor in VI.
+    stopping_threshold: Stop if the change in value is less than this value.
+    max_iterations: Maximum number of iterations to run VI.
+    seed: For tie-breaking.
+    affordances_fn: Affordances and relevant masking for the bellman update.
+    writer: An optional writer to save data.
+    initial_values: Values of shape |S| to warm start VI from. Defaults to
+      zeros.
+    solver: The name of the planner in `rl.SOLVERS` to use instead of VI.
+    factored: Solve the MDP of every destination independently, see
+      `rl.factored_solve`. Probability mass the option model puts on other
+      destinations is ignored. Cannot be used with a writer.
+
+  Returns:
+    pi_star: Policy over options, |S| x |O|.
+    num_iters: The number of iterations VI took.
+    V_star: The values of shape |S| found by VI. Pass these as
+      `initial_values` when re-planning with an updated option model.
+  """
+  if solver not in rl.SOLVERS:
+    raise ValueError(
+        f'Unknown solver {solver}. Valid: {list(rl.SOLVERS)}')
+  if factored and writer is not None:
+    raise ValueError('A writer cannot be used with a factored solve.')
+  problem = make_option_planning_problem(
+      option_reward, option_transition, option_length, gamma=gamma,
+      affordances_fn=affordances_fn)
+
+  solver_kwargs = {}
+  if factored:
+    solver_kwargs['blocks'] = env_utils.DESTINATION_BLOCKS
+  else:
+    solver_kwargs['writer'] = writer
+  V_star, _, num_iters = rl.solve_planning_problem(  # pylint: disable=invalid-name
+      problem,
+      solver=solver,
       max_iterations=max_iterations,
       stopping_threshold=stopping_threshold,
-      affordances_fn=affordances_fn,
-      gamma=gamma,
-      writer=writer)
-  pi_star = rl.extract_greedy_policy(
-      option_reward, option_transition, V_star, gamma=gamma, seed=seed,
-      affordances_fn=affordances_fn)
+      initial_values=initial_values,
+      **solver_kwargs)
+  pi_star = rl.extract_greedy_policy_from_problem(problem, V_star, seed=seed)
 
-  return pi_star, num_iters
+  return pi_star, num_iters, V_star
@@ -15,8 +15,14 @@
 
 """Tests for option_utils."""
 
+import os
+import tempfile
+from unittest import mock
+
 from absl.testing import absltest
 from absl.testing import parameterized
+import numpy as np
+from affordances_option_models import data
 from affordances_option_models import definitions
 from affordances_option_models import env_utils
 from affordances_option_models import option_utils
@@ -30,6 +36,11 @@ ActionMap = definitions.ActionMap
 
 class OptionUtilsTest(parameterized.TestCase):
 
+  def _make_tempdir(self):
+    tempdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tempdir.cleanup)
+    return tempdir.name
+
   def test_number_of_options(self):
     self.assertLen(option_utils.Options, 75)
     self.assertLen(option_utils.OptionsDropping, 25)
@@ -203,6 +214,228 @@ class OptionUtilsTest(parameterized.TestCase):
         option_utils.check_option_termination(taxi_state, action, option),
         outcome)
 
+  def test_option_info(self):
+    self.assertEqual(
+        option_utils.OPTION_INFO[Options.GoTo8_Any],
+        (option_utils.OptionKind.ANY, 8, (1, 3)))
+    self.assertEqual(
+        option_utils.OPTION_INFO[Options.GoTo24_Drop],
+        (option_utils.OptionKind.DROP, 24, (4, 4)))
+    self.assertEqual(
+        option_utils.OPTION_INFO[Options.GoTo0_Pickup],
+        (option_utils.OptionKind.PICKUP, 0, (0, 0)))
+
+  def test_termination_table_matches_definition(self):
+    next_states, _, _ = env_utils.get_transition_tables()
+    for option in Options:
+      option_info = option_utils.OPTION_INFO[option]
+      for s_t in range(env_utils.NUM_STATES):
+        passenger_inside = (
+            env_utils.int_to_state_fn(s_t).passenger_status ==
+            env_utils.PASSENGER_INSIDE_CAR_STATUS)
+        for a_t in range(env_utils.NUM_ACTIONS):
+          s_tp1 = env_utils.int_to_state_fn(next_states[s_t, a_t])
+          expected = (s_tp1.row, s_tp1.col) == option_info.target_xy
+          if option in OptionsDropping:
+            expected &= a_t == ActionMap.DROP and passenger_inside
+          if option in OptionsPicking:
+            expected &= a_t == ActionMap.PICKUP and not passenger_inside
+          self.assertEqual(
+              option_utils.OPTION_TERMINATION_TABLE[
+                  s_t, a_t, option.value - 1], expected)
+
+  def test_compute_per_step_matrices_for_all_options(self):
+    rewards, masks = option_utils.compute_per_step_matrices_for_all_options(
+        r_option_completion=2.0, r_other=-1.0)
+    self.assertEqual(
+        rewards.shape,
+        (len(Options), env_utils.NUM_STATES, env_utils.NUM_ACTIONS))
+    for option in Options:
+      expected_rewards, expected_masks = (
+          option_utils.compute_per_step_matrices_for_option_learning(
+              option, r_option_completion=2.0, r_other=-1.0))
+      np.testing.assert_array_equal(
+          rewards[option.value - 1], expected_rewards)
+      np.testing.assert_array_equal(masks[option.value - 1], expected_masks)
+
+  def test_learn_option_policies_matches_learn_option_policy(self):
+    options = (Options.GoTo0_Any, Options.GoTo12_Any, Options.GoTo24_Any)
+    pi_stars, num_iters = option_utils.learn_option_policies(
+        options, max_iterations=1000, seed=1)
+    next_states, _, _ = env_utils.get_transition_tables()
+    for option in options:
+      _, expected_num_iters = option_utils.learn_option_policy(
+          option, max_iterations=1000, seed=1)
+      self.assertEqual(num_iters[option], expected_num_iters)
+      # Following the learned policy from any state must reach the target.
+      # Transitions out of goal states are masked out during learning.
+      for state in set(range(env_utils.NUM_STATES)) - set(
+          env_utils.GOAL_STATES):
+        for _ in range(20):
+          action = pi_stars[option][state].argmax()
+          if option_utils.check_option_termination(state, action, option):
+            break
+          state = next_states[state, action]
+        else:
+          self.fail(f'{option} did not terminate.')
+
+  def test_compute_option_model_matches_option_outcomes(self):
+    option_policies, _ = option_utils.learn_option_policies(
+        max_iterations=1000, stopping_threshold=1e-5, seed=1)
+    option_model = option_utils.compute_option_model(
+        option_policies, max_option_length=10)
+    outcomes = data.compile_option_outcomes(
+        option_policies, max_option_length=10)
+    expected_transitions = np.eye(env_utils.NUM_STATES)[
+        outcomes.final_states[..., 0]]
+    np.testing.assert_array_equal(
+        option_model['transitions'], expected_transitions)
+    np.testing.assert_array_equal(
+        option_model['lengths'], outcomes.lengths[..., 0])
+    np.testing.assert_array_equal(
+        option_model['rewards'], outcomes.rewards[..., 0])
+
+    errors = option_utils.option_model_errors(option_model, option_model)
+    self.assertEqual(set(errors.values()), {0.0})
+    perturbed_model = dict(
+        option_model, lengths=option_model['lengths'] + 1,
+        transitions=np.full_like(
+            option_model['transitions'], 1 / env_utils.NUM_STATES))
+    errors = option_utils.option_model_errors(perturbed_model, option_model)
+    self.assertAlmostEqual(errors['length_mae'], 1.0)
+    self.assertAlmostEqual(
+        errors['transition_tv_max'], 1 - 1 / env_utils.NUM_STATES)
+
+  def test_compute_option_model_without_maximum_length(self):
+    uniform_policies = {
+        option: np.ones((env_utils.NUM_STATES, env_utils.NUM_ACTIONS))
+        for option in Options}
+    option_model = option_utils.compute_option_model(
+        uniform_policies, max_option_length=None)
+    np.testing.assert_allclose(option_model['transitions'].sum(-1), 1)
+    # The expected length is one step plus the expected length from wherever
+    # the option continues.
+    next_states, _, dones = env_utils.get_transition_tables()
+    option = Options.GoTo12_Any
+    continues = ~(dones | option_utils.OPTION_TERMINATION_TABLE[
+        :, :, option.value - 1])
+    lengths = option_model['lengths'][:, option.value - 1]
+    np.testing.assert_allclose(
+        lengths, 1 + np.mean(continues * lengths[next_states], axis=-1))
+
+  def test_factored_policy_over_options_rejects_writer(self):
+    shape = (env_utils.NUM_STATES, len(Options))
+    with self.assertRaisesRegex(ValueError, 'writer'):
+      option_utils.learn_policy_over_options(
+          option_reward=np.zeros(shape),
+          option_transition=np.zeros(shape + (env_utils.NUM_STATES,)),
+          option_length=np.ones(shape),
+          factored=True,
+          writer=object())
+
+  @parameterized.parameters(True, False)
+  def test_packed_option_policies_round_trip(self, with_ties):
+    rng = np.random.default_rng(0)
+    # Distinct values in every row so that there are only the ties added below.
+    option_policies = {
+        option: np.stack([
+            rng.permutation(env_utils.NUM_ACTIONS).astype(np.float64)
+            for _ in range(env_utils.NUM_STATES)])
+        for option in Options}
+    if with_ties:
+      option_policies[Options.GoTo0_Any][3] = [5, 0, 5, 0, 0, 5]
+    packed = option_utils.pack_option_policies(option_policies)
+    self.assertEqual(
+        packed.actions.shape, (env_utils.NUM_STATES, len(Options)))
+    self.assertEqual(packed.actions.dtype, np.uint8)
+    self.assertEqual(packed.ties is not None, with_ties)
+    stacked = option_utils.stack_option_policies(option_policies)
+    np.testing.assert_array_equal(packed.actions, np.argmax(stacked, -1).T)
+
+    save_dir = self._make_tempdir()
+    option_utils.save_packed_option_policies(save_dir, packed)
+    loaded = option_utils.load_packed_option_policies(save_dir)
+    self.assertIsInstance(loaded.actions, np.memmap)
+    np.testing.assert_array_equal(loaded.actions, packed.actions)
+    self.assertEqual(loaded.ties is not None, with_ties)
+
+    # The legacy tables have the same maximal actions as the originals.
+    for option, table in loaded.to_dict().items():
+      np.testing.assert_array_equal(
+          np.isclose(table, table.max(-1, keepdims=True)),
+          np.isclose(option_policies[option],
+                     option_policies[option].max(-1, keepdims=True)))
+
+  def test_load_packed_option_policies_without_files(self):
+    with self.assertRaises(FileNotFoundError):
+      option_utils.load_packed_option_policies(
+          self._make_tempdir())
+
+  def test_load_option_policies_checks_manifest(self):
+    rng = np.random.default_rng(0)
+    option_policies = {
+        option: np.eye(env_utils.NUM_ACTIONS)[
+            rng.integers(env_utils.NUM_ACTIONS, size=env_utils.NUM_STATES)]
+        for option in Options}
+    save_dir = self._make_tempdir()
+    for option, option_policy in option_policies.items():
+      with open(os.path.join(
+          save_dir, option_utils.option_policy_filename(option)), 'wb') as fout:
+        np.save(fout, option_policy)
+    expected_actions = option_utils.pack_option_policies(
+        option_policies).actions
+    legacy_digest = option_utils.option_policies_digest(save_dir)
+    np.testing.assert_array_equal(
+        option_utils.load_option_policies(save_dir).actions, expected_actions)
+
+    option_utils.save_packed_option_policies(
+        save_dir, option_utils.load_option_policies(save_dir))
+    option_utils.write_option_manifest(save_dir)
+    digest = option_utils.option_policies_digest(save_dir)
+    self.assertNotEqual(digest, legacy_digest)
+    loaded = option_utils.load_option_policies(save_dir)
+    self.assertIsInstance(loaded.actions, np.memmap)
+    np.testing.assert_array_equal(loaded.actions, expected_actions)
+    np.testing.assert_array_equal(
+        option_utils.load_option_policies(save_dir, packed=False).actions,
+        expected_actions)
+
+    # The digest is only computed again once the files change.
+    with mock.patch.object(
+        option_utils, '_read_file', wraps=option_utils._read_file) as read:
+      self.assertEqual(option_utils.option_policies_digest(save_dir), digest)
+    read.assert_not_called()
+
+    # Files that were changed after the manifest was written are rejected.
+    changed_actions = expected_actions.copy()
+    changed_actions[0, 0] += 1
+    option_utils.save_packed_option_policies(
+        save_dir, option_utils.PackedOptionPolicies(changed_actions))
+    with self.assertRaisesRegex(ValueError, 'does not match'):
+      option_utils.load_option_policies(save_dir)
+    wrong_shape = option_utils.PackedOptionPolicies(expected_actions[:-1])
+    option_utils.save_packed_option_policies(save_dir, wrong_shape)
+    option_utils.write_option_manifest(save_dir)
+    with self.assertRaisesRegex(ValueError, 'shape'):
+      option_utils.load_option_policies(save_dir)
+    option_utils.save_packed_option_policies(
+        save_dir, option_utils.PackedOptionPolicies(changed_actions))
+    option_utils.write_option_manifest(save_dir)
+    self.assertNotEqual(option_utils.option_policies_digest(save_dir), digest)
+    np.testing.assert_array_equal(
+        option_utils.load_option_policies(save_dir).actions, changed_actions)
+
+  def test_compute_option_model_from_packed_option_policies(self):
+    option_policies, _ = option_utils.learn_option_policies(
+        max_iterations=1000, stopping_threshold=1e-5, seed=1)
+    option_model = option_utils.compute_option_model(
+        option_policies, max_option_length=10)
+    packed_option_model = option_utils.compute_option_model(
+        option_utils.pack_option_policies(option_policies),
+        max_option_length=10)
+    for key, table in option_model.items():
+      np.testing.assert_array_equal(packed_option_model[key], table)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -14,17 +14,30 @@
 # ==============================================================================
 
 """Reinforcement learning functions."""
+import concurrent.futures
 import datetime
-from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from absl import logging
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 from affordances_option_models import affordances
 from affordances_option_models import env_utils
+from affordances_option_models import seeding
+from affordances_option_models import stats_utils
+from affordances_option_models import tracing
 
 DEFAULT_GAMMA = 0.99
 
+# Transitions can be given in one of three representations:
+# 1. A dense |S| x |A| x |S| array of probabilities.
+# 2. An integer |S| x |A| array of next states for deterministic transitions.
+# 3. A sparse (|S| * |A|) x |S| matrix of probabilities where row s * |A| + a
+#    is the distribution over next states after taking action a in state s.
+TransitionMatrix = Union[np.ndarray, scipy.sparse.spmatrix]
+
 
 class Transition(NamedTuple):
   """Container storing the transition for tensorflow."""
@@ -38,24 +51,207 @@ class Transition(NamedTuple):
 Trajectory = List[Transition]
 
 
-def _compute_q_v(
-    reward_matrix, gamma, transition_matrix, values, affordance_mask=None):
-  """Computes Q-value."""
+def get_num_states_and_actions(
+    transition_matrix: TransitionMatrix) -> Tuple[int, int]:
+  """Returns the number of states and actions of a transition matrix."""
+  if scipy.sparse.issparse(transition_matrix):
+    num_rows, num_states = transition_matrix.shape
+    if num_rows % num_states:
+      raise ValueError(
+          f'Sparse transition matrix has shape {transition_matrix.shape}. '
+          'Expected (|S| * |A|, |S|).')
+    return num_states, num_rows // num_states
+  if transition_matrix.ndim == 3:
+    num_states, num_actions, _ = transition_matrix.shape
+    return num_states, num_actions
+  if (transition_matrix.ndim == 2 and
+      np.issubdtype(transition_matrix.dtype, np.integer)):
+    return transition_matrix.shape
+  raise ValueError(
+      f'Unknown transition matrix with shape {transition_matrix.shape} and '
+      f'dtype {transition_matrix.dtype}.')
+
+
+def to_sparse_transition_matrix(
+    transition_matrix: TransitionMatrix,
+    min_probability: float = 0.0,
+    ) -> scipy.sparse.csr_matrix:
+  """Converts a transition matrix into the sparse representation.
+
+  Args:
+    transition_matrix: Transition matrix in any supported representation.
+    min_probability: Probabilities less than or equal to this are dropped. This
+      is useful for learned models that put a tiny probability everywhere.
+
+  Returns:
+    A (|S| * |A|) x |S| sparse matrix.
+  """
+  num_states, num_actions = get_num_states_and_actions(transition_matrix)
+  if scipy.sparse.issparse(transition_matrix):
+    sparse_matrix = scipy.sparse.csr_matrix(transition_matrix)
+  elif transition_matrix.ndim == 2:
+    sparse_matrix = scipy.sparse.csr_matrix(
+        (np.ones(num_states * num_actions), transition_matrix.ravel(),
+         np.arange(num_states * num_actions + 1)),
+        shape=(num_states * num_actions, num_states))
+  else:
+    sparse_matrix = scipy.sparse.csr_matrix(
+        transition_matrix.reshape(num_states * num_actions, num_states))
+  if min_probability > 0:
+    sparse_matrix.data[sparse_matrix.data <= min_probability] = 0
+    sparse_matrix.eliminate_zeros()
+  return sparse_matrix
 
+
+class PlanningProblem(NamedTuple):
+  """An MDP that has been prepared for planning, see `make_planning_problem`.
+
+  The arrays of a problem are read-only, so the same problem can be shared by
+  every Bellman backup of a solve, by different solvers and by repeated plans.
+  """
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  reward_matrix: np.ndarray  # Rewards of shape |S| x |A|.
+  transition_matrix: TransitionMatrix  # In any supported representation.
+  # Discounts of shape |S| x |A|. They are zero in terminal states so that
+  # nothing is bootstrapped from there.
+  discount_matrix: np.ndarray
+  # Boolean mask of shape |S| x |A| of the affordable actions, or None if every
+  # action is affordable.
+  affordances_mask: Optional[np.ndarray]
+
+  @property
+  def num_states(self) -> int:
+    return self.reward_matrix.shape[0]
+
+  @property
+  def num_actions(self) -> int:
+    return self.reward_matrix.shape[1]
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+  """Returns a read-only view of an array without copying it."""
+  array = np.asarray(array).view()
+  array.flags.writeable = False
+  return array
+
+
+def _get_discount_matrix(
+    gamma: Union[float, np.ndarray],
+    shape: Tuple[int, ...],
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    ) -> np.ndarray:
+  """Broadcasts gamma to `shape` (..., |S|, |A|) and masks terminal states."""
+  discount_matrix = np.array(np.broadcast_to(gamma, shape), dtype=np.float64)
   # All transitions out of the goal state should be masked out since you cannot
   # actually _start_ your trajectories here and the environment terminates once
   # you get here.
-  # TODO(zaf): Do this in a nicer way by doing a transition_matrix.copy() or
-  # doing this masking somewhere else.
-  transition_matrix[env_utils.GOAL_STATES, :] = 0
+  discount_matrix[..., list(terminal_states), :] = 0
+  return discount_matrix
 
-  q_values = reward_matrix + gamma * np.einsum(
-      'ijk,k->ij', transition_matrix, values)
 
-  if affordance_mask is not None:
+def make_planning_problem(
+    reward_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    affordances_fn: Optional[affordances.AffordancesFn] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    ) -> PlanningProblem:
+  """Checks an MDP and prepares it for planning.
+
+  The masking of terminal states, the affordances mask and the discounts are
+  computed once here instead of on every Bellman backup. The transition matrix
+  is neither copied nor modified.
+
+  Args:
+    reward_matrix: Array of shape |S| x |A|.
+    transition_matrix: Transition matrix in any supported representation, see
+      `value_iteration`.
+    gamma: Discount factor. If this is a matrix, it must be of shape |S| x |A|.
+    affordances_fn: A function that returns the affordances mask.
+    terminal_states: States from which no value is bootstrapped.
+
+  Returns:
+    The prepared `PlanningProblem`.
+  """
+  num_states, num_actions = get_num_states_and_actions(transition_matrix)
+  if reward_matrix.shape != (num_states, num_actions):
+    raise ValueError(
+        f'Reward matrix ({reward_matrix.shape})has an incompatible shape to '
+        f'transition matrix ({transition_matrix.shape})')
+
+  if scipy.sparse.issparse(transition_matrix):
+    # Converting is free when the matrix already is in CSR format.
+    transition_matrix = scipy.sparse.csr_matrix(transition_matrix)
+  else:
+    transition_matrix = _read_only(transition_matrix)
+
+  affordances_mask = None
+  if affordances_fn is not None:
+    affordances_mask = np.asarray(affordances_fn()) > 0
+    if affordances_mask.shape != (num_states, num_actions):
+      raise ValueError(
+          f'Affordances mask has shape {affordances_mask.shape}. '
+          f'Expected {(num_states, num_actions)}')
+    affordances_mask = _read_only(affordances_mask)
+
+  return PlanningProblem(
+      reward_matrix=_read_only(np.array(reward_matrix, dtype=np.float64)),
+      transition_matrix=transition_matrix,
+      discount_matrix=_read_only(_get_discount_matrix(
+          gamma, (num_states, num_actions), terminal_states)),
+      affordances_mask=affordances_mask)
+
+
+def _expected_next_values(
+    transition_matrix: TransitionMatrix,
+    values: np.ndarray,
+    ) -> np.ndarray:
+  """Computes sum_s' P(s' | s, a) V(s') for every (s, a) pair.
+
+  Args:
+    transition_matrix: Transition matrix in any supported representation.
+    values: Values of shape |S| or a batch of values of shape B x |S|.
+
+  Returns:
+    Expected next values of shape |S| x |A| (or B x |S| x |A|).
+  """
+  num_states, num_actions = get_num_states_and_actions(transition_matrix)
+  if scipy.sparse.issparse(transition_matrix):
+    return np.reshape(
+        (transition_matrix @ values.T).T,
+        values.shape[:-1] + (num_states, num_actions))
+  if transition_matrix.ndim == 2:
+    return values[..., transition_matrix]
+  return np.einsum('ijk,...k->...ij', transition_matrix, values)
+
+
+def random_argmax(values: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+  """Argmax over the last axis with stochastic tie-breaking.
+
+  Every entry that is close to the maximum is picked uniformly at random by
+  taking the argmax of uniform noise over the tied entries. A single draw from
+  `rng` is made for the whole batch.
+
+  Args:
+    values: Array of shape [..., N].
+    rng: Random number generator used to break ties.
+
+  Returns:
+    Array of shape [...] with the index of a maximal entry.
+  """
+  ties = np.isclose(values, values.max(-1, keepdims=True))
+  noise = rng.random(values.shape)
+  return np.argmax(np.where(ties, noise, -1.0), axis=-1)
+
+
+def _compute_q_v(problem: PlanningProblem, values: np.ndarray):
+  """Computes Q-value."""
+  q_values = problem.reward_matrix + problem.discount_matrix * (
+      _expected_next_values(problem.transition_matrix, values))
+
+  if problem.affordances_mask is not None:
     # Set Q-values that are unaffordable to the worst q-value.
-    q_values = (
-        q_values * affordance_mask + (1 - affordance_mask) * np.min(q_values))
+    q_values = np.where(problem.affordances_mask, q_values, np.min(q_values))
 
   values_new = np.max(q_values, axis=1)
   value_diff = np.absolute(values - values_new)
@@ -63,44 +259,122 @@ def _compute_q_v(
   return q_values, values_new, value_diff
 
 
+def _get_initial_values(
+    problem: PlanningProblem,
+    initial_values: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+  """Returns the values to start planning from."""
+  if initial_values is None:
+    return np.zeros(problem.num_states)
+  if np.shape(initial_values) != (problem.num_states,):
+    raise ValueError(
+        f'Initial values have shape {np.shape(initial_values)}. '
+        f'Expected {(problem.num_states,)}')
+  return np.array(initial_values, dtype=np.float64)
+
+
+def _get_policy_chain(
+    problem: PlanningProblem,
+    policy: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, Union[np.ndarray, scipy.sparse.spmatrix]]:
+  """Returns the rewards, discounts and |S| x |S| transitions under a policy."""
+  num_states, num_actions = problem.num_states, problem.num_actions
+  states = np.arange(num_states)
+  reward_pi = problem.reward_matrix[states, policy]
+  gamma_pi = problem.discount_matrix[states, policy]
+  transition_matrix = problem.transition_matrix
+  if scipy.sparse.issparse(transition_matrix):
+    transition_pi = transition_matrix[states * num_actions + policy]
+  elif transition_matrix.ndim == 2:
+    transition_pi = scipy.sparse.csr_matrix(
+        (np.ones(num_states), transition_matrix[states, policy],
+         np.arange(num_states + 1)), shape=(num_states, num_states))
+  else:
+    transition_pi = transition_matrix[states, policy]
+  return reward_pi, gamma_pi, transition_pi
+
+
+def _improve_policy(
+    q_values: np.ndarray, policy: Optional[np.ndarray]) -> np.ndarray:
+  """Greedy policy improvement that keeps the current action on ties."""
+  best_actions = np.argmax(q_values, axis=1)
+  if policy is None:
+    return best_actions
+  states = np.arange(q_values.shape[0])
+  keep = np.isclose(q_values[states, policy], q_values[states, best_actions])
+  return np.where(keep, policy, best_actions)
+
+
+def extract_greedy_policy_from_problem(
+    problem: PlanningProblem,
+    values: np.ndarray,
+    seed: Optional[int] = None,
+    ) -> np.ndarray:
+  """Returns a table containing the best greedy actions in a planning problem."""
+  rng = np.random.default_rng(seed)
+  q_values, _, _ = _compute_q_v(problem, values)
+
+  best_actions = random_argmax(q_values, rng)
+  pi = np.eye(problem.num_actions)[best_actions]
+  assert pi.shape == problem.reward_matrix.shape
+
+  return pi
+
+
 def extract_greedy_policy(
     reward_matrix: np.ndarray,
-    transition_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
     values: np.ndarray,
     gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
     seed: Optional[int] = None,
     affordances_fn: Optional[affordances.AffordancesFn] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
     ) -> np.ndarray:
   """Returns a table containing the best greedy actions to take."""
-  rng = np.random.default_rng(seed)
+  problem = make_planning_problem(
+      reward_matrix, transition_matrix, gamma, affordances_fn, terminal_states)
+  return extract_greedy_policy_from_problem(problem, values, seed)
 
-  if affordances_fn is not None:
-    affordances_mask = affordances_fn()
-  else:
-    affordances_mask = None
-  q_values, _, _ = _compute_q_v(
-      reward_matrix, gamma, transition_matrix, values, affordances_mask)
-
-  # Use "random" argmax with stochastic tie-breaking:
-  rargmax = lambda arr: rng.choice(np.flatnonzero(arr))
-  best_actions = np.apply_along_axis(
-      rargmax, 1, np.isclose(q_values, q_values.max(-1, keepdims=True)))
-  num_states, num_actions = reward_matrix.shape
-  del num_states
-  pi = np.eye(num_actions)[best_actions]
-  assert pi.shape == reward_matrix.shape
 
-  return pi
+def _value_iteration(
+    problem: PlanningProblem,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Value iteration on a prepared problem, see `value_iteration`."""
+  start_time = datetime.datetime.now()
+  values = _get_initial_values(problem, initial_values)
+  for i in range(max_iterations):
+    _, values, value_diff = _compute_q_v(problem, values)
+    if writer is not None:
+      writer.write({
+          'iteration': i, 'max_value': np.max(values),
+          'min_value': np.min(values), 'mean_value': np.mean(values),
+          'mean_diff': np.mean(value_diff), 'max_diff': np.mean(value_diff),
+      })
+    if np.all(value_diff < stopping_threshold):
+      logging.debug('Terminating value iteration: stopping threshold reached.')
+      break
+
+  elapsed = datetime.datetime.now() - start_time
+  logging.info(
+      'Value iteration completed. Value Diff: %s, iterations: %s, time : %s',
+      np.mean(value_diff), i, elapsed)
+  return values, elapsed, i
 
 
 def value_iteration(
     reward_matrix: np.ndarray,
-    transition_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
     gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
     stopping_threshold: float = 0.0001,
     max_iterations: int = 100,
     affordances_fn: Optional[affordances.AffordancesFn] = None,
     writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
     ) -> Tuple[np.ndarray, datetime.timedelta, int]:
   """Obtains the optimal policy for an MDP using value iteration.
 
@@ -108,65 +382,453 @@ def value_iteration(
     reward_matrix: Array of shape |S| x |A| determiniting rewards for a
       transition.
     transition_matrix: Array of shape |S| x |A| x |S| determining the
-      probability of transitioning from (s, a) to s'.
+      probability of transitioning from (s, a) to s'. Deterministic transitions
+      can be given as an integer array of next states of shape |S| x |A| and
+      sparse transitions as a (|S| * |A|) x |S| scipy sparse matrix. Both avoid
+      the cost of a dense backup.
     gamma: Discount factor. If this is a matrix, it must be of shape |S| x |A|.
     stopping_threshold: The minimum change in the values needed to prevent the
       algorithm from stopping early.
     max_iterations: The maximum number of iterations to run value iteration for.
     affordances_fn: A function that returns the list of affordances and a mask.
     writer: Writer to write data.
+    initial_values: Values of shape |S| to start value iteration from, e.g. the
+      values of a previous solve of a similar MDP. Defaults to zeros.
+    terminal_states: States from which no value is bootstrapped, i.e. their
+      outgoing transitions are masked out. Defaults to the taxi goal states.
 
   Returns:
     The values (V_pi of shape |S|) at the end of value iteration.
     The amount of time value iteration was run for.
     The number of iterations value iteration ran for before exiting.
   """
+  problem = make_planning_problem(
+      reward_matrix, transition_matrix, gamma, affordances_fn, terminal_states)
+  return _value_iteration(
+      problem, stopping_threshold, max_iterations, writer, initial_values)
+
+
+def _policy_iteration(
+    problem: PlanningProblem,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Policy iteration on a prepared problem, see `policy_iteration`."""
+  del stopping_threshold  # Unused.
   start_time = datetime.datetime.now()
-  num_states, num_actions, _ = transition_matrix.shape
-  if reward_matrix.shape != (num_states, num_actions):
-    raise ValueError(
-        f'Reward matrix ({reward_matrix.shape})has an incompatible shape to '
-        f'transition matrix ({transition_matrix.shape})')
+  values = _get_initial_values(problem, initial_values)
+  num_states = problem.num_states
+  policy = None
+  for i in range(max_iterations):
+    q_values, _, _ = _compute_q_v(problem, values)
+    new_policy = _improve_policy(q_values, policy)
+    num_changes = (
+        num_states if policy is None else np.count_nonzero(new_policy != policy))
+    if writer is not None:
+      writer.write({
+          'iteration': i, 'max_value': np.max(values),
+          'min_value': np.min(values), 'mean_value': np.mean(values),
+          'num_policy_changes': num_changes,
+      })
+    if num_changes == 0:
+      logging.debug('Terminating policy iteration: policy is stable.')
+      break
+    policy = new_policy
+    reward_pi, gamma_pi, transition_pi = _get_policy_chain(problem, policy)
+    # Solve (I - gamma_pi * P_pi) V = r_pi.
+    if scipy.sparse.issparse(transition_pi):
+      system = scipy.sparse.identity(num_states, format='csc') - (
+          scipy.sparse.diags(gamma_pi) @ transition_pi)
+      values = scipy.sparse.linalg.spsolve(system.tocsc(), reward_pi)
+    else:
+      system = np.eye(num_states) - gamma_pi[:, None] * transition_pi
+      values = np.linalg.solve(system, reward_pi)
 
-  values = np.zeros(num_states)
-  if affordances_fn is not None:
-    # Cache the mask so we don't repeatedly call it.
-    affordances_mask = affordances_fn()
-  else:
-    affordances_mask = None
+  elapsed = datetime.datetime.now() - start_time
+  logging.info(
+      'Policy iteration completed. iterations: %s, time : %s', i, elapsed)
+  return values, elapsed, i
+
+
+def policy_iteration(
+    reward_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    affordances_fn: Optional[affordances.AffordancesFn] = None,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Obtains the optimal policy for an MDP using policy iteration.
+
+  Every iteration evaluates the current policy exactly by solving the linear
+  system of the |S| x |S| Markov chain it induces and then improves the policy
+  greedily. This usually converges in a handful of iterations, even when the
+  discount is close to 1. The arguments and return values are the same as
+  `value_iteration`. `stopping_threshold` is unused since policy iteration stops
+  when the policy does not change.
+  """
+  problem = make_planning_problem(
+      reward_matrix, transition_matrix, gamma, affordances_fn, terminal_states)
+  return _policy_iteration(
+      problem, stopping_threshold, max_iterations, writer, initial_values)
+
+
+def _modified_policy_iteration(
+    problem: PlanningProblem,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    num_evaluation_sweeps: int = 10,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Modified policy iteration on a prepared problem.
+
+  See `modified_policy_iteration`.
+  """
+  start_time = datetime.datetime.now()
+  values = _get_initial_values(problem, initial_values)
   for i in range(max_iterations):
-    _, values, value_diff = _compute_q_v(
-        reward_matrix, gamma, transition_matrix, values, affordances_mask)
+    q_values, values_new, value_diff = _compute_q_v(problem, values)
+    values = values_new
     if writer is not None:
       writer.write({
           'iteration': i, 'max_value': np.max(values),
           'min_value': np.min(values), 'mean_value': np.mean(values),
-          'mean_diff': np.mean(value_diff), 'max_diff': np.mean(value_diff),
+          'mean_diff': np.mean(value_diff), 'max_diff': np.max(value_diff),
       })
     if np.all(value_diff < stopping_threshold):
-      logging.debug('Terminating value iteration: stopping threshold reached.')
+      logging.debug(
+          'Terminating modified policy iteration: stopping threshold reached.')
       break
+    reward_pi, gamma_pi, transition_pi = _get_policy_chain(
+        problem, np.argmax(q_values, axis=1))
+    for _ in range(num_evaluation_sweeps):
+      values = reward_pi + gamma_pi * (transition_pi @ values)
 
   elapsed = datetime.datetime.now() - start_time
   logging.info(
-      'Value iteration completed. Value Diff: %s, iterations: %s, time : %s',
-      np.mean(value_diff), i, elapsed)
+      'Modified policy iteration completed. Value Diff: %s, iterations: %s, '
+      'time : %s', np.mean(value_diff), i, elapsed)
   return values, elapsed, i
 
 
+def modified_policy_iteration(
+    reward_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    affordances_fn: Optional[affordances.AffordancesFn] = None,
+    writer=None,
+    initial_values: Optional[np.ndarray] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    num_evaluation_sweeps: int = 10,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Obtains the optimal policy for an MDP using modified policy iteration.
+
+  Every iteration does one greedy Bellman backup, like value iteration, followed
+  by `num_evaluation_sweeps` cheaper backups with the greedy policy held fixed.
+  With zero sweeps this is value iteration and with infinitely many it is policy
+  iteration. The other arguments and return values are the same as
+  `value_iteration`.
+  """
+  problem = make_planning_problem(
+      reward_matrix, transition_matrix, gamma, affordances_fn, terminal_states)
+  return _modified_policy_iteration(
+      problem, stopping_threshold, max_iterations, writer, initial_values,
+      num_evaluation_sweeps)
+
+
+# Planners that share the signature of `value_iteration`.
+SOLVERS = {
+    'value_iteration': value_iteration,
+    'policy_iteration': policy_iteration,
+    'modified_policy_iteration': modified_policy_iteration,
+}
+
+# The same planners working on a prepared `PlanningProblem`.
+_PROBLEM_SOLVERS = {
+    'value_iteration': _value_iteration,
+    'policy_iteration': _policy_iteration,
+    'modified_policy_iteration': _modified_policy_iteration,
+}
+
+
+def _get_block_problem(
+    problem: PlanningProblem,
+    block: np.ndarray,
+    ) -> Tuple[PlanningProblem, float]:
+  """Restricts a planning problem to a block of states.
+
+  Args:
+    problem: The planning problem over all states.
+    block: Sorted array of the states in the block.
+
+  Returns:
+    The planning problem over the states of the block, with the transitions in
+      the same representation.
+    The largest probability of leaving the block from any (s, a) pair.
+  """
+  num_states, num_actions = problem.num_states, problem.num_actions
+  transition_matrix = problem.transition_matrix
+  global_to_local = np.full(num_states, -1)
+  global_to_local[block] = np.arange(len(block))
+  discount_matrix = problem.discount_matrix[block]
+  if scipy.sparse.issparse(transition_matrix):
+    rows = (block[:, None] * num_actions + np.arange(num_actions)).ravel()
+    block_rows = transition_matrix[rows]
+    block_transitions = block_rows[:, block].tocsr()
+    leaving = np.asarray(
+        block_rows.sum(-1) - block_transitions.sum(-1)).ravel()
+  elif transition_matrix.ndim == 2:
+    block_transitions = global_to_local[transition_matrix[block]]
+    leaving = (block_transitions < 0).astype(np.float64)
+    # Transitions leaving the block are dropped, as in the other
+    # representations, by not bootstrapping from them. They point at an
+    # arbitrary state of the block to keep the indices valid.
+    block_transitions = np.maximum(block_transitions, 0)
+    discount_matrix = np.where(leaving > 0, 0.0, discount_matrix)
+  else:
+    block_rows = transition_matrix[block]
+    block_transitions = block_rows[:, :, block]
+    leaving = block_rows.sum(-1) - block_transitions.sum(-1)
+
+  affordances_mask = problem.affordances_mask
+  if affordances_mask is not None:
+    affordances_mask = affordances_mask[block]
+  block_problem = PlanningProblem(
+      reward_matrix=problem.reward_matrix[block],
+      transition_matrix=block_transitions,
+      discount_matrix=discount_matrix,
+      affordances_mask=affordances_mask)
+  return block_problem, float(np.max(leaving, initial=0.0))
+
+
+def _factored_solve(
+    problem: PlanningProblem,
+    blocks: Sequence[np.ndarray],
+    solver: str = 'value_iteration',
+    initial_values: Optional[np.ndarray] = None,
+    max_workers: Optional[int] = None,
+    **solver_kwargs,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Factored solve of a prepared problem, see `factored_solve`."""
+  start_time = datetime.datetime.now()
+  values = _get_initial_values(problem, initial_values)
+  blocks = [np.sort(np.asarray(block)) for block in blocks]
+  if not np.array_equal(
+      np.sort(np.concatenate(blocks)), np.arange(problem.num_states)):
+    raise ValueError('Blocks must partition the states.')
+
+  def solve_block(block):
+    block_problem, leaving = _get_block_problem(problem, block)
+    if leaving > 1e-6:
+      logging.warning(
+          'Up to %s probability mass leaves the block and is ignored.', leaving)
+    return _PROBLEM_SOLVERS[solver](
+        block_problem, initial_values=values[block], **solver_kwargs)
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers or len(blocks)) as executor:
+    results = list(executor.map(solve_block, blocks))
+
+  num_iterations = 0
+  for block, (block_values, _, block_iterations) in zip(blocks, results):
+    values[block] = block_values
+    num_iterations = max(num_iterations, block_iterations)
+  elapsed = datetime.datetime.now() - start_time
+  logging.info(
+      'Factored %s completed on %d blocks. iterations: %s, time : %s',
+      solver, len(blocks), num_iterations, elapsed)
+  return values, elapsed, num_iterations
+
+
+def factored_solve(
+    reward_matrix: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    blocks: Sequence[np.ndarray],
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    solver: str = 'value_iteration',
+    affordances_fn: Optional[affordances.AffordancesFn] = None,
+    initial_values: Optional[np.ndarray] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    max_workers: Optional[int] = None,
+    **solver_kwargs,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Solves an MDP that decomposes into independent blocks of states.
+
+  When no transition leaves a block of states, for example the states sharing
+  the same taxi destination, each block is an MDP of its own. The blocks are
+  solved independently and in parallel and their values are reassembled.
+
+  Args:
+    reward_matrix: Array of shape |S| x |A|.
+    transition_matrix: Transition matrix in any supported representation.
+    blocks: Arrays of states that partition the state space, e.g.
+      `env_utils.DESTINATION_BLOCKS`.
+    gamma: Discount factor. If this is a matrix, it must be of shape |S| x |A|.
+    solver: The name of the planner in `SOLVERS` to solve every block with.
+    affordances_fn: A function that returns the affordances mask.
+    initial_values: Values of shape |S| to start planning from.
+    terminal_states: States from which no value is bootstrapped.
+    max_workers: Number of threads to solve blocks with. Defaults to one thread
+      per block.
+    **solver_kwargs: Passed on to the solver, e.g. `stopping_threshold`.
+
+  Returns:
+    The values of shape |S| after solving every block.
+    The amount of time the solve took.
+    The largest number of iterations needed by any block.
+  """
+  problem = make_planning_problem(
+      reward_matrix, transition_matrix, gamma, affordances_fn, terminal_states)
+  return _factored_solve(
+      problem, blocks, solver, initial_values, max_workers, **solver_kwargs)
+
+
+def solve_planning_problem(
+    problem: PlanningProblem,
+    solver: str = 'value_iteration',
+    blocks: Optional[Sequence[np.ndarray]] = None,
+    **solver_kwargs,
+    ) -> Tuple[np.ndarray, datetime.timedelta, int]:
+  """Plans in a prepared problem.
+
+  Args:
+    problem: The problem returned by `make_planning_problem`.
+    solver: The name of the planner in `SOLVERS` to use.
+    blocks: If given, the problem is solved block by block, see
+      `factored_solve`.
+    **solver_kwargs: Passed on to the solver, e.g. `stopping_threshold`,
+      `max_iterations` or `initial_values`.
+
+  Returns:
+    The values, the time taken and the number of iterations, see
+    `value_iteration`.
+  """
+  if solver not in _PROBLEM_SOLVERS:
+    raise ValueError(f'Unknown solver {solver}. Valid: {list(SOLVERS)}')
+  if blocks is not None:
+    return _factored_solve(problem, blocks, solver, **solver_kwargs)
+  return _PROBLEM_SOLVERS[solver](problem, **solver_kwargs)
+
+
+def batched_value_iteration(
+    reward_matrices: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    stopping_threshold: float = 0.0001,
+    max_iterations: int = 100,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    ) -> Tuple[np.ndarray, datetime.timedelta, np.ndarray]:
+  """Runs value iteration on a batch of MDPs that share their transitions.
+
+  This is equivalent to calling `value_iteration` on every MDP in the batch,
+  but every Bellman backup is done for all MDPs at once. Each MDP stops being
+  updated once its own values have converged.
+
+  Args:
+    reward_matrices: Array of shape B x |S| x |A| with the rewards of every MDP.
+    transition_matrix: The transitions shared by all MDPs, see
+      `value_iteration`.
+    gamma: Discount factor. If this is an array, it must broadcast to
+      B x |S| x |A|.
+    stopping_threshold: The minimum change in the values needed to prevent the
+      algorithm from stopping early.
+    max_iterations: The maximum number of iterations to run value iteration for.
+    terminal_states: States from which no value is bootstrapped.
+
+  Returns:
+    The values of shape B x |S| at the end of value iteration.
+    The amount of time value iteration was run for.
+    The number of iterations value iteration ran for on each MDP, shape B.
+  """
+  start_time = datetime.datetime.now()
+  num_states, num_actions = get_num_states_and_actions(transition_matrix)
+  batch_size = reward_matrices.shape[0]
+  if reward_matrices.shape != (batch_size, num_states, num_actions):
+    raise ValueError(
+        f'Reward matrices ({reward_matrices.shape}) have an incompatible shape '
+        f'to transition matrix ({transition_matrix.shape})')
+  gamma = _get_discount_matrix(gamma, reward_matrices.shape, terminal_states)
+
+  values = np.zeros((batch_size, num_states))
+  num_iterations = np.full(batch_size, max_iterations - 1)
+  active = np.arange(batch_size)
+  for i in range(max_iterations):
+    q_values = reward_matrices[active] + gamma[active] * _expected_next_values(
+        transition_matrix, values[active])
+    values_new = np.max(q_values, axis=-1)
+    converged = np.all(
+        np.absolute(values[active] - values_new) < stopping_threshold, axis=-1)
+    values[active] = values_new
+    num_iterations[active[converged]] = i
+    active = active[~converged]
+    if not active.size:
+      logging.debug('Terminating value iteration: stopping threshold reached.')
+      break
+
+  elapsed = datetime.datetime.now() - start_time
+  logging.info(
+      'Batched value iteration completed. Converged: %s/%s, iterations: %s, '
+      'time : %s', batch_size - active.size, batch_size, i, elapsed)
+  return values, elapsed, num_iterations
+
+
+def extract_batched_greedy_policies(
+    reward_matrices: np.ndarray,
+    transition_matrix: TransitionMatrix,
+    values: np.ndarray,
+    gamma: Union[float, np.ndarray] = DEFAULT_GAMMA,
+    seed: Optional[int] = None,
+    terminal_states: Sequence[int] = env_utils.GOAL_STATES,
+    ) -> np.ndarray:
+  """Batched version of `extract_greedy_policy`, see `batched_value_iteration`.
+
+  Returns:
+    A B x |S| x |A| array containing the greedy policy of every MDP.
+  """
+  rng = np.random.default_rng(seed)
+  gamma = _get_discount_matrix(gamma, reward_matrices.shape, terminal_states)
+  q_values = reward_matrices + gamma * _expected_next_values(
+      transition_matrix, values)
+
+  best_actions = random_argmax(q_values, rng)
+  num_actions = reward_matrices.shape[-1]
+  pi = np.eye(num_actions)[best_actions]
+  assert pi.shape == reward_matrices.shape
+
+  return pi
+
+
 def run_policy_in_env(
     policy: Callable[[int], int],
     num_episodes: int = 1000,
     max_steps_per_episode: int = 1000,
     initial_state: Optional[int] = None,
-    seed: Optional[int] = None,
+    seed: seeding.Seed = None,
     termination_fn: Callable[[Transition], bool] = lambda t: t.done,
+    record_trajectories: bool = True,
+    tracer: Optional[tracing.Tracer] = None,
     ) -> Tuple[List[Trajectory], List[int], List[float]]:
-  """Executes policy in the environment."""
+  """Executes policy in the environment.
+
+  If `record_trajectories` is False, no trajectories are kept and the returned
+  list of trajectories is empty. Every step and episode is reported to the
+  `tracer`, if given (e.g. a `tracing.LoggingTracer` to log them). Without a
+  tracer, events are logged if debug logging is enabled, see
+  `tracing.get_default_tracer`.
+  """
+  if tracer is None:
+    tracer = tracing.get_default_tracer()
 
-  env = env_utils.make_taxi_environment()
-  env.seed(seed)
-  total_steps, total_pickups, total_illegal, total_reward = 0, 0, 0, 0
+  env = env_utils.BatchedTaxiEnvironment(num_envs=1, seed=seed)
+  statistics = stats_utils.EpisodeStatistics()
 
   trajectories = []
   lengths = []
@@ -174,73 +836,70 @@ def run_policy_in_env(
 
   for _ in range(num_episodes):
     episode_reward, episode_length, reward = 0, 0, 0
-    state = env.reset()
-    if initial_state is not None:
-      env.s = initial_state
-      state = env.s
-      logging.debug('State set to %s', env.s)
-    else:
-      state = env.reset()
+    num_pickups, num_illegal = 0, 0
+    state = int(env.reset(initial_state)[0])
+    if tracer is not None:
+      tracer.on_episode_start(state)
 
     transitions = []
     for _ in range(max_steps_per_episode):
       action = policy(state)
-      new_state, reward, done, _ = env.step(action)
+      new_states, step_rewards, dones = env.step([action])
+      new_state, reward, done = (
+          int(new_states[0]), float(step_rewards[0]), bool(dones[0]))
 
-      logging.debug(
-          ('New transition: \n\t'
-           'State @ t = %s,\n\t'
-           'action = %s,\n\t'
-           'State @ t+1 = %s,\n\t'
-           'reward = %s'),
-          env_utils.int_to_state_fn(state),
-          action,
-          env_utils.int_to_state_fn(new_state),
-          reward)
+      if tracer is not None:
+        tracer.on_step(state, action, reward, new_state, done)
 
       if reward == 20:
-        total_pickups += 1
+        num_pickups += 1
         assert done, 'Episode should terminate when pickup is successful.'
       if reward == -10:
-        total_illegal += 1
+        num_illegal += 1
 
-      transitions.append(
-          Transition(state, action, reward, new_state, done))
+      transition = Transition(state, action, reward, new_state, done)
+      if record_trajectories:
+        transitions.append(transition)
       state = new_state
 
-      total_steps += 1
-      total_reward += reward
       episode_reward += reward
       episode_length += 1
 
-      if termination_fn(transitions[-1]): break
+      if termination_fn(transition): break
 
-    trajectories.append(transitions)
+    if record_trajectories:
+      trajectories.append(transitions)
     lengths.append(episode_length)
     rewards.append(episode_reward)
-
-  logging.debug(
-      ('Results average over %d episodes.\n\t'
-       'Average timesteps per episode: %s\n\t'
-       'Average illegal pickups/drops per step: %s\n\t'
-       'Average successful pickups per step: %s\n\t'
-       'Average reward per step: %s\n\t'
-       'Average episode reward: %s\n\t'
-       'Min/Max episode reward: %s/%s\n\t'
-       'Min/Max episode length: %s/%s\n\t'),
-      num_episodes,
-      total_steps / num_episodes,
-      total_illegal / total_steps,
-      total_pickups / total_steps,
-      total_reward / total_steps,
-      sum(rewards) / len(rewards),
-      min(rewards),
-      max(rewards),
-      min(lengths),
-      max(lengths),
-  )
+    statistics.add_episode(
+        episode_length, episode_reward, num_pickups, num_illegal)
+    if tracer is not None:
+      tracer.on_episode_end(episode_length, episode_reward)
+
+  if logging.level_debug():
+    statistics = statistics.result()
+    logging.debug(
+        ('Results average over %d episodes.\n\t'
+         'Average timesteps per episode: %s\n\t'
+         'Average illegal pickups/drops per step: %s\n\t'
+         'Average successful pickups per step: %s\n\t'
+         'Average reward per step: %s\n\t'
+         'Average episode reward: %s\n\t'
+         'Min/Max episode reward: %s/%s\n\t'
+         'Min/Max episode length: %s/%s\n\t'),
+        num_episodes,
+        statistics['avg_num_steps_per_episode'],
+        statistics['avg_num_illegal_per_step'],
+        statistics['avg_success_per_step'],
+        statistics['avg_reward_per_step'],
+        statistics['avg_episode_reward'],
+        statistics['min_episode_reward'],
+        statistics['max_episode_reward'],
+        statistics['min_episode_length'],
+        statistics['max_episode_length'],
+    )
 
   assert len(lengths) == num_episodes
   assert len(rewards) == num_episodes
-  assert len(trajectories) == num_episodes
+  assert len(trajectories) == (num_episodes if record_trajectories else 0)
   return trajectories, lengths, rewards
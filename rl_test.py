@@ -58,6 +58,114 @@ class RlTest(absltest.TestCase):
         sum(rewards) / sum(lengths), 0,
         msg='Avg reward per step should be > zero for the trained policy.')
 
+  def test_value_iteration_transition_representations_agree(self):
+    _, P_matrix, R_matrix = env_utils.get_transition_and_reward_matrices()  # pylint: disable=invalid-name
+    next_states, _, _ = env_utils.get_transition_tables()
+    expected_values, _, expected_iterations = rl.value_iteration(
+        R_matrix, P_matrix, max_iterations=50)
+    expected_pi = rl.extract_greedy_policy(
+        R_matrix, P_matrix, expected_values, seed=1)
+    for transition_matrix in (
+        next_states, rl.to_sparse_transition_matrix(P_matrix),
+        rl.to_sparse_transition_matrix(next_states)):
+      values, _, num_iterations = rl.value_iteration(
+          R_matrix, transition_matrix, max_iterations=50)
+      np.testing.assert_allclose(values, expected_values)
+      self.assertEqual(num_iterations, expected_iterations)
+      pi = rl.extract_greedy_policy(R_matrix, transition_matrix, values, seed=1)
+      np.testing.assert_array_equal(pi, expected_pi)
+
+  def test_value_iteration_warm_start(self):
+    next_states, R_matrix, _ = env_utils.get_transition_tables()  # pylint: disable=invalid-name
+    values, _, num_iterations = rl.value_iteration(
+        R_matrix, next_states, max_iterations=10000, stopping_threshold=1e-8)
+    self.assertGreater(num_iterations, 1)
+    warm_values, _, warm_iterations = rl.value_iteration(
+        R_matrix, next_states, max_iterations=10000, stopping_threshold=1e-8,
+        initial_values=values)
+    self.assertEqual(warm_iterations, 0)
+    np.testing.assert_allclose(warm_values, values)
+
+  def test_policy_iteration_solvers_agree_with_value_iteration(self):
+    _, P_matrix, R_matrix = env_utils.get_transition_and_reward_matrices()  # pylint: disable=invalid-name
+    next_states, _, _ = env_utils.get_transition_tables()
+    expected_values, _, vi_iterations = rl.value_iteration(
+        R_matrix, next_states, max_iterations=10000, stopping_threshold=1e-10)
+    for transition_matrix in (
+        P_matrix, next_states, rl.to_sparse_transition_matrix(P_matrix)):
+      values, _, pi_iterations = rl.policy_iteration(
+          R_matrix, transition_matrix, max_iterations=100)
+      np.testing.assert_allclose(values, expected_values, atol=1e-6)
+      self.assertLess(pi_iterations, vi_iterations)
+      values, _, _ = rl.modified_policy_iteration(
+          R_matrix, transition_matrix, max_iterations=10000,
+          stopping_threshold=1e-10, num_evaluation_sweeps=5)
+      np.testing.assert_allclose(values, expected_values, atol=1e-6)
+
+  def test_factored_solve_matches_full_solve(self):
+    _, P_matrix, R_matrix = env_utils.get_transition_and_reward_matrices()  # pylint: disable=invalid-name
+    next_states, _, _ = env_utils.get_transition_tables()
+    expected_values, _, _ = rl.value_iteration(
+        R_matrix, next_states, max_iterations=10000, stopping_threshold=1e-10)
+    for transition_matrix in (
+        P_matrix, next_states, rl.to_sparse_transition_matrix(P_matrix)):
+      for solver in rl.SOLVERS:
+        values, _, _ = rl.factored_solve(
+            R_matrix, transition_matrix, env_utils.DESTINATION_BLOCKS,
+            solver=solver, max_iterations=10000, stopping_threshold=1e-10)
+        np.testing.assert_allclose(values, expected_values, atol=1e-6)
+
+  def test_factored_solve_drops_transitions_leaving_blocks(self):
+    # Two states that move to each other. Solving them as separate blocks must
+    # not bootstrap from the other state in any representation.
+    reward_matrix = np.array([[1.0], [2.0]])
+    next_states = np.array([[1], [0]])
+    transition_matrix = np.eye(2)[next_states]
+    for transitions in (
+        transition_matrix, next_states,
+        rl.to_sparse_transition_matrix(transition_matrix)):
+      values, _, _ = rl.factored_solve(
+          reward_matrix, transitions, [np.array([0]), np.array([1])],
+          terminal_states=(), max_iterations=100)
+      np.testing.assert_allclose(values, [1.0, 2.0])
+
+  def test_planning_problem_is_read_only_and_reusable(self):
+    _, P_matrix, R_matrix = env_utils.get_transition_and_reward_matrices()  # pylint: disable=invalid-name
+    original_transitions = P_matrix.copy()
+    mask = np.ones_like(R_matrix)
+    mask[:, 0] = 0
+    problem = rl.make_planning_problem(
+        R_matrix, P_matrix, affordances_fn=lambda: mask)
+    expected_values, _, expected_iterations = rl.value_iteration(
+        R_matrix, P_matrix, max_iterations=50, affordances_fn=lambda: mask)
+    for solver in rl.SOLVERS:
+      values, _, num_iterations = rl.solve_planning_problem(
+          problem, solver=solver, max_iterations=50)
+      if solver == 'value_iteration':
+        np.testing.assert_array_equal(values, expected_values)
+        self.assertEqual(num_iterations, expected_iterations)
+    np.testing.assert_array_equal(P_matrix, original_transitions)
+    np.testing.assert_array_equal(
+        problem.discount_matrix[list(env_utils.GOAL_STATES)], 0)
+    pi = rl.extract_greedy_policy_from_problem(problem, expected_values, seed=1)
+    np.testing.assert_array_equal(pi[:, 0], 0)
+    with self.assertRaises(ValueError):
+      problem.transition_matrix[0, 0, 0] = 1.0
+    with self.assertRaises(ValueError):
+      problem.reward_matrix[0, 0] = 1.0
+
+  def test_random_argmax(self):
+    values = np.array([[1.0, 3.0, 3.0, 0.0], [2.0, 1.0, 0.0, 1.0]])
+    actions = rl.random_argmax(
+        np.repeat(values[None], 10000, 0), np.random.default_rng(0))
+    self.assertEqual(actions.shape, (10000, 2))
+    np.testing.assert_array_equal(actions[:, 1], 0)
+    self.assertEqual(set(actions[:, 0]), {1, 2})
+    self.assertAlmostEqual(np.mean(actions[:, 0] == 1), 0.5, delta=0.02)
+    np.testing.assert_array_equal(
+        rl.random_argmax(values, np.random.default_rng(1)),
+        rl.random_argmax(values, np.random.default_rng(1)))
+
 
 if __name__ == '__main__':
   absltest.main()
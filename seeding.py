@@ -0,0 +1,80 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Independent random number streams for parallel data collection.
+
+Streams are organised in a tree of `np.random.SeedSequence`s, as created by
+`np.random.SeedSequence.spawn`. The sequence of a rollout node is the child of
+the global seed at the index of the node, and the sequence of a batch is the
+child of its node at the index of the batch. Sequences at different positions
+of the tree give independent streams, unlike seeds such as `seed + i` which
+overlap between neighbouring nodes.
+"""
+from typing import Optional, Union
+
+import numpy as np
+
+Seed = Optional[Union[int, np.random.SeedSequence]]
+
+
+def child_sequence(
+    sequence: np.random.SeedSequence, *indices: int) -> np.random.SeedSequence:
+  """Returns a descendant of a seed sequence.
+
+  `child_sequence(sequence, i)` is the same sequence as
+  `sequence.spawn(i + 1)[i]`, but it does not change the state of `sequence`
+  and does not depend on how many children were spawned before.
+
+  Args:
+    sequence: The parent sequence.
+    *indices: The index of the child, then of the grandchild, etc.
+
+  Returns:
+    The descendant sequence.
+  """
+  return np.random.SeedSequence(
+      sequence.entropy, spawn_key=tuple(sequence.spawn_key) + indices,
+      pool_size=sequence.pool_size)
+
+
+def rollout_node_sequence(
+    global_seed: int, node_index: int) -> np.random.SeedSequence:
+  """Returns the seed sequence of a rollout node."""
+  return child_sequence(np.random.SeedSequence(global_seed), node_index)
+
+
+def batch_sequence(
+    node_sequence: np.random.SeedSequence,
+    batch_index: int) -> np.random.SeedSequence:
+  """Returns the seed sequence of a batch collected by a rollout node."""
+  return child_sequence(node_sequence, batch_index)
+
+
+def trajectory_seeds(seed: Seed, num_trajectories: int):
+  """Returns the seeds of the trajectories sampled with `seed`.
+
+  Args:
+    seed: The seed of a batch of trajectories.
+    num_trajectories: The number of trajectories in the batch.
+
+  Returns:
+    A list with the child sequences of the seed sequence, or of
+    `np.random.SeedSequence(seed)` for integer seeds. None stays None.
+  """
+  if seed is None:
+    return [None] * num_trajectories
+  if not isinstance(seed, np.random.SeedSequence):
+    seed = np.random.SeedSequence(seed)
+  return [child_sequence(seed, i) for i in range(num_trajectories)]
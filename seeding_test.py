@@ -0,0 +1,65 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for seeding."""
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import seeding
+
+
+def _draws(seed):
+  return np.random.default_rng(seed).integers(0, 2**32, size=4).tolist()
+
+
+class SeedingTest(absltest.TestCase):
+
+  def test_child_sequence_matches_spawn(self):
+    parent = np.random.SeedSequence(1234)
+    children = np.random.SeedSequence(1234).spawn(3)
+    for i, child in enumerate(children):
+      self.assertEqual(
+          _draws(seeding.child_sequence(parent, i)), _draws(child))
+    self.assertEqual(parent.n_children_spawned, 0)
+    self.assertEqual(
+        _draws(seeding.child_sequence(parent, 2, 5)),
+        _draws(children[2].spawn(6)[5]))
+
+  def test_streams_are_distinct(self):
+    streams = set()
+    for node_index in range(3):
+      node_sequence = seeding.rollout_node_sequence(7, node_index)
+      streams.add(tuple(_draws(node_sequence)))
+      for batch_index in range(3):
+        streams.add(tuple(_draws(
+            seeding.batch_sequence(node_sequence, batch_index))))
+    self.assertLen(streams, 12)
+    self.assertEqual(
+        _draws(seeding.batch_sequence(seeding.rollout_node_sequence(7, 1), 2)),
+        _draws(seeding.batch_sequence(seeding.rollout_node_sequence(7, 1), 2)))
+
+  def test_trajectory_seeds(self):
+    self.assertEqual(seeding.trajectory_seeds(None, 2), [None, None])
+    expected = [_draws(s) for s in np.random.SeedSequence(3).spawn(2)]
+    for seed in (3, np.random.SeedSequence(3)):
+      self.assertEqual(
+          [_draws(s) for s in seeding.trajectory_seeds(seed, 2)], expected)
+    # Neighbouring integer seeds do not share trajectory streams.
+    self.assertNotEqual(
+        _draws(seeding.trajectory_seeds(0, 2)[1]),
+        _draws(seeding.trajectory_seeds(1, 1)[0]))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,260 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Streaming statistics of rollouts.
+
+The accumulators keep counts, sums, minima and maxima of (weighted) values so
+that rollouts can be summarized without keeping their trajectories in memory.
+Values can be added one at a time from a rollout loop or as arrays from
+batched rollouts.
+"""
+import collections
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+Statistics = Dict[str, Any]
+Number = Union[int, float]
+Weights = Optional[Union[Number, np.ndarray]]
+
+
+def _to_python(value):
+  return value.item() if isinstance(value, np.generic) else value
+
+
+class Accumulator:
+  """Streaming weighted count, sum, minimum and maximum of values."""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+  def add(self, value: Number, weight: Number = 1):
+    """Adds a value that was observed `weight` times."""
+    self.count += weight
+    self.total += weight * value
+    self._update_range(value, value)
+
+  def _update_range(self, min_value: Number, max_value: Number):
+    if self.min is None or min_value < self.min:
+      self.min = min_value
+    if self.max is None or max_value > self.max:
+      self.max = max_value
+
+  def add_many(self, values: np.ndarray, weights: Weights = None):
+    """Adds an array of values, each observed once or `weights` times.
+
+    Args:
+      values: The values to add.
+      weights: Optional weight of every value, or a single weight for all of
+        them.
+    """
+    values = np.asarray(values)
+    if not values.size:
+      return
+    if weights is None or np.ndim(weights) == 0:
+      weight = 1 if weights is None else weights
+      self.count += weight * values.size
+      self.total += weight * _to_python(values.sum())
+    else:
+      self.count += _to_python(np.sum(weights))
+      self.total += _to_python(np.dot(weights, values))
+    self._update_range(_to_python(values.min()), _to_python(values.max()))
+
+  @property
+  def mean(self) -> float:
+    return self.total / self.count
+
+
+class KeyedAccumulator:
+  """Streaming weighted counts and value sums per key.
+
+  Keys are kept in order of their first occurrence, so that ties in
+  `most_common` are broken by the key that was seen first.
+  """
+
+  def __init__(self):
+    self.counts = collections.Counter()
+    self.totals = collections.Counter()
+
+  def add(self, key: int, value: Number, weight: Number = 1):
+    self.counts[key] += weight
+    self.totals[key] += weight * value
+
+  def add_many(
+      self,
+      keys: np.ndarray,
+      values: np.ndarray,
+      weights: Weights = None,
+      ):
+    """Adds arrays of integer keys and their values."""
+    keys = np.asarray(keys)
+    if not keys.size:
+      return
+    weights = np.broadcast_to(1 if weights is None else weights, keys.shape)
+    unique_keys, first_index = np.unique(keys, return_index=True)
+    counts = np.bincount(keys, weights=weights)
+    totals = np.bincount(keys, weights=weights * np.asarray(values))
+    if np.issubdtype(np.asarray(weights).dtype, np.integer):
+      counts = counts.astype(np.int64)
+    for key in unique_keys[np.argsort(first_index)].tolist():
+      self.counts[key] += _to_python(counts[key])
+      self.totals[key] += _to_python(totals[key])
+
+  def most_common(self, n: int) -> List[Tuple[int, Number]]:
+    return self.counts.most_common(n)
+
+
+class EpisodeStatistics:
+  """Streaming statistics of the episodes of a rollout."""
+
+  def __init__(self):
+    self.lengths = Accumulator()
+    self.rewards = Accumulator()
+    self.pickups = Accumulator()
+    self.illegal = Accumulator()
+
+  def add_episode(
+      self, length: int, reward: float, num_pickups: int, num_illegal: int,
+      weight: Number = 1):
+    """Adds an episode that was observed `weight` times."""
+    self.lengths.add(length, weight)
+    self.rewards.add(reward, weight)
+    self.pickups.add(num_pickups, weight)
+    self.illegal.add(num_illegal, weight)
+
+  def add_episodes(
+      self,
+      lengths: np.ndarray,
+      rewards: np.ndarray,
+      num_pickups: np.ndarray,
+      num_illegal: np.ndarray,
+      weights: Weights = None,
+      ):
+    """Adds a batch of episodes given as arrays."""
+    self.lengths.add_many(lengths, weights)
+    self.rewards.add_many(rewards, weights)
+    self.pickups.add_many(num_pickups, weights)
+    self.illegal.add_many(num_illegal, weights)
+
+  def _get_scale(
+      self, num_episodes: Optional[Number]) -> Tuple[Number, Number]:
+    """Returns the number of episodes and the factor to scale totals by."""
+    if num_episodes is None:
+      return self.lengths.count, 1
+    return num_episodes, num_episodes / self.lengths.count
+
+  def result(self, num_episodes: Optional[Number] = None) -> Statistics:
+    """Returns the statistics of the episodes.
+
+    Args:
+      num_episodes: The number of episodes to report the statistics for. Totals
+        are scaled accordingly. Defaults to the total weight of the episodes.
+    """
+    num_episodes, scale = self._get_scale(num_episodes)
+    total_steps = scale * self.lengths.total
+    return {
+        'num_episodes': num_episodes,
+        'avg_num_steps_per_episode': total_steps / num_episodes,
+        'avg_num_illegal_per_step': scale * self.illegal.total / total_steps,
+        'avg_success_per_step': scale * self.pickups.total / total_steps,
+        'avg_reward_per_step': scale * self.rewards.total / total_steps,
+        'prop_success': scale * self.pickups.total / num_episodes,
+        'prop_illegal': scale * self.illegal.total / num_episodes,
+        'avg_episode_reward': scale * self.rewards.total / num_episodes,
+        'min_episode_reward': self.rewards.min,
+        'max_episode_reward': self.rewards.max,
+        'min_episode_length': self.lengths.min,
+        'max_episode_length': self.lengths.max,
+        'total_steps': total_steps,
+    }
+
+
+class HrlStatistics(EpisodeStatistics):
+  """Streaming statistics of the episodes and options of an HRL rollout.
+
+  Options are identified by their index into `option_names`.
+  """
+
+  def __init__(self, option_names: Sequence[str]):
+    super().__init__()
+    self._option_names = option_names
+    self.options_per_episode = Accumulator()
+    self.option_lengths = Accumulator()
+    self.option_rewards = Accumulator()
+    self.options = KeyedAccumulator()
+
+  def add_episode(
+      self, length: int, reward: float, num_pickups: int, num_illegal: int,
+      num_options: int = 0, weight: Number = 1):
+    super().add_episode(length, reward, num_pickups, num_illegal, weight)
+    self.options_per_episode.add(num_options, weight)
+
+  def add_episodes(
+      self,
+      lengths: np.ndarray,
+      rewards: np.ndarray,
+      num_pickups: np.ndarray,
+      num_illegal: np.ndarray,
+      num_options: Optional[np.ndarray] = None,
+      weights: Weights = None,
+      ):
+    super().add_episodes(lengths, rewards, num_pickups, num_illegal, weights)
+    if num_options is not None:
+      self.options_per_episode.add_many(num_options, weights)
+
+  def add_option(
+      self, option_id: int, length: int, reward: float, weight: Number = 1):
+    """Adds an executed option that was observed `weight` times."""
+    self.option_lengths.add(length, weight)
+    self.option_rewards.add(reward, weight)
+    self.options.add(option_id, reward, weight)
+
+  def add_options(
+      self,
+      option_ids: np.ndarray,
+      lengths: np.ndarray,
+      rewards: np.ndarray,
+      weights: Weights = None,
+      ):
+    """Adds a batch of executed options in the order they were executed."""
+    self.option_lengths.add_many(lengths, weights)
+    self.option_rewards.add_many(rewards, weights)
+    self.options.add_many(option_ids, rewards, weights)
+
+  def result(self, num_episodes: Optional[Number] = None) -> Statistics:
+    statistics = super().result(num_episodes)
+    num_episodes, scale = self._get_scale(num_episodes)
+    total_options = scale * self.options_per_episode.total
+    most_common = self.options.most_common(10)
+    statistics.update({
+        'avg_num_options_per_episode': total_options / num_episodes,
+        'total_options_executed': total_options,
+        'avg_option_length': self.option_lengths.mean,
+        'min_option_length': self.option_lengths.min,
+        'max_option_length': self.option_lengths.max,
+        'avg_option_reward': self.option_rewards.mean,
+        'min_option_reward': self.option_rewards.min,
+        'max_option_reward': self.option_rewards.max,
+        'most_common_options': {
+            self._option_names[k]: v / self.options_per_episode.total
+            for k, v in most_common},
+        'most_common_option_reward': {
+            self._option_names[k]: self.options.totals[k] / v
+            for k, v in most_common},
+    })
+    return statistics
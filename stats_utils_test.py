@@ -0,0 +1,100 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for stats_utils."""
+from absl.testing import absltest
+import numpy as np
+from affordances_option_models import stats_utils
+
+
+class StatsUtilsTest(absltest.TestCase):
+
+  def test_accumulator(self):
+    values = [3, -1, 4, 1, 5]
+    accumulator = stats_utils.Accumulator()
+    for value in values:
+      accumulator.add(value)
+    batched_accumulator = stats_utils.Accumulator()
+    batched_accumulator.add_many(np.array(values[:2]))
+    batched_accumulator.add_many(np.array(values[2:]))
+    for acc in (accumulator, batched_accumulator):
+      self.assertEqual(
+          (acc.count, acc.total, acc.min, acc.max), (5, 12, -1, 5))
+      self.assertEqual(acc.mean, 2.4)
+
+    weighted_accumulator = stats_utils.Accumulator()
+    weighted_accumulator.add_many(np.array([3, -1]), weights=np.array([2, 3]))
+    weighted_accumulator.add_many(np.array([4]), weights=5)
+    self.assertEqual(weighted_accumulator.count, 10)
+    self.assertEqual(weighted_accumulator.total, 23)
+    self.assertEqual((weighted_accumulator.min, weighted_accumulator.max),
+                     (-1, 4))
+
+  def test_keyed_accumulator_keeps_first_occurrence_order(self):
+    keys = [2, 0, 2, 1, 0, 1]
+    values = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+    accumulator = stats_utils.KeyedAccumulator()
+    for key, value in zip(keys, values):
+      accumulator.add(key, value)
+    batched_accumulator = stats_utils.KeyedAccumulator()
+    batched_accumulator.add_many(np.array(keys), np.array(values))
+    for acc in (accumulator, batched_accumulator):
+      self.assertEqual(acc.most_common(3), [(2, 2), (0, 2), (1, 2)])
+      self.assertEqual(acc.totals, {0: 7.0, 1: 10.0, 2: 4.0})
+
+  def test_hrl_statistics_weights(self):
+    statistics = stats_utils.HrlStatistics(('A', 'B'))
+    weighted_statistics = stats_utils.HrlStatistics(('A', 'B'))
+    episodes = [
+        # (length, reward, pickups, illegal, options, lengths, rewards)
+        (3, -3.0, 0, 0, [1, 0], [2, 1], [-2.0, -1.0]),
+        (5, 15.0, 1, 1, [0], [5], [15.0]),
+    ]
+    for weight, episode in zip((1, 3), episodes):
+      length, reward, pickups, illegal, options, lengths, rewards = episode
+      for _ in range(weight):
+        statistics.add_episode(length, reward, pickups, illegal, len(options))
+        for option_id, option_length, option_reward in zip(
+            options, lengths, rewards):
+          statistics.add_option(option_id, option_length, option_reward)
+      weighted_statistics.add_episode(
+          length, reward, pickups, illegal, len(options), weight=weight)
+      weighted_statistics.add_options(
+          np.array(options), np.array(lengths), np.array(rewards), weight)
+
+    expected = statistics.result()
+    self.assertEqual(weighted_statistics.result(), expected)
+    self.assertEqual(expected['num_episodes'], 4)
+    self.assertEqual(expected['total_steps'], 18)
+    self.assertEqual(expected['prop_success'], 0.75)
+    self.assertEqual(expected['most_common_options'], {'A': 0.8, 'B': 0.2})
+    self.assertEqual(expected['most_common_option_reward'],
+                     {'A': 11.0, 'B': -2.0})
+    # Totals are scaled when reporting for a different number of episodes.
+    scaled = weighted_statistics.result(num_episodes=8)
+    self.assertEqual(scaled['total_steps'], 36)
+    self.assertEqual(scaled['prop_success'], 0.75)
+
+  def test_hrl_statistics_episodes_without_options(self):
+    statistics = stats_utils.HrlStatistics(('A',))
+    statistics.add_episodes(
+        np.array([3, 5]), np.array([-3.0, 15.0]), np.array([0, 1]),
+        np.array([0, 0]))
+    self.assertEqual(statistics.options_per_episode.total, 0)
+    self.assertEqual(statistics.lengths.total, 8)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -16,7 +16,7 @@
 """An open-sourcable version of task-queue."""
 import queue
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 from absl import logging
 import launchpad as lp
@@ -54,12 +54,15 @@ class _QueueImplementation:
   def __init__(self, **kwargs):
     del kwargs  # Unused.
     self._queue = queue.Queue(maxsize=int(1e9))
+    # Keys of the tasks whose results were not set yet.
+    self._pending = set()
     self._closed = False
     logging.info('Queue created!')
 
   def enqueue_task(self, task_key, data):
     data = data.copy()
     data['task_key'] = task_key
+    self._pending.add(task_key)
     self._queue.put_nowait(data)
     logging.log_every_n_seconds(
         logging.INFO, 'Current queue size is %d',
@@ -73,10 +76,12 @@ class _QueueImplementation:
     logging.log_every_n_seconds(logging.INFO, '[GET] Data = %s', 15, data)
     return task_key, data
 
-  def set_result(self, *args, **kwargs):
+  def set_result(self, topic_name, task_key, *args, **kwargs):
+    self._pending.discard(task_key)
     self._queue.task_done()
     logging.log_every_n_seconds(
-        logging.INFO, 'Task result was set %s %s', 600, args, kwargs)
+        logging.INFO, 'Task result was set %s %s %s %s', 600, topic_name,
+        task_key, args, kwargs)
 
   def closed(self):
     return self._closed
@@ -84,6 +89,24 @@ class _QueueImplementation:
   def empty(self):
     return self._queue.empty()
 
+  def join(self, timeout: Optional[float] = None) -> List[Any]:
+    """Blocks until the results of all tasks were set.
+
+    A task whose consumer fails before setting its result is never done, so
+    without a timeout this blocks forever in that case.
+
+    Args:
+      timeout: The number of seconds to wait for, or None to wait until every
+        result is set.
+
+    Returns:
+      The keys of the tasks whose results were not set in time.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while self._pending and (deadline is None or time.time() < deadline):
+      time.sleep(1)
+    return sorted(self._pending)
+
   def close(self):
     while True:
       if self._queue.empty():
@@ -0,0 +1,117 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tracing hooks for rollout loops.
+
+Rollout loops such as `rl.run_policy_in_env` and `hrl.run_hrl_policy_in_env`
+take an optional tracer and call its hooks as the rollout progresses. Without a
+tracer nothing is formatted or decoded, so tracers should only be attached when
+diagnosing a rollout. When debug logging is enabled, e.g. with `--v=1`, rollouts
+without a tracer log their events with a `LoggingTracer`.
+"""
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from absl import logging
+
+from affordances_option_models import env_utils
+
+
+class Tracer:
+  """Receives the events of a rollout. All hooks do nothing by default."""
+
+  def on_episode_start(self, state: int):
+    """Called with the initial state of every episode."""
+
+  def on_step(
+      self,
+      s_t: int,
+      a_t: int,
+      r_tp1: float,
+      s_tp1: int,
+      done: bool,
+      option_id: Optional[Any] = None):
+    """Called after every step, with the executing option in HRL rollouts."""
+
+  def on_option_end(
+      self, option_id: Any, option_length: int, option_reward: float):
+    """Called when an option stops executing in HRL rollouts."""
+
+  def on_episode_end(self, episode_length: int, episode_reward: float):
+    """Called at the end of every episode."""
+
+
+class LoggingTracer(Tracer):
+  """Logs every event at debug level, with decoded states."""
+
+  def on_episode_start(self, state):
+    logging.debug('Episode started in %s', env_utils.int_to_state_fn(state))
+
+  def on_step(self, s_t, a_t, r_tp1, s_tp1, done, option_id=None):
+    logging.debug(
+        ('New transition: \n\t'
+         'State @ t = %s,\n\t'
+         'action = %s,\n\t'
+         'option= %s\n\t'
+         'State @ t+1 = %s,\n\t'
+         'reward = %s,\n\t'
+         'done = %s'),
+        env_utils.int_to_state_fn(s_t),
+        a_t,
+        option_id,
+        env_utils.int_to_state_fn(s_tp1),
+        r_tp1,
+        done)
+
+  def on_option_end(self, option_id, option_length, option_reward):
+    logging.debug(
+        'Option %s terminated. Option length = %d, reward = %s',
+        option_id, option_length, option_reward)
+
+  def on_episode_end(self, episode_length, episode_reward):
+    logging.debug(
+        'Episode terminated. Length = %d, reward = %s',
+        episode_length, episode_reward)
+
+
+def get_default_tracer() -> Optional[Tracer]:
+  """Returns a `LoggingTracer` if debug logging is enabled, None otherwise."""
+  return LoggingTracer() if logging.level_debug() else None
+
+
+class TracedEpisode(NamedTuple):
+  """Events of an episode recorded by `RecordingTracer`."""
+  # NOTE: Do not change this to a dataclass to maintain tuple semantics.
+  initial_state: int
+  # (s_t, a_t, r_tp1, s_tp1, done, option_id) of every step.
+  steps: List[Tuple[int, int, float, int, bool, Optional[Any]]]
+  # (option_id, option_length, option_reward) of every executed option.
+  options: List[Tuple[Any, int, float]]
+
+
+class RecordingTracer(Tracer):
+  """Records the events of every episode in memory."""
+
+  def __init__(self):
+    self.episodes: List[TracedEpisode] = []
+
+  def on_episode_start(self, state):
+    self.episodes.append(TracedEpisode(state, [], []))
+
+  def on_step(self, s_t, a_t, r_tp1, s_tp1, done, option_id=None):
+    self.episodes[-1].steps.append((s_t, a_t, r_tp1, s_tp1, done, option_id))
+
+  def on_option_end(self, option_id, option_length, option_reward):
+    self.episodes[-1].options.append(
+        (option_id, option_length, option_reward))
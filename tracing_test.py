@@ -0,0 +1,89 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for tracing."""
+from unittest import mock
+
+from absl import logging
+from absl.testing import absltest
+from affordances_option_models import hrl
+from affordances_option_models import option_utils
+from affordances_option_models import rl
+from affordances_option_models import tracing
+
+Options = option_utils.Options
+
+
+class TracingTest(absltest.TestCase):
+
+  def test_recording_tracer_matches_trajectories(self):
+    tracer = tracing.RecordingTracer()
+    trajectories, lengths, _ = rl.run_policy_in_env(
+        lambda s: s % 6, num_episodes=3, max_steps_per_episode=20, seed=0,
+        tracer=tracer)
+    self.assertLen(tracer.episodes, 3)
+    for episode, trajectory, length in zip(
+        tracer.episodes, trajectories, lengths):
+      self.assertEqual(episode.initial_state, trajectory[0].s_t)
+      self.assertEqual(
+          [step[:5] for step in episode.steps],
+          [tuple(transition) for transition in trajectory])
+      self.assertLen(episode.steps, length)
+
+  def test_hrl_tracer_reports_options(self):
+    tracer = tracing.RecordingTracer()
+    trajectories, _, _, statistics = hrl.run_hrl_policy_in_env(
+        option_policy=lambda s, o: (s + o.value) % 6,
+        policy_over_options=lambda s: Options(s % len(Options) + 1),
+        option_term_fn=lambda t: t.transition.done,
+        max_option_length=3,
+        num_episodes=2,
+        max_steps_per_episode=10,
+        seed=0,
+        tracer=tracer)
+    self.assertEqual(
+        sum(len(episode.options) for episode in tracer.episodes),
+        statistics['total_options_executed'])
+    for episode, trajectory in zip(tracer.episodes, trajectories):
+      self.assertEqual(
+          [step[-1] for step in episode.steps],
+          [transition.option_id for transition in trajectory])
+      self.assertEqual(
+          sum(length for _, length, _ in episode.options), len(trajectory))
+
+  def test_logging_tracer(self):
+    with mock.patch.object(logging, 'debug') as debug:
+      rl.run_policy_in_env(
+          lambda s: 0, num_episodes=1, max_steps_per_episode=2, seed=0,
+          tracer=tracing.LoggingTracer())
+    # One call for the start, every step and the end of the episode.
+    self.assertEqual(debug.call_count, 4)
+
+  def test_debug_logging_attaches_logging_tracer(self):
+    verbosity = logging.get_verbosity()
+    self.addCleanup(logging.set_verbosity, verbosity)
+    with mock.patch.object(logging, 'debug') as debug:
+      rl.run_policy_in_env(
+          lambda s: 0, num_episodes=1, max_steps_per_episode=2, seed=0)
+      self.assertEqual(debug.call_count, 0)
+      logging.set_verbosity(logging.DEBUG)
+      rl.run_policy_in_env(
+          lambda s: 0, num_episodes=1, max_steps_per_episode=2, seed=0)
+    # The four events of the episode and the summary of the rollout.
+    self.assertEqual(debug.call_count, 5)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -21,12 +21,15 @@ import numpy as np
 import tensorflow as tf
 
 from affordances_option_models import affordances
+from affordances_option_models import data as data_tools
 
 NestedTensor = Union[tf.Tensor, List[tf.Tensor]]
 OptimizationStep = Callable[[NestedTensor], Dict[str, tf.Tensor]]
 
 
-def prepare_data(data: List[Tuple[Any, ...]]) -> List[tf.Tensor]:
+def prepare_data(
+    data: Union[List[Tuple[Any, ...]], data_tools.OptionTransitionBatch]
+    ) -> List[tf.Tensor]:
   r"""Prepares the trajectory data ready for tensorflow.
 
   This function unpacks transition data and stacks them suitable for input
@@ -37,12 +40,25 @@ def prepare_data(data: List[Tuple[Any, ...]]) -> List[tf.Tensor]:
      of shape (batch_size, 1). Note: That if the transition contains a tuple,
      it will be flattened such that the shape will be (None, 1).
 
+  A `data.OptionTransitionBatch` is already stored column by column, so its
+  arrays are converted without going through Python objects. The weights of an
+  aggregated batch are returned as a seventh tensor.
+
   Args:
-    data: A list of tuples with the transition data.
+    data: A list of tuples with the transition data or a columnar batch.
 
   Returns:
     A list of `tf.Tensor`s that are suitable for a neural network.
   """
+  if isinstance(data, data_tools.OptionTransitionBatch):
+    # Intents are stored as int8 to keep batches small. Cast them to the same
+    # dtype that stacking a list of transitions gives.
+    data = data._replace(
+        intents_completed=data.intents_completed.astype(np.int32))
+    if data.weights is None:
+      data = data[:-1]
+    return [tf.reshape(tf.convert_to_tensor(x), (-1, 1)) for x in data]
+
   # Transpose data from [(x1, y1), (x2, y2), ...]  into
   # ([x1, x2, ...], [y1, y2, ...]).
   transposed_data = list(zip(*data))
@@ -81,15 +97,17 @@ def get_training_steps(
     if affordance_network is None: return dict(
         total_affordance_loss=tf.constant(0.0))
     with tf.GradientTape() as tape:
-      s_t, o_t, _, _, _, achieved_intent = trajectory
+      s_t, o_t, _, _, _, achieved_intent = trajectory[:6]
 
       predicted_intent = affordance_network(s_t, o_t)
+      # Every intent of a transition gets the weight of the transition.
+      weights = _get_weights(trajectory, predicted_intent)
       achieved_intent = tf.reshape(achieved_intent, (-1, 1))
       predicted_intent = tf.reshape(predicted_intent, (-1, 1))
 
       loss = tf.keras.losses.binary_crossentropy(  # pytype: disable=attribute-error
           achieved_intent, predicted_intent)
-      total_loss = tf.reduce_mean(loss)
+      total_loss = tf.reduce_sum(loss * weights) / tf.reduce_sum(weights)
     grads = tape.gradient(total_loss, affordance_network.trainable_variables)
     if affordance_optimizer is None:
       raise ValueError('Please provide an affordance optimizer.')
@@ -98,6 +116,15 @@ def get_training_steps(
 
     return dict(total_affordance_loss=total_loss)
 
+  def _get_weights(trajectory, like):
+    """Returns the transition weights broadcast to `like` and flattened."""
+    if len(trajectory) < 7:
+      return tf.ones_like(tf.reshape(like, (-1,)), dtype=tf.float32)
+    weights = tf.cast(trajectory[6], tf.float32)
+    if like.shape.rank == 1:
+      return tf.reshape(weights, (-1,))
+    return tf.reshape(tf.broadcast_to(weights, tf.shape(like)), (-1,))
+
   if heuristic_affordance_fn is not None and not use_learned_affordances:
     affs_matrix = heuristic_affordance_fn()
     heuristic_affs_matrix = affs_matrix.astype(np.float32)
@@ -107,7 +134,7 @@ def get_training_steps(
   def _train_step_model(trajectory):
     """Train model network."""
     with tf.GradientTape() as tape:
-      s_t, o_t, target_lengths, target_rewards, s_tp1, _ = trajectory
+      s_t, o_t, target_lengths, target_rewards, s_tp1, _ = trajectory[:6]
 
       # Here we compute the mask for each element in the batch. For each
       # (state, option) pair in the batch, the mask is 1 if it is part of the
@@ -137,6 +164,8 @@ def get_training_steps(
       else:
         # By default everything is affordable.
         mask = tf.ones_like(tf.squeeze(s_t), dtype=tf.float32)
+      # Aggregated transitions count as many times as they occurred.
+      mask = mask * _get_weights(trajectory, mask)
       # The mask is a vector of length batch size with 1's indicating which
       # examples should be included in the loss. We take the sum of the mask
       # here to obtains the number of examples that are to be incldued. This